@@ -0,0 +1,205 @@
+from heapq import nlargest
+from mal_common import AnimeStatus
+
+DEFAULT_STATUS_SORT_ORDER = (AnimeStatus.Completed, AnimeStatus.Watching, AnimeStatus.OnHold, AnimeStatus.Dropped)
+
+
+class CharacterVaGraph:
+    """
+    In-memory graph of anime <-> character <-> voice actor with all the edges indexed
+    in both directions, so adding/removing an anime and querying the graph never
+    requires scanning all the characters.
+
+    Only voice actors of 'voice_actor_language' are linked to characters. Per character
+    the graph keeps whether it's a main character in any of its anime and the best rank of
+    the statuses of its anime (according to 'status_sort_order'), per voice actor it keeps
+    the number of main characters they voice.
+    """
+    def __init__(self, voice_actor_language: str = 'Japanese', status_sort_order: tuple = DEFAULT_STATUS_SORT_ORDER):
+        self.voice_actor_language = voice_actor_language.lower()
+        self._status_ranks = {status: rank for rank, status in enumerate(status_sort_order)}
+
+        # {'ID of an anime': {'title', 'status'}, ...}
+        self.anime = {}
+
+        # {'ID of an anime character': {'name', 'image_link', 'voice_actors': [[id, language], ...]}, ...}
+        self.characters = {}
+
+        # Edges, anime -> characters also holds whether the character is a main character in that anime
+        self.anime_characters = {}          # {anime_id: {character_id: is_main_character}}
+        self.character_anime = {}           # {character_id: {anime_id: None}} (ordered set)
+        self.character_voice_actors = {}    # {character_id: {voice_actor_id: None}} (ordered set)
+        self.voice_actor_characters = {}    # {voice_actor_id: {character_id: None}} (ordered set)
+
+        # Aggregates
+        self.character_is_main = {}         # {character_id: bool}
+        self.character_status_rank = {}     # {character_id: int}
+        self.voice_actor_main_counts = {}   # {voice_actor_id: int}
+
+    def add_anime(self, anime_id: str, title: str, status: int, characters: list) -> None:
+        """
+        Add (or replace) an anime and its characters, as returned by mal_base.get_anime_character_list.
+        """
+        if anime_id in self.anime:
+            self.remove_anime(anime_id)
+
+        self.anime[anime_id] = {'title': title, 'status': status}
+        self.anime_characters[anime_id] = {}
+        for character in characters:
+            self.__add_character(anime_id, character['id'], {
+                'name'          : character['name'],
+                'image_link'    : character['image_link'],
+                'voice_actors'  : [[voice_actor['id'], voice_actor['language']] for voice_actor in character['voice_actors']]
+            }, character['is_main_character'])
+
+    def remove_anime(self, anime_id: str) -> None:
+        """
+        Remove an anime, characters that don't appear in any other anime are removed as well.
+        """
+        del self.anime[anime_id]
+        for character_id in self.anime_characters.pop(anime_id):
+            appearances = self.character_anime[character_id]
+            del appearances[anime_id]
+            if appearances:
+                self.__refresh_character(character_id)
+            else:
+                self.__remove_character(character_id)
+
+    def set_anime_status(self, anime_id: str, status: int) -> None:
+        self.anime[anime_id]['status'] = status
+        for character_id in self.anime_characters[anime_id]:
+            self.__refresh_character(character_id)
+
+    def set_anime_title(self, anime_id: str, title: str) -> None:
+        self.anime[anime_id]['title'] = title
+
+    def get_anime_voice_actors(self, anime_id: str) -> set:
+        return {voice_actor_id for character_id in self.anime_characters[anime_id] for voice_actor_id in self.character_voice_actors[character_id]}
+
+    def get_shared_voice_actors(self, anime_ids_a, anime_ids_b) -> set:
+        """
+        Return the voice actors that voice characters in both groups of anime
+        (e.g. a single anime each, or the lists of two users).
+        """
+        voice_actors_a = set().union(*(self.get_anime_voice_actors(anime_id) for anime_id in anime_ids_a))
+        voice_actors_b = set().union(*(self.get_anime_voice_actors(anime_id) for anime_id in anime_ids_b))
+        return voice_actors_a & voice_actors_b
+
+    def get_voice_actor_score(self, voice_actor_id: str) -> tuple:
+        # Voice actors are ranked by the number of characters and then by the number of main characters
+        return len(self.voice_actor_characters[voice_actor_id]), self.voice_actor_main_counts[voice_actor_id]
+
+    def get_top_voice_actors(self, count: int) -> list[str]:
+        return nlargest(count, self.voice_actor_characters, key=self.get_voice_actor_score)
+
+    def get_sorted_voice_actor_characters(self, voice_actor_id: str, anime_order: list = None) -> list[str]:
+        """
+        Return the characters of the voice actor sorted by the status of their anime
+        (see 'status_sort_order') and then main characters first. Ties are broken by
+        the first of their anime in 'anime_order' and then by ID, so the order doesn't
+        depend on the order in which anime were added to the graph.
+        """
+        return self.__sort_characters(self.voice_actor_characters[voice_actor_id], self.__get_character_positions(anime_order))
+
+    def get_sorted_rows(self, anime_order: list = None) -> list[list[str]]:
+        """
+        Return a list of characters per voice actor, voice actors with the most
+        characters (and then most main characters) first. Ties are broken the same
+        way as in get_sorted_voice_actor_characters().
+        """
+        character_positions = self.__get_character_positions(anime_order)
+        voice_actor_positions = {
+            voice_actor_id: min(character_positions[character_id] for character_id in character_ids)
+            for voice_actor_id, character_ids in self.voice_actor_characters.items()
+        }
+
+        def get_voice_actor_sort_key(voice_actor_id: str) -> tuple:
+            character_count, main_character_count = self.get_voice_actor_score(voice_actor_id)
+            return -character_count, -main_character_count, voice_actor_positions[voice_actor_id], voice_actor_id
+
+        voice_actor_ids = sorted(self.voice_actor_characters, key=get_voice_actor_sort_key)
+        return [self.__sort_characters(self.voice_actor_characters[voice_actor_id], character_positions) for voice_actor_id in voice_actor_ids]
+
+    def __get_character_positions(self, anime_order: list = None) -> dict:
+        # {character_id: position of the character's first anime in 'anime_order'}, anime that aren't in it come last
+        anime_positions = {anime_id: position for position, anime_id in enumerate(anime_order or ())}
+        return {
+            character_id: min(anime_positions.get(anime_id, len(anime_positions)) for anime_id in anime_ids)
+            for character_id, anime_ids in self.character_anime.items()
+        }
+
+    def __sort_characters(self, character_ids, character_positions: dict) -> list[str]:
+        return sorted(character_ids, key=(lambda character_id : (
+            self.character_status_rank[character_id], not self.character_is_main[character_id], character_positions[character_id], character_id)))
+
+    def to_json(self) -> dict:
+        return {
+            'anime'         : {anime_id: dict(anime, characters=self.anime_characters[anime_id]) for anime_id, anime in self.anime.items()},
+            'characters'    : self.characters
+        }
+
+    @classmethod
+    def from_json(cls, json_data: dict, *args, **kwargs) -> 'CharacterVaGraph':
+        graph = cls(*args, **kwargs)
+        for anime_id, anime in json_data['anime'].items():
+            graph.anime[anime_id] = {'title': anime['title'], 'status': anime['status']}
+            graph.anime_characters[anime_id] = {}
+            for character_id, is_main_character in anime['characters'].items():
+                graph.__add_character(anime_id, character_id, json_data['characters'][character_id], is_main_character)
+        return graph
+
+    def __add_character(self, anime_id: str, character_id: str, character_data: dict, is_main_character: bool) -> None:
+        self.anime_characters[anime_id][character_id] = is_main_character
+        self.character_anime.setdefault(character_id, {})[anime_id] = None
+
+        # The newest data of a character replaces the old one
+        self.characters[character_id] = character_data
+        voice_actor_ids = dict.fromkeys(
+            voice_actor_id for voice_actor_id, language in character_data['voice_actors']
+            if language.lower() == self.voice_actor_language
+        )
+
+        previous_voice_actor_ids = self.character_voice_actors.get(character_id, {})
+        for voice_actor_id in previous_voice_actor_ids.keys() - voice_actor_ids.keys():
+            self.__unlink(character_id, voice_actor_id)
+        self.character_voice_actors[character_id] = voice_actor_ids
+        for voice_actor_id in [voice_actor_id for voice_actor_id in voice_actor_ids if voice_actor_id not in previous_voice_actor_ids]:
+            self.voice_actor_characters.setdefault(voice_actor_id, {})[character_id] = None
+            self.voice_actor_main_counts.setdefault(voice_actor_id, 0)
+            if self.character_is_main.get(character_id):
+                self.voice_actor_main_counts[voice_actor_id] += 1
+
+        self.__refresh_character(character_id)
+
+    def __remove_character(self, character_id: str) -> None:
+        for voice_actor_id in self.character_voice_actors.pop(character_id):
+            self.__unlink(character_id, voice_actor_id)
+        del self.character_anime[character_id]
+        del self.characters[character_id]
+        del self.character_is_main[character_id]
+        del self.character_status_rank[character_id]
+
+    def __unlink(self, character_id: str, voice_actor_id: str) -> None:
+        voice_actor_characters = self.voice_actor_characters[voice_actor_id]
+        del voice_actor_characters[character_id]
+        if not voice_actor_characters:
+            del self.voice_actor_characters[voice_actor_id]
+            del self.voice_actor_main_counts[voice_actor_id]
+        elif self.character_is_main[character_id]:
+            self.voice_actor_main_counts[voice_actor_id] -= 1
+
+    def __refresh_character(self, character_id: str) -> None:
+        """
+        Recalculate the aggregates of a character after its anime changed.
+        """
+        anime_ids = self.character_anime[character_id]
+        self.character_status_rank[character_id] = min(
+            self._status_ranks.get(self.anime[anime_id]['status'], len(self._status_ranks)) for anime_id in anime_ids)
+
+        is_main_character = any(self.anime_characters[anime_id][character_id] for anime_id in anime_ids)
+        # New characters are linked to their voice actors as non main characters
+        was_main_character = self.character_is_main.get(character_id, False)
+        self.character_is_main[character_id] = is_main_character
+        if was_main_character != is_main_character:
+            for voice_actor_id in self.character_voice_actors[character_id]:
+                self.voice_actor_main_counts[voice_actor_id] += 1 if is_main_character else -1
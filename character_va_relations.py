@@ -1,18 +1,65 @@
-from mal_base import get_user_anime_list, get_anime_character_list, AnimeListSortBy
-from mal_common import AnimeListType, AnimeStatus, MAL_CHARACTER_URL_PREFIX
-from time import sleep
-from collections import namedtuple
-from functools import reduce
-from os import system, path
+from mal_base import iter_user_anime_list, get_user_anime_list, get_anime_character_list, AnimeListSortBy
+from mal_pipeline import get_many_anime_character_lists
+from mal_common import AnimeListType, AnimeStatus, MAL_CHARACTER_URL_PREFIX, atomic_write, get_temporary_path
+from character_va_graph import CharacterVaGraph
+from mal_thumbnails import get_thumbnails, get_thumbnail_data_uri
+from mal_refresh import CacheRefresher
+from os import system, path, replace, listdir, remove, makedirs
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import quote
+import json
+from itertools import combinations
 
 VOICE_ACTOR_LANGUAGE = 'Japanese'
+BUILD_STATE_DIRECTORY = path.join(path.dirname(__file__), 'cache')
+BUILD_STATE_VERSION = 2
 CHARACTER_TYPE_SORT_ORDER = (AnimeStatus.Completed, AnimeStatus.Watching, AnimeStatus.OnHold, AnimeStatus.Dropped)
 
 TABLE_CHARACTER_ROW_FORMAT = '<tr><td><table><tr>{character_name_cells}</tr><tr>{character_image_cells}</tr></table></td></tr>'
 TABLE_CHARACTER_NAME_CELL_FORMAT = '<td><a href="{character_page_link}">{character_name}</a></td>'
-TABLE_CHARACTER_IMAGE_CELL_FORMAT = '<td><img src={character_image_link} title="{character_image_alt_text}"/></td>'
+TABLE_CHARACTER_IMAGE_CELL_FORMAT = '<td><img src="{character_image_link}" title="{character_image_alt_text}"/></td>'
 
-AnimeCharacter = namedtuple('AnimeCharacter', ['name', 'is_main_character', 'id', 'character_image_link', 'anime_status'])
+SHARED_VOICE_ACTORS_FILE_NAME = 'shared_voice_actors.json'
+REPORT_TEMPLATE_PATH = path.join(path.dirname(__file__), 'character_va_relationship_template.html')
+# Loads the next chunk of rows whenever the bottom of the table becomes visible
+REPORT_CHUNK_LOADER_SCRIPT_FORMAT = '''<div id="chunk_sentinel"></div>
+    <script>
+        const chunkCount = {chunk_count};
+        const mainTable = document.getElementById('main_table');
+        const sentinel = document.getElementById('chunk_sentinel');
+        let loadedChunks = 0;
+        let loading = false;
+
+        function appendReportRows(rows) {{
+            mainTable.insertAdjacentHTML('beforeend', rows.join(''));
+            loadedChunks++;
+            loading = false;
+            if (loadedChunks >= chunkCount) {{
+                observer.disconnect();
+            }} else {{
+                // Observing again reports the current state, so the next chunk is loaded if the table is still too short
+                observer.unobserve(sentinel);
+                observer.observe(sentinel);
+            }}
+        }}
+
+        const observer = new IntersectionObserver(function(entries) {{
+            if (!entries[0].isIntersecting || loading || loadedChunks >= chunkCount) {{
+                return;
+            }}
+            loading = true;
+            const script = document.createElement('script');
+            script.src = '{chunks_directory}/chunk_' + (loadedChunks + 1) + '.js';
+            document.body.appendChild(script);
+        }}, {{rootMargin: '1000px'}});
+        observer.observe(sentinel);
+    </script>'''
+
+class ReportImages:
+    Remote  = 'remote'  # Full size images from MAL, loaded when the report is opened
+    Local   = 'local'   # Relative links to the thumbnails in cache/thumbnails, see mal_thumbnails
+    Inline  = 'inline'  # Thumbnails embedded in the report, so it can be moved or shared as a single file
 
 
 def format_html_string_width(string: str, line_length: int) -> str:
@@ -31,108 +78,380 @@ def format_html_string_width(string: str, line_length: int) -> str:
     return result[:-1]
 
 
-def generate_va_relationships(mal_username: str, output_path: str, open_result_file=False) -> None:
-    print('Getting anime list')
-    user_anime_list = get_user_anime_list(mal_username, AnimeListType.AllAnime, -AnimeListSortBy.AirStartDate)
+class VaRelationsBuildState:
+    """
+    Everything that's needed to render the report of a user, persisted between
+    runs so that only anime that were added, removed or changed status since the
+    previous run have to be processed again.
+    """
+    def __init__(self, anime: dict = None, anime_order: list = None, graph: CharacterVaGraph = None, render_options: dict = None):
+        # {'ID of an anime': {'updated_at'}, ...}, the rest of the data about an anime is in the graph
+        self.anime = anime or {}
+
+        # IDs of the anime in the same order as in the user's list
+        self.anime_order = anime_order or []
+
+        self.graph = graph or CharacterVaGraph(VOICE_ACTOR_LANGUAGE, CHARACTER_TYPE_SORT_ORDER)
+
+        # Options the report was last rendered with (see get_render_options), None if it wasn't rendered yet
+        self.render_options = render_options
+
+    def needs_render(self, changed: bool, render_options: dict) -> bool:
+        return changed or render_options != self.render_options or not path.isfile(render_options['output_path'])
+
+    @classmethod
+    def load(cls, state_path: str) -> 'VaRelationsBuildState':
+        try:
+            with open(state_path, 'r', encoding='utf8') as state_file:
+                json_data = json.load(state_file)
+        except FileNotFoundError:
+            return cls()
+
+        # States written by older versions are rebuilt from scratch
+        if json_data.get('version') != BUILD_STATE_VERSION:
+            return cls()
+
+        return cls(
+            json_data['anime'],
+            json_data['anime_order'],
+            CharacterVaGraph.from_json(json_data['graph'], VOICE_ACTOR_LANGUAGE, CHARACTER_TYPE_SORT_ORDER),
+            json_data.get('render_options')
+        )
+
+    def save(self, state_path: str) -> None:
+        atomic_write(state_path, json.dumps({
+            'version'       : BUILD_STATE_VERSION,
+            'anime'         : self.anime,
+            'anime_order'   : self.anime_order,
+            'graph'         : self.graph.to_json(),
+            'render_options': self.render_options
+        }))
+
+    def get_missing_anime(self, user_anime_list) -> list:
+        """
+        Return the entries of the list whose characters aren't in the state yet.
+        """
+        return [anime for anime in user_anime_list if anime.status != AnimeStatus.PlanToWatch and str(anime.anime_id) not in self.anime]
+
+    def update(self, user_anime_list, get_characters=get_anime_character_list, print_progress=True) -> bool:
+        """
+        Apply the differences between the given list and the previous one.
+        Return whether anything that affects the report has changed.
+        'get_characters' returns the characters of an anime given its URL.
+        """
+        changed = False
+        anime_order = []
+
+        for anime in user_anime_list:
+            # Ignore anime that's marked as plan to watch
+            if anime.status == AnimeStatus.PlanToWatch:
+                continue
+
+            anime_id = str(anime.anime_id)
+            anime_order.append(anime_id)
+            updated_at = anime.updated_at.timestamp()
 
-    # {'ID of voice actor': [all the characters they voice], ...}
-    voice_actor_characters = {}
+            previous_anime = self.anime.get(anime_id)
+            if previous_anime is not None:
+                # Only the status of an anime is shown in the report, other changes (e.g. watched episodes) don't matter
+                if previous_anime['updated_at'] != updated_at:
+                    previous_anime['updated_at'] = updated_at
+                    graph_anime = self.graph.anime[anime_id]
+                    if graph_anime['status'] != anime.status:
+                        self.graph.set_anime_status(anime_id, anime.status)
+                        changed = True
+                    if graph_anime['title'] != anime.anime_title:
+                        self.graph.set_anime_title(anime_id, anime.anime_title)
+                        changed = True
+                continue
 
-    # {'ID of an anime character': [titles of animes that the character appears in], ...}
-    character_anime_appearances = {}
+            if print_progress:
+                print(anime.anime_title)
+            characters = get_characters(anime.anime_url)
+            if characters is None:
+                raise Exception(f'Failed to get the characters of "{anime.anime_title}", the IP may be suspended')
+
+            self.graph.add_anime(anime_id, anime.anime_title, anime.status, characters)
+            self.anime[anime_id] = {'updated_at': updated_at}
+            changed = True
+
+        # Forget anime that were removed from the list (or moved to plan to watch)
+        for anime_id in self.anime.keys() - set(anime_order):
+            del self.anime[anime_id]
+            self.graph.remove_anime(anime_id)
+            changed = True
+
+        if anime_order != self.anime_order:
+            self.anime_order = anime_order
+            changed = True
+
+        return changed
+
+
+def get_render_options(output_path: str, rows_per_chunk: int = None, images: str = ReportImages.Local) -> dict:
+    # Everything besides the build state that the rendered report depends on
+    return {'output_path': path.abspath(output_path), 'rows_per_chunk': rows_per_chunk, 'images': images}
+
+
+def generate_va_relationships(mal_username: str, output_path: str, open_result_file=False, full_rebuild=False, rows_per_chunk: int = None,
+                              images: str = ReportImages.Local) -> None:
+    state_path = path.join(BUILD_STATE_DIRECTORY, f'va_relations_{mal_username}.json')
+    build_state = VaRelationsBuildState() if full_rebuild else VaRelationsBuildState.load(state_path)
 
     print('Getting characters from all anime')
-    for anime in user_anime_list:
-        # Ignore anime that's marked as plan to watch
-        if anime.status == AnimeStatus.PlanToWatch:
-            continue
-
-        print(anime.anime_title)
-
-        characters = get_anime_character_list(anime.anime_url)
-
-        for current_character in characters:
-            if current_character.id not in character_anime_appearances:
-                character_anime_appearances.update({current_character.id: []})
-
-            # Some characters may appear several times in different anime, insert them only once
-            for voice_actor in current_character.voice_actors:
-                # Make sure to take characters only from the voice actor of the specified language
-                if voice_actor.language.lower() == VOICE_ACTOR_LANGUAGE.lower():
-                    # Create the list for this voice actor if it doesn't exist
-                    if voice_actor.id not in voice_actor_characters:
-                        voice_actor_characters.update({voice_actor.id : []})
-
-                    # Add this character only if it isn't already in the list (perhaps it was added from another anime)
-                    if not any([(current_character.id == character.id) for character in voice_actor_characters[voice_actor.id]]):
-                        voice_actor_characters[voice_actor.id].append(AnimeCharacter(
-                            name = current_character.name,
-                            is_main_character = current_character.is_main_character,
-                            id = current_character.id,
-                            character_image_link = current_character.image_link,
-                            anime_status = anime.status
-                        ))
-
-            character_anime_appearances[current_character.id].append(anime.anime_title)
-
-    # We don't care about the voice actors themselves, so we make a list of lists:
-    # [[characters voiced by voice actor 1], [characters voiced by voice actor 2], ...]
-    rows_data = list(voice_actor_characters.values())
-    del voice_actor_characters
-
-    # Sorting each row by the following priorities
-    # 1) Anime status priority order: Completed > Watching > On-hold > Dropped
-    # 2) Is main character
-    for characters in rows_data:
-        characters.sort(key=(lambda item : item.is_main_character), reverse=True)
-        characters.sort(key=(lambda item : CHARACTER_TYPE_SORT_ORDER.index(item.anime_status)))
-
-    # Sorting all rows by the following priorities
-    # 1) Number of characters
-    # 2) Number of main characters
-    rows_data.sort(key=(lambda item : reduce(lambda crnt_sum, crnt_item : crnt_sum + (1 if crnt_item.is_main_character else 0), item, 0)), reverse=True)
-    rows_data.sort(key=(lambda item : len(item)), reverse=True)
-
-    # Generating html table
-    rows_iterator = iter(rows_data)
-    html_rows = ''
+    # The list is downloaded page by page while the characters of the first entries are already being processed
+    changed = build_state.update(iter_user_anime_list(mal_username, AnimeListType.AllAnime, -AnimeListSortBy.AirStartDate))
+
+    # The state is saved after the report, so a report that failed to render is rendered again by the next run
+    render_options = get_render_options(output_path, rows_per_chunk, images)
+    if build_state.needs_render(changed, render_options):
+        render_va_relationships(build_state, output_path, rows_per_chunk, images)
+        build_state.render_options = render_options
+    else:
+        print('Nothing changed since the last run')
+    build_state.save(state_path)
+
+    if open_result_file:
+        system(f'start "" "{output_path}"')
+
+
+def generate_many_va_relationships(mal_usernames: list[str], output_directory: str, full_rebuild=False, rows_per_chunk: int = None,
+                                   images: str = ReportImages.Local) -> dict:
+    """
+    Generate the reports of several users ('<output_directory>/<username>.html') and a
+    JSON file of the voice actors that every two of them share. The characters of each
+    anime are fetched once for all the users, anime that more users need first, so the
+    cost depends on the number of different anime rather than on the sizes of the lists.
+    Return {username: VaRelationsBuildState}.
+    """
+    makedirs(output_directory, exist_ok=True)
+    build_states = {}
+    user_anime_lists = {}
+    for mal_username in mal_usernames:
+        state_path = path.join(BUILD_STATE_DIRECTORY, f'va_relations_{mal_username}.json')
+        build_states[mal_username] = VaRelationsBuildState() if full_rebuild else VaRelationsBuildState.load(state_path)
+        user_anime_lists[mal_username] = get_user_anime_list(mal_username, AnimeListType.AllAnime, -AnimeListSortBy.AirStartDate)
+
+    # {anime URL: number of users that need its characters}
+    user_counts = {}
+    for mal_username, build_state in build_states.items():
+        for anime in build_state.get_missing_anime(user_anime_lists[mal_username]):
+            user_counts[anime.anime_url] = user_counts.get(anime.anime_url, 0) + 1
+    anime_urls = sorted(user_counts, key=user_counts.__getitem__, reverse=True)
+
+    print(f'Getting the characters of {len(anime_urls)} anime for {len(mal_usernames)} users')
+    anime_characters = dict(zip(anime_urls, get_many_anime_character_lists(anime_urls))) if anime_urls else {}
+
+    for mal_username, build_state in build_states.items():
+        output_path = path.join(output_directory, f'{mal_username}.html')
+        changed = build_state.update(user_anime_lists[mal_username], anime_characters.__getitem__, print_progress=False)
+        render_options = get_render_options(output_path, rows_per_chunk, images)
+        if build_state.needs_render(changed, render_options):
+            render_va_relationships(build_state, output_path, rows_per_chunk, images)
+            build_state.render_options = render_options
+        build_state.save(path.join(BUILD_STATE_DIRECTORY, f'va_relations_{mal_username}.json'))
+
+    with open(path.join(output_directory, SHARED_VOICE_ACTORS_FILE_NAME), 'w', encoding='utf8') as shared_voice_actors_file:
+        json.dump([
+            {'users': [mal_username_a, mal_username_b], 'voice_actors': sorted(voice_actor_ids, key=int)}
+            for (mal_username_a, mal_username_b), voice_actor_ids in get_shared_voice_actors(build_states).items()
+        ], shared_voice_actors_file, indent=4)
+
+    return build_states
+
+
+def get_shared_voice_actors(build_states: dict) -> dict:
+    """
+    Return {(username, username): IDs of the voice actors that voice characters in both lists}
+    for every two of the given users ({username: VaRelationsBuildState}).
+    """
+    voice_actors = {mal_username: build_state.graph.voice_actor_characters.keys() for mal_username, build_state in build_states.items()}
+    return {
+        (mal_username_a, mal_username_b): voice_actors[mal_username_a] & voice_actors[mal_username_b]
+        for mal_username_a, mal_username_b in combinations(voice_actors, 2)
+    }
+
+
+class VaReportWriter:
+    """
+    Writes the report to a temporary file while rows are being generated, which
+    replaces the output file only when the writer exits without an exception
+    (so a failed build keeps the previous report). If 'rows_per_chunk' is given, only the first chunk of rows is written to the
+    report itself and the rest are written to numbered script files in
+    '<report name>_chunks/', which the report loads one by one as it's scrolled
+    (works for local files too, unlike fetch()).
+    """
+    def __init__(self, output_path: str, rows_per_chunk: int = None):
+        self.output_path = output_path
+        self.rows_per_chunk = rows_per_chunk
+        self.chunks_directory = path.splitext(output_path)[0] + '_chunks'
+
+        with open(REPORT_TEMPLATE_PATH, 'r', encoding='utf8') as template_file:
+            html_template = template_file.read()
+        self._template_head, html_template = html_template.split('{CONTENT_PLACEHOLDER}')
+        self._template_middle, self._template_tail = html_template.split('{SCRIPT_PLACEHOLDER}')
+
+        self._output_file = None
+        self._chunk_file = None
+        self._row_count = 0
+        self._chunk_count = 0
+        # (temporary path, final path) of every file written so far
+        self._written_paths = []
+
+    def __enter__(self) -> 'VaReportWriter':
+        self._output_file = self.__open_temporary(self.output_path)
+        self._output_file.write(self._template_head)
+        return self
+
+    def write_row(self, row_html: str) -> None:
+        if not self.rows_per_chunk or self._row_count < self.rows_per_chunk:
+            self._output_file.write(row_html)
+        else:
+            if (self._row_count % self.rows_per_chunk) == 0:
+                self.__start_chunk()
+            else:
+                self._chunk_file.write(',')
+            self._chunk_file.write(json.dumps(row_html))
+
+        self._row_count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        completed = False
+        try:
+            if exc_type is None:
+                self.__end_chunk()
+                self._output_file.write(self._template_middle)
+                if self._chunk_count:
+                    self._output_file.write(REPORT_CHUNK_LOADER_SCRIPT_FORMAT.format(
+                        chunks_directory = path.basename(self.chunks_directory),
+                        chunk_count = self._chunk_count
+                    ))
+                self._output_file.write(self._template_tail)
+                completed = True
+        finally:
+            for open_file in (self._chunk_file, self._output_file):
+                if open_file is not None:
+                    open_file.close()
+            self._chunk_file = None
+            if not completed:
+                self.__remove_temporary_files()
+        if not completed:
+            return
+
+        # Remove chunks of a previous report so that they're never loaded by mistake,
+        # also when the report isn't chunked anymore
+        new_chunk_paths = {final_path for _, final_path in self._written_paths}
+        if path.isdir(self.chunks_directory):
+            for file_name in listdir(self.chunks_directory):
+                chunk_path = path.join(self.chunks_directory, file_name)
+                if file_name.startswith('chunk_') and file_name.endswith('.js') and chunk_path not in new_chunk_paths:
+                    remove(chunk_path)
+
+        # The report itself is written last, it replaces the previous one only once all its chunks are in place
+        for temporary_path, final_path in self._written_paths[1:] + self._written_paths[:1]:
+            replace(temporary_path, final_path)
+
+    def __open_temporary(self, final_path: str):
+        temporary_path = get_temporary_path(final_path)
+        self._written_paths.append((temporary_path, final_path))
+        return open(temporary_path, 'w', encoding='utf8')
+
+    def __remove_temporary_files(self) -> None:
+        for temporary_path, _ in self._written_paths:
+            if path.exists(temporary_path):
+                remove(temporary_path)
+
+    def __start_chunk(self) -> None:
+        self.__end_chunk()
+        makedirs(self.chunks_directory, exist_ok=True)
+        self._chunk_count += 1
+        self._chunk_file = self.__open_temporary(path.join(self.chunks_directory, f'chunk_{self._chunk_count}.js'))
+        self._chunk_file.write('appendReportRows([')
+
+    def __end_chunk(self) -> None:
+        if self._chunk_file is not None:
+            self._chunk_file.write(']);')
+            self._chunk_file.close()
+            self._chunk_file = None
+
+
+def iter_report_rows(build_state: VaRelationsBuildState, image_sources: dict = None) -> Iterator[str]:
+    """
+    Yield the HTML of each row of the report, a row for each voice actor. Images
+    are linked to their 'image_sources' ({image link: src}), or to MAL if they have none.
+    """
+    image_sources = image_sources or {}
+    graph = build_state.graph
+
+    # Titles of the anime that a character appears in are listed in the same order as in the user's list
+    anime_positions = {anime_id: position for position, anime_id in enumerate(build_state.anime_order)}
 
     # Iterating over lists of characters with the same voice actor
-    for current_row in rows_data:
-        character_name_cells = ''
-        character_image_cells = ''
+    for current_row in graph.get_sorted_rows(build_state.anime_order):
+        character_name_cells = []
+        character_image_cells = []
 
         # Generating row content
-        for character in current_row:
-            character_name_cells += TABLE_CHARACTER_NAME_CELL_FORMAT.format(
-                character_page_link = MAL_CHARACTER_URL_PREFIX + character.id,
-                character_name = format_html_string_width(character.name, 10)
-            )
-            character_image_cells += TABLE_CHARACTER_IMAGE_CELL_FORMAT.format(
-                character_image_link = character.character_image_link,
-                character_image_alt_text = '\n'.join(character_anime_appearances[character.id])
-            )
-
-        # Formatting row
-        html_rows += TABLE_CHARACTER_ROW_FORMAT.format(
-            character_name_cells = character_name_cells,
-            character_image_cells = character_image_cells
+        for character_id in current_row:
+            character = graph.characters[character_id]
+            character_anime_ids = sorted(graph.character_anime[character_id], key=anime_positions.__getitem__)
+
+            character_name_cells.append(TABLE_CHARACTER_NAME_CELL_FORMAT.format(
+                character_page_link = MAL_CHARACTER_URL_PREFIX + character_id,
+                character_name = format_html_string_width(character['name'], 10)
+            ))
+            character_image_cells.append(TABLE_CHARACTER_IMAGE_CELL_FORMAT.format(
+                character_image_link = image_sources.get(character['image_link'], character['image_link']),
+                character_image_alt_text = '\n'.join(graph.anime[anime_id]['title'] for anime_id in character_anime_ids)
+            ))
+
+        yield TABLE_CHARACTER_ROW_FORMAT.format(
+            character_name_cells = ''.join(character_name_cells),
+            character_image_cells = ''.join(character_image_cells)
         )
 
-    # Writing result to file
-    with open('character_va_relationship_template.html') as template_file:
-        html_template = template_file.read()
 
-    with open(output_path, 'w', encoding='utf8') as output_file:
-        output_file.write(html_template.replace('{CONTENT_PLACEHOLDER}', html_rows))
+def get_report_image_sources(build_state: VaRelationsBuildState, output_path: str, images: str) -> dict:
+    """
+    Return {image link: src of its thumbnail in the report}, see ReportImages.
+    """
+    if images == ReportImages.Remote:
+        return {}
 
-    if open_result_file:
-        system(f'start "" "{output_path}"')
+    thumbnails = get_thumbnails(character['image_link'] for character in build_state.graph.characters.values())
+    thumbnails = {image_link: thumbnail_path for image_link, thumbnail_path in thumbnails.items() if thumbnail_path is not None}
+    if images == ReportImages.Inline:
+        # Characters with several voice actors are in several rows, each thumbnail is encoded once
+        data_uris = {thumbnail_path: get_thumbnail_data_uri(thumbnail_path) for thumbnail_path in set(thumbnails.values())}
+        return {image_link: data_uris[thumbnail_path] for image_link, thumbnail_path in thumbnails.items()}
+
+    report_directory = path.dirname(path.abspath(output_path))
+    image_sources = {}
+    for image_link, thumbnail_path in thumbnails.items():
+        try:
+            image_sources[image_link] = quote(Path(path.relpath(thumbnail_path, report_directory)).as_posix())
+        except ValueError:
+            # Different drives on Windows
+            image_sources[image_link] = Path(path.abspath(thumbnail_path)).as_uri()
+    return image_sources
+
+
+def render_va_relationships(build_state: VaRelationsBuildState, output_path: str, rows_per_chunk: int = None,
+                            images: str = ReportImages.Local) -> None:
+    image_sources = get_report_image_sources(build_state, output_path, images)
+    with VaReportWriter(output_path, rows_per_chunk) as report_writer:
+        for row_html in iter_report_rows(build_state, image_sources):
+            report_writer.write_row(row_html)
 
 
 if __name__ == '__main__':
-    mal_username = input('Enter your MAL username: ')
-    generate_va_relationships(
-        mal_username,
-        path.join(path.dirname(__file__), 'user lists', f'{mal_username}.html'),
-        True)
\ No newline at end of file
+    mal_usernames = input('Enter MAL usernames (separated by spaces): ').split()
+    # Characters that expired recently are used as they are and refreshed in the background
+    with CacheRefresher():
+        if len(mal_usernames) == 1:
+            generate_va_relationships(
+                mal_usernames[0],
+                path.join(path.dirname(__file__), 'user lists', f'{mal_usernames[0]}.html'),
+                True)
+        else:
+            generate_many_va_relationships(mal_usernames, path.join(path.dirname(__file__), 'user lists'))
\ No newline at end of file
@@ -0,0 +1,210 @@
+import asyncio
+from typing import AsyncIterator
+from mal_common import *
+from mal_http import get_html_async, is_suspension_error
+from mal_cache import MAL_CACHE
+from mal_base import get_user_anime_list_url, get_user_anime_list_page_url, decode_user_anime_list_page, USER_ANIME_LIST_PAGE_SIZE,\
+    get_anime_id_from_url, get_cached_anime_character_list, cache_anime_character_list, parse_anime_character_list, parse_character_voice_actors, parse_anime_details,\
+    cache_character_voice_actors, cache_anime_details
+from mal_search import ANIME_SEARCH_URL, get_search_cache_key, parse_search_results, cache_search_results
+from mal_title_index import MAL_TITLE_INDEX
+
+# Upper bound for the number of requests that are downloaded/parsed at the same time,
+# the rate limiter is what actually decides how fast requests are sent.
+MAX_CONCURRENT_REQUESTS = 16
+
+
+async def fetch_html(url: str, params: dict = None) -> str:
+    """
+    Wait for a slot from the shared rate limiter and download the page without
+    blocking the event loop, so DNS, TLS and the body download of one request
+    overlap with the waiting/parsing of the others.
+    """
+    return await get_html_async(url, params)
+
+
+async def parse_html(parser, response_html: str):
+    # Parsing is CPU bound, keep it off the event loop
+    return await asyncio.to_thread(parser, response_html)
+
+
+async def gather_limited(coroutines, max_concurrency: int = MAX_CONCURRENT_REQUESTS) -> list:
+    """
+    Like asyncio.gather but runs at most 'max_concurrency' coroutines at once.
+    Results are returned in the same order as the given coroutines.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+async def get_cached(kind: str, key) -> object:
+    return await asyncio.to_thread(MAL_CACHE.get, kind, key)
+
+
+async def put_cached(kind: str, key, value) -> None:
+    await asyncio.to_thread(MAL_CACHE.put, kind, key, value)
+
+
+async def get_user_anime_list(mal_user_name: str, list_type: int, main_sort_order=None, secondary_sort_order=None) -> list[AnimeListEntry]:
+    return [entry async for entry in iter_user_anime_list(mal_user_name, list_type, main_sort_order, secondary_sort_order)]
+
+
+async def iter_user_anime_list(mal_user_name: str, list_type: int, main_sort_order=None, secondary_sort_order=None) -> AsyncIterator[AnimeListEntry]:
+    """
+    Async version of mal_base.iter_user_anime_list, the next page is downloaded while the current one is consumed.
+    """
+    anime_list_link = get_user_anime_list_url(mal_user_name, list_type, main_sort_order, secondary_sort_order)
+    result = await get_cached(CacheKind.UserAnimeList, anime_list_link)
+    if result is not None:
+        for entry in result:
+            yield entry
+        return
+
+    async def get_page(offset: int) -> list[AnimeListEntry]:
+        response_json = await fetch_html(get_user_anime_list_page_url(mal_user_name, list_type, offset, main_sort_order, secondary_sort_order))
+        return await asyncio.to_thread(decode_user_anime_list_page, mal_user_name, response_json)
+
+    result = []
+    next_page = asyncio.create_task(get_page(0))
+    try:
+        while next_page is not None:
+            page = await next_page
+            next_page = None
+
+            # A full page means that there may be more entries
+            if len(page) == USER_ANIME_LIST_PAGE_SIZE:
+                next_page = asyncio.create_task(get_page(len(result) + len(page)))
+
+            for entry in page:
+                result.append(entry)
+                yield entry
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+    await put_cached(CacheKind.UserAnimeList, anime_list_link, result)
+    await asyncio.to_thread(MAL_TITLE_INDEX.add_list_entries, result)
+
+
+async def get_anime_character_list(anime_url: str) -> list[Character]:
+    result = await asyncio.to_thread(get_cached_anime_character_list, anime_url)
+    if result is not None:
+        return result
+
+    # Shares downloads in flight with other tasks and with the blocking scrapers in mal_base
+    return await MAL_SINGLE_FLIGHT.run_async(
+        (CacheKind.AnimeCharacters, get_anime_id_from_url(anime_url)), __download_anime_character_list, anime_url)
+
+
+async def __download_anime_character_list(anime_url: str) -> list[Character]:
+    result = await asyncio.to_thread(get_cached_anime_character_list, anime_url)
+    if result is not None:
+        return result
+
+    try:
+        response_html = await fetch_html(MAL_BASE_URL + anime_url + '/characters')
+    except Exception as e:
+        if not is_suspension_error(e):
+            raise
+        # The transport already reported the status to the rate limiter
+        return None
+
+    result = await parse_html(parse_anime_character_list, response_html)
+    if result is None:
+        await asyncio.to_thread(MAL_RATE_LIMITER.record_throttled)
+        return None
+
+    # Get the voice actors that aren't displayed in the characters page concurrently
+    missing_voice_actors = [character for character in result if len(character.voice_actors) == 0]
+    if missing_voice_actors:
+        voice_actors = await get_many_character_voice_actors(character.id for character in missing_voice_actors)
+        for character in missing_voice_actors:
+            character.voice_actors = voice_actors[character.id]
+
+    await asyncio.to_thread(cache_anime_character_list, anime_url, result)
+
+    return result
+
+
+async def get_character_voice_actors(character_id) -> list[VoiceActor]:
+    result = await get_cached(CacheKind.CharacterVoiceActors, character_id)
+    if result is not None:
+        return result
+
+    return await MAL_SINGLE_FLIGHT.run_async(
+        (CacheKind.CharacterVoiceActors, str(character_id)), __download_character_voice_actors, character_id)
+
+
+async def get_many_character_voice_actors(character_ids) -> dict:
+    """
+    Async version of mal_base.get_many_character_voice_actors.
+    """
+    character_ids = list(dict.fromkeys(character_ids))
+    result = await asyncio.to_thread(MAL_CACHE.get_known_character_voice_actors, character_ids)
+    missing_character_ids = [character_id for character_id in character_ids if character_id not in result]
+    result.update(zip(missing_character_ids, await asyncio.gather(*map(get_character_voice_actors, missing_character_ids))))
+    return result
+
+
+async def __download_character_voice_actors(character_id) -> list[VoiceActor]:
+    result = await get_cached(CacheKind.CharacterVoiceActors, character_id)
+    if result is not None:
+        return result
+
+    result = await parse_html(parse_character_voice_actors, await fetch_html(MAL_CHARACTER_URL_PREFIX + str(character_id)))
+    await asyncio.to_thread(cache_character_voice_actors, character_id, result)
+    return result
+
+
+async def get_anime_details(anime_id) -> AnimeDetails:
+    result = await get_cached(CacheKind.AnimeDetails, anime_id)
+    if result is not None:
+        return result
+
+    return await MAL_SINGLE_FLIGHT.run_async((CacheKind.AnimeDetails, str(anime_id)), __download_anime_details, anime_id)
+
+
+async def __download_anime_details(anime_id) -> AnimeDetails:
+    result = await get_cached(CacheKind.AnimeDetails, anime_id)
+    if result is not None:
+        return result
+
+    result = await parse_html(parse_anime_details, await fetch_html(MAL_ANIME_URL_PREFIX + str(anime_id)))
+    await asyncio.to_thread(cache_anime_details, anime_id, result)
+    return result
+
+
+async def search_anime(query: str) -> list[SearchResult]:
+    result = await get_cached(CacheKind.SearchResults, get_search_cache_key(query))
+    if result is not None:
+        return result
+
+    return await MAL_SINGLE_FLIGHT.run_async((CacheKind.SearchResults, get_search_cache_key(query)), __download_search_results, query)
+
+
+async def __download_search_results(query: str) -> list[SearchResult]:
+    result = await get_cached(CacheKind.SearchResults, get_search_cache_key(query))
+    if result is not None:
+        return result
+
+    result = await parse_html(parse_search_results, await fetch_html(ANIME_SEARCH_URL, params={'q': query}))
+    await asyncio.to_thread(cache_search_results, query, result)
+    return result
+
+
+async def get_many_anime_character_lists(anime_urls: list[str], max_concurrency: int = MAX_CONCURRENT_REQUESTS) -> list[list[Character]]:
+    return await gather_limited((get_anime_character_list(anime_url) for anime_url in anime_urls), max_concurrency)
+
+
+async def get_many_anime_details(anime_ids: list, max_concurrency: int = MAX_CONCURRENT_REQUESTS) -> list[AnimeDetails]:
+    return await gather_limited((get_anime_details(anime_id) for anime_id in anime_ids), max_concurrency)
+
+
+if __name__ == '__main__':
+    for details in asyncio.run(get_many_anime_details([1, 5, 6])):
+        print(details)
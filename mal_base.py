@@ -1,77 +1,206 @@
 import re
 import json
-import requests
 from bs4 import BeautifulSoup
 from mal_common import *
-from time import ctime
+from mal_http import get_html, iter_html, is_suspension_error
+from mal_cache import MAL_CACHE
+from mal_stats import Endpoint, timed_parser
+from mal_title_index import MAL_TITLE_INDEX
+import mal_lxml
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime, timedelta
 from os.path import dirname, join
+from typing import Iterator
 
 
 CACHE_DIRECTORY = join(dirname(__file__), 'cache')
+# Number of entries returned by each request to the list's load.json endpoint
+USER_ANIME_LIST_PAGE_SIZE = 300
+# Character pages that are downloaded/parsed at the same time when the voice actors of several
+# characters are missing from a characters page, the rate limiter still spaces out the requests
+MAX_CONCURRENT_VOICE_ACTOR_REQUESTS = 4
 
 
 # Get a list of entries according to the list type
 # see AnimeListType for possible 'list_type' values
-def get_user_anime_list(mal_user_name: str, list_type: int, main_sort_order=None, secondary_sort_order=None) -> list[EntryContainer]:
+def get_user_anime_list(mal_user_name: str, list_type: int, main_sort_order=None, secondary_sort_order=None) -> list[AnimeListEntry]:
+    return list(iter_user_anime_list(mal_user_name, list_type, main_sort_order, secondary_sort_order))
+
+
+def iter_user_anime_list(mal_user_name: str, list_type: int, main_sort_order=None, secondary_sort_order=None) -> Iterator[AnimeListEntry]:
+    """
+    Yield all the entries of the list, page by page. The next page is downloaded
+    in the background while the caller processes the entries of the current one.
+    """
+    anime_list_link = get_user_anime_list_url(mal_user_name, list_type, main_sort_order, secondary_sort_order)
+    result = MAL_CACHE.get(CacheKind.UserAnimeList, anime_list_link)
+    if result is not None:
+        yield from result
+        return
+
+    result = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_user_anime_list_page, mal_user_name, list_type, 0, main_sort_order, secondary_sort_order)
+        while next_page is not None:
+            page = next_page.result()
+            next_page = None
+
+            # A full page means that there may be more entries
+            if len(page) == USER_ANIME_LIST_PAGE_SIZE:
+                next_page = executor.submit(
+                    get_user_anime_list_page, mal_user_name, list_type, len(result) + len(page), main_sort_order, secondary_sort_order)
+
+            for entry in page:
+                result.append(entry)
+                yield entry
+
+    MAL_CACHE.put(CacheKind.UserAnimeList, anime_list_link, result)
+    MAL_TITLE_INDEX.add_list_entries(result)
+
+
+def get_user_anime_list_page(mal_user_name: str, list_type: int, offset: int, main_sort_order=None, secondary_sort_order=None) -> list[AnimeListEntry]:
+    """
+    Return up to USER_ANIME_LIST_PAGE_SIZE entries of the list, starting from 'offset'.
+    """
+    return decode_user_anime_list_page(
+        mal_user_name, get_html(get_user_anime_list_page_url(mal_user_name, list_type, offset, main_sort_order, secondary_sort_order)))
+
+
+def get_user_anime_list_url(mal_user_name: str, list_type: int, main_sort_order=None, secondary_sort_order=None) -> str:
     # Generate MAL link from args
     anime_list_link = MAL_BASE_URL + f'/animelist/{mal_user_name}?status={list_type}'
+    return anime_list_link + __get_sort_order_parameters(main_sort_order, secondary_sort_order)
+
+
+def get_user_anime_list_page_url(mal_user_name: str, list_type: int, offset: int, main_sort_order=None, secondary_sort_order=None) -> str:
+    anime_list_link = MAL_BASE_URL + f'/animelist/{mal_user_name}/load.json?offset={offset}&status={list_type}'
+    return anime_list_link + __get_sort_order_parameters(main_sort_order, secondary_sort_order)
+
+
+@timed_parser(Endpoint.List)
+def decode_user_anime_list_page(mal_user_name: str, response_json: str) -> list[AnimeListEntry]:
+    json_data = json.loads(response_json)
+
+    # Private lists and unknown users return an error object instead of a list of entries
+    if not isinstance(json_data, list):
+        raise Exception(f'Failed to load the anime list of "{mal_user_name}": {json_data}')
+
+    return decode_anime_list_entries(json_data)
+
+
+def __get_sort_order_parameters(main_sort_order, secondary_sort_order) -> str:
+    parameters = ''
     if main_sort_order is not None:
-        anime_list_link += f'&order={main_sort_order}'
+        parameters += f'&order={main_sort_order}'
     if secondary_sort_order is not None:
-        anime_list_link += f'&order2={secondary_sort_order}'
+        parameters += f'&order2={secondary_sort_order}'
+    return parameters
 
-    # Get HTML data of the anime list page
-    with mal_request():
-        response_html = requests.get(anime_list_link).content.decode()
+
+@timed_parser(Endpoint.List)
+def parse_user_anime_list(response_html: str) -> list[AnimeListEntry]:
+    if get_parser_backend() == ParserBackend.Lxml:
+        return mal_lxml.parse_user_anime_list(response_html)
 
     # Parse html and extract table data
     soup = BeautifulSoup(response_html, features='lxml')
     json_data = json.loads(soup.select('#list-container > div.list-block > div > table')[0]['data-items'])
 
-    # Reinterpret some fields as pythonic types for easier use
-    result = []
-    for json_entry in json_data:
-        # Date fields
-        for field_name in ('anime_start_date_string', 'anime_end_date_string'):
-            if json_entry[field_name] is not None:
-                json_entry[field_name] = datetime.strptime(json_entry[field_name], AIR_DATE_FORMAT)
+    return decode_anime_list_entries(json_data)
 
-        # Named entry lists
-        for field_name in ('genres', 'demographics'):
-            json_entry[field_name] = [entry['name'] for entry in json_entry[field_name]]
 
-        # ctime entries
-        for field_name in ('created_at', 'updated_at'):
-            json_entry[field_name] = datetime.strptime(ctime(json_entry[field_name]), '%c')
+def get_anime_character_list(anime_url: str) -> list[Character]:
+    """
+    Return the characters of the given anime, or None if the
+    page couldn't be parsed (usually means that the IP was suspended).
+    """
+    result = get_cached_anime_character_list(anime_url)
+    if result is not None:
+        return result
+
+    # Callers that ask for the same anime at the same time share a single download
+    return MAL_SINGLE_FLIGHT.run(
+        (CacheKind.AnimeCharacters, get_anime_id_from_url(anime_url)), __download_anime_character_list, anime_url)
+
+
+def refresh_anime_character_list(anime_url: str) -> list[Character]:
+    """
+    Download the characters of the anime again even if they're cached, see mal_refresh.
+    """
+    return MAL_SINGLE_FLIGHT.run(
+        (CacheKind.AnimeCharacters, get_anime_id_from_url(anime_url)), __download_anime_character_list, anime_url, False)
+
 
-        # Misc
-        json_entry['tags'] = json_entry['tags'].split(', ')
-        json_entry['is_rewatching'] = bool(json_entry['is_rewatching'])
+def __download_anime_character_list(anime_url: str, use_cache: bool = True) -> list[Character]:
+    # The previous download may have completed since the cache was checked
+    result = get_cached_anime_character_list(anime_url) if use_cache else None
+    if result is not None:
+        return result
+
+    # Get HTML data of the characters list page
+    try:
+        response_html = get_html(MAL_BASE_URL + anime_url + '/characters')
+    except Exception as e:
+        if not is_suspension_error(e):
+            raise
+        # The transport already reported the status to the rate limiter
+        return None
+
+    result = parse_anime_character_list(response_html)
+    if result is None:
+        MAL_RATE_LIMITER.record_throttled()
+        return None
 
-        result.append(EntryContainer(json_entry))
+    # Some MAL pages may not display the voice actors of a character, if that's the case then
+    # we need to explicitly get the voice actors from that characters' page
+    missing_voice_actors = [character for character in result if len(character.voice_actors) == 0]
+    if missing_voice_actors:
+        voice_actors = get_many_character_voice_actors(character.id for character in missing_voice_actors)
+        for character in missing_voice_actors:
+            character.voice_actors = voice_actors[character.id]
+
+    cache_anime_character_list(anime_url, result)
 
     return result
 
 
-def get_anime_character_list(anime_url: str) -> list[EntryContainer]:
+def get_cached_anime_character_list(anime_url: str) -> list[Character]:
     """
-    Return (request_sent: bool, character_list: list)
-    request_sent is True when a request is sent to myanimelist.com
-    and False when the cache was used.
+    Return the cached characters of the given anime, or None if the
+    cache is empty or expired.
     """
-    result = __get_characters_list_from_cache(anime_url)
-    if result:
-        # Make sure that the cache isn't empty or expired
-        if (datetime.today() - datetime.strptime(result[0], CACHE_TIME_FORMAT)).days <= CACHE_LIFETIME_IN_DAYS:
-            result  = [EntryContainer(entry) for entry in result[1]]
-            for entry in result:
-                entry.voice_actors = [EntryContainer(va) for va in entry.voice_actors]
-            return result
+    anime_id = get_anime_id_from_url(anime_url)
+    result = MAL_CACHE.get(CacheKind.AnimeCharacters, anime_id)
+    if result is not None:
+        return result
+
+    # Import entries from the old cache format (one JSON file per anime) the first time they're needed
+    legacy_result = __get_characters_list_from_legacy_cache(anime_url)
+    if legacy_result:
+        written_at = datetime.strptime(legacy_result[0], CACHE_TIME_FORMAT).timestamp()
+        result = [Character(entry) for entry in legacy_result[1]]
+        for entry in result:
+            entry.voice_actors = [VoiceActor(va) for va in entry.voice_actors]
+        MAL_CACHE.put(CacheKind.AnimeCharacters, anime_id, result, written_at)
+        return MAL_CACHE.get(CacheKind.AnimeCharacters, anime_id)
+
+    return None
+
+
+def cache_anime_character_list(anime_url: str, characters: list[Character]) -> None:
+    MAL_CACHE.put(CacheKind.AnimeCharacters, get_anime_id_from_url(anime_url), characters)
+
+
+@timed_parser(Endpoint.Characters)
+def parse_anime_character_list(response_html: str) -> list[Character]:
+    """
+    Parse a '/characters' page. Characters whose voice actors aren't displayed
+    on the page are returned with an empty 'voice_actors' list.
+    """
+    if get_parser_backend() == ParserBackend.Lxml:
+        return mal_lxml.parse_anime_character_list(response_html)
 
-    # Get HTML data of the characters list page
-    with mal_request():
-        response_html = requests.get(MAL_BASE_URL + anime_url + '/characters').content.decode()
     soup = BeautifulSoup(response_html, features='lxml')
 
     # If the page doesn't contain the expected content, assume that the IP was suspended
@@ -94,7 +223,7 @@ def get_anime_character_list(anime_url: str) -> list[EntryContainer]:
             # Parse each voice actor for this character
             for voice_actor in voice_actors_data:
                 name, language = voice_actor.select('div')
-                character_voice_actors.append(EntryContainer({
+                character_voice_actors.append(VoiceActor({
                     'name'     : name.a.contents[0].strip(),
                     'language' : language.contents[0].strip(),
                     'id'        : __get_person_id_from_url(name.a['href'].strip())
@@ -116,12 +245,7 @@ def get_anime_character_list(anime_url: str) -> list[EntryContainer]:
         character_image_links = character_row.select('td:nth-of-type(1) > div > a > img')[0]['data-srcset'].split(', ')
         larges_character_image_link = max(character_image_links, key=(lambda item : item.split(' ')[1])).split(' ')[0]
 
-        # Some MAL pages may not display the voice actors of a character, if that's the case then
-        # we need to explicitly get the voice actors from that characters' page
-        if len(character_voice_actors) == 0:
-            character_voice_actors = get_character_voice_actors(character_id)
-
-        result.append(EntryContainer({
+        result.append(Character({
             'name'              : character_name,
             'is_main_character' : character_is_main_role,
             'id'                : character_id,
@@ -129,14 +253,58 @@ def get_anime_character_list(anime_url: str) -> list[EntryContainer]:
             'voice_actors'      : character_voice_actors
         }))
 
-    __write_characters_list_to_cache(result, anime_url)
+    return result
+
+
+def get_character_voice_actors(character_id) -> list[VoiceActor]:
+    result = MAL_CACHE.get(CacheKind.CharacterVoiceActors, character_id)
+    if result is not None:
+        return result
+
+    return MAL_SINGLE_FLIGHT.run((CacheKind.CharacterVoiceActors, str(character_id)), __download_character_voice_actors, character_id)
+
+
+def refresh_character_voice_actors(character_id) -> list[VoiceActor]:
+    return MAL_SINGLE_FLIGHT.run(
+        (CacheKind.CharacterVoiceActors, str(character_id)), __download_character_voice_actors, character_id, False)
+
+
+def __download_character_voice_actors(character_id, use_cache: bool = True) -> list[VoiceActor]:
+    result = MAL_CACHE.get(CacheKind.CharacterVoiceActors, character_id) if use_cache else None
+    if result is not None:
+        return result
+
+    result = parse_character_voice_actors(get_html(MAL_CHARACTER_URL_PREFIX + str(character_id)))
+    cache_character_voice_actors(character_id, result)
 
     return result
 
 
-def get_character_voice_actors(character_id) -> list[EntryContainer]:
-    with mal_request():
-        response_html = requests.get(MAL_CHARACTER_URL_PREFIX + str(character_id)).content.decode()
+def cache_character_voice_actors(character_id, voice_actors: list[VoiceActor]) -> None:
+    MAL_CACHE.put(CacheKind.CharacterVoiceActors, character_id, voice_actors)
+
+
+def get_many_character_voice_actors(character_ids) -> dict:
+    """
+    Return {character_id: voice actors}. Each character is looked up once, characters
+    that already appear with their voice actors in the characters list of another cached
+    anime (e.g. a prequel) are taken from there, and the pages of the rest are downloaded
+    together, so parsing one page overlaps with waiting for the next request slot.
+    """
+    character_ids = list(dict.fromkeys(character_ids))
+    result = MAL_CACHE.get_known_character_voice_actors(character_ids)
+    missing_character_ids = [character_id for character_id in character_ids if character_id not in result]
+    if missing_character_ids:
+        with ThreadPoolExecutor(max_workers=min(len(missing_character_ids), MAX_CONCURRENT_VOICE_ACTOR_REQUESTS)) as executor:
+            result.update(zip(missing_character_ids, executor.map(get_character_voice_actors, missing_character_ids)))
+    return result
+
+
+@timed_parser(Endpoint.Character)
+def parse_character_voice_actors(response_html: str) -> list[VoiceActor]:
+    if get_parser_backend() == ParserBackend.Lxml:
+        return mal_lxml.parse_character_voice_actors(response_html)
+
     soup = BeautifulSoup(response_html, features='lxml')
 
     voice_actors = []
@@ -144,23 +312,91 @@ def get_character_voice_actors(character_id) -> list[EntryContainer]:
     voice_actors_data = soup.select('#content > table:nth-of-type(1) > tr:nth-of-type(1) > td:nth-of-type(2) > table > tr > td:nth-of-type(2)')
 
     for voice_actor_data in voice_actors_data:
-        voice_actors.append(EntryContainer({
-            'name'     : voice_actor_data.a.contents[0],
-            'language' : voice_actor_data.div.small.contents[0],
+        voice_actors.append(VoiceActor({
+            'name'     : str(voice_actor_data.a.contents[0]),
+            'language' : str(voice_actor_data.div.small.contents[0]),
             'id'       : __get_person_id_from_url(voice_actor_data.a['href'])
         }))
 
     return voice_actors
 
 
-ANIME_DURATION_REGEX = re.compile(r'^(?:(\d+) hr\.)? ?(?:(\d+) min\.)? ?(?:(\d+) sec\.)?')
-def get_anime_details(anime_id) -> EntryContainer:
-    with mal_request():
-        response_html = requests.get(MAL_ANIME_URL_PREFIX + str(anime_id)).content.decode()
+def get_anime_details(anime_id, fields=None) -> AnimeDetails:
+    """
+    'fields' limits the result to some AnimeDetails fields, e.g. ('episodes', 'duration'):
+    the page is downloaded only up to the last of them. Such partial details aren't
+    cached, but when the complete details are cached they're returned as they are.
+    """
+    # Validated first, so unknown fields raise whether or not the details are cached
+    if fields is not None:
+        fields = get_anime_details_fields(fields)
+
+    result = MAL_CACHE.get(CacheKind.AnimeDetails, anime_id)
+    if result is not None:
+        return result
+
+    if fields is not None:
+        return MAL_SINGLE_FLIGHT.run((CacheKind.AnimeDetails, str(anime_id), fields), __stream_anime_details, anime_id, fields)
+    return MAL_SINGLE_FLIGHT.run((CacheKind.AnimeDetails, str(anime_id)), __download_anime_details, anime_id)
+
+
+def refresh_anime_details(anime_id) -> AnimeDetails:
+    return MAL_SINGLE_FLIGHT.run((CacheKind.AnimeDetails, str(anime_id)), __download_anime_details, anime_id, False)
+
+
+def __download_anime_details(anime_id, use_cache: bool = True) -> AnimeDetails:
+    result = MAL_CACHE.get(CacheKind.AnimeDetails, anime_id) if use_cache else None
+    if result is not None:
+        return result
+
+    result = __stream_anime_details(anime_id)
+    cache_anime_details(anime_id, result)
+
+    return result
+
+
+def cache_anime_details(anime_id, details: AnimeDetails) -> None:
+    """
+    Cache the details and index their titles. Error responses raise before anything is cached,
+    but a page without the information sidebar (e.g. a suspension page served as 200) isn't worth caching either.
+    """
+    if is_empty_anime_details(details):
+        return
+    MAL_CACHE.put(CacheKind.AnimeDetails, anime_id, details)
+    MAL_TITLE_INDEX.add_anime_details(anime_id, details)
+
+
+def is_empty_anime_details(details: AnimeDetails) -> bool:
+    return all(value is None for value in details.to_dict().values())
+
+
+def __stream_anime_details(anime_id, fields: frozenset = None) -> AnimeDetails:
+    # Everything after the information sidebar (reviews, recommendations, ...) is never downloaded
+    with closing(iter_html(MAL_ANIME_URL_PREFIX + str(anime_id))) as html_chunks:
+        return parse_anime_details_stream(html_chunks, fields)
+
+
+def get_anime_details_fields(fields) -> frozenset:
+    fields = frozenset(fields)
+    unknown_fields = fields - frozenset(AnimeDetails.FIELDS)
+    if unknown_fields:
+        raise ValueError(f'Unknown anime details fields: {", ".join(sorted(unknown_fields))}')
+    return fields
+
+
+@timed_parser(Endpoint.Details)
+def parse_anime_details(response_html: str) -> AnimeDetails:
+    if get_parser_backend() == ParserBackend.Lxml:
+        return mal_lxml.parse_anime_details(response_html)
+
     soup = BeautifulSoup(response_html, features='lxml')
 
-    attributes = soup.select('div.spaceit_pad')
     attr_dict = {}
+    title_element = soup.select_one('h1.title-name')
+    if title_element is not None:
+        attr_dict['title'] = title_element.get_text().strip()
+
+    attributes = soup.select('div.spaceit_pad')
     for attr in attributes:
         attr_span = attr.select('div > span')
         attr_a = attr.select('div > a')
@@ -170,13 +406,13 @@ def get_anime_details(anime_id) -> EntryContainer:
         # Categorize types of attributes
         if attr_a:
             # Link group category
-            attr_value = [a.contents[0] for a in attr_a]
+            attr_value = [str(a.contents[0]) for a in attr_a]
             if attr_name == 'type':
                 attr_value = attr_value[0]
 
         elif len(attr_span) > 1:
             # Span value category
-            attr_value = attr_span[1].contents[0]
+            attr_value = str(attr_span[1].contents[0])
 
         else:
             # Direct sibling value category
@@ -203,10 +439,28 @@ def get_anime_details(anime_id) -> EntryContainer:
         if attr_name == 'favorites':
             break
 
-    return EntryContainer(attr_dict)
+    return AnimeDetails(attr_dict)
+
 
+# Not timed like the other parsers, most of the time is spent waiting for the download
+def parse_anime_details_stream(html_chunks, fields=None) -> AnimeDetails:
+    """
+    Parse the details of an anime from the chunks of its page (see iter_html in mal_http)
+    and stop reading chunks once every field in 'fields' (all fields by default) was found.
+    """
+    if fields is not None:
+        fields = get_anime_details_fields(fields)
+    if get_parser_backend() == ParserBackend.Lxml:
+        return mal_lxml.parse_anime_details_stream(html_chunks, fields)
+
+    # BeautifulSoup can't parse a page incrementally
+    result = parse_anime_details(b''.join(html_chunks).decode())
+    if fields is None:
+        return result
+    return AnimeDetails({field: result[field] for field in fields if result[field] is not None})
 
-def __get_anime_id_from_url(anime_url: str) -> str:
+
+def get_anime_id_from_url(anime_url: str) -> str:
     parts = anime_url.split('/')
     return parts[parts.index('anime') + 1]
 
@@ -221,19 +475,14 @@ def __get_person_id_from_url(person_url: str) -> str:
     return parts[parts.index('people') + 1]
 
 
-def __get_characters_list_from_cache(anime_url: str) -> list:
+def __get_characters_list_from_legacy_cache(anime_url: str) -> list:
     try:
-        with open(join(CACHE_DIRECTORY, __get_anime_id_from_url(anime_url) + '.json'), 'r', encoding='utf8') as cache_file:
+        with open(join(CACHE_DIRECTORY, get_anime_id_from_url(anime_url) + '.json'), 'r', encoding='utf8') as cache_file:
             return json.load(cache_file)
     except FileNotFoundError:
         return None
 
 
-def __write_characters_list_to_cache(characters_list: list, anime_url: str) -> None:
-    with open(join(CACHE_DIRECTORY, __get_anime_id_from_url(anime_url) + '.json'), 'w', encoding='utf8') as cache_file:
-        json.dump((datetime.today().strftime(CACHE_TIME_FORMAT), characters_list), cache_file)
-
-
 def main():
     print(get_anime_details(17843))
 
@@ -0,0 +1,343 @@
+import json
+import platform
+import re
+import sys
+from argparse import ArgumentParser
+from contextlib import contextmanager, redirect_stdout
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import StringIO
+from os import listdir
+from os.path import dirname, join
+from statistics import mean, median
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+from urllib.parse import urlparse, parse_qs
+from requests.adapters import HTTPAdapter
+from mal_common import *
+from mal_cache import MalCache, MAL_CACHE
+from mal_http import get_session
+from mal_title_index import TitleIndex
+import mal_base
+import mal_search
+import mal_pipeline
+import character_va_relations
+
+# Offline benchmarks of the hot paths, run against the pages in fixtures/ and a local
+# stand-in for myanimelist.net. Results are written as JSON and can be compared to a
+# previous run with --baseline to catch regressions.
+
+DEFAULT_REPEATS = 5
+DEFAULT_TOLERANCE = 0.25 # A benchmark regressed if it's 25% slower than the baseline
+CACHE_BENCHMARK_ENTRY_COUNT = 200
+BENCHMARK_USER_NAME = 'benchmark_user'
+TITLE_INDEX_QUERY_COUNT = 100
+FETCH_PARSE_ANIME_COUNT = 40
+# Close to the time BeautifulSoup takes to parse a details page, so fetching and parsing take about as long
+FETCH_PARSE_REQUEST_INTERVAL = 0.05 # seconds
+
+FIXTURES_DIRECTORY = join(dirname(__file__), 'fixtures')
+# Which parser each fixture file is meant for, by file name prefix
+FIXTURE_PARSERS = {
+    'anime_list'            : 'parse_user_anime_list',
+    'anime_characters'      : 'parse_anime_character_list',
+    'character'             : 'parse_character_voice_actors',
+    'anime_details'         : 'parse_anime_details',
+    'search_results'        : 'parse_search_results',
+}
+
+
+def get_fixture_parser_name(fixture_file_name: str) -> str:
+    for prefix in FIXTURE_PARSERS:
+        if fixture_file_name.startswith(prefix):
+            return FIXTURE_PARSERS[prefix]
+    return None
+
+
+def read_fixture(fixture_file_name: str) -> str:
+    with open(join(FIXTURES_DIRECTORY, fixture_file_name), 'r', encoding='utf8') as fixture_file:
+        return fixture_file.read()
+
+
+def measure(name: str, function, repeats: int, setup=None, **labels) -> dict:
+    """
+    Call 'function' 'repeats' times ('setup' is called before each call and isn't timed)
+    and return the timings in seconds.
+    """
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+
+    return dict(name=name, **labels, repeats=repeats, min=min(timings), median=median(timings), mean=mean(timings))
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves fixture pages in place of myanimelist.net.
+    """
+    ROUTES = (
+        (re.compile(r'^/animelist/[^/]+/load\.json$'), None),
+        (re.compile(r'^/anime/\d+/[^/]+/characters$'), 'anime_characters.html'),
+        (re.compile(r'^/character/\d+'), 'character.html'),
+        (re.compile(r'^/anime/\d+'), 'anime_details.html'),
+        (re.compile(r'^/anime\.php$'), 'search_results.html'),
+    )
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        for route, fixture_file_name in self.ROUTES:
+            if route.match(url.path):
+                break
+        else:
+            self.send_error(404)
+            return
+
+        if fixture_file_name is None:
+            # Only the first page of the list has entries
+            offset = int(parse_qs(url.query).get('offset', ['0'])[0])
+            body = read_fixture('anime_list_page.json') if offset == 0 else '[]'
+        else:
+            body = read_fixture(fixture_file_name)
+
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class StandInAdapter(HTTPAdapter):
+    """
+    Redirects every request to MAL to the stand-in server.
+    """
+    def __init__(self, stand_in_url: str):
+        super().__init__()
+        self.stand_in_url = stand_in_url
+
+    def send(self, request, **kwargs):
+        request.url = self.stand_in_url + request.url[len(MAL_BASE_URL):]
+        return super().send(request, **kwargs)
+
+
+@contextmanager
+def stand_in_server():
+    """
+    Run the stand-in server and send every request to MAL to it until the context exits.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInRequestHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    session = get_session()
+    previous_adapter = session.adapters.get(MAL_BASE_URL)
+    session.mount(MAL_BASE_URL, StandInAdapter(f'http://127.0.0.1:{server.server_port}'))
+    try:
+        yield server
+    finally:
+        stand_in_adapter = session.adapters.pop(MAL_BASE_URL)
+        stand_in_adapter.close()
+        if previous_adapter is not None:
+            session.mount(MAL_BASE_URL, previous_adapter)
+        server.shutdown()
+        server.server_close()
+
+
+def benchmark_parsers(repeats: int) -> list[dict]:
+    parsers_module = {name: mal_base for name in FIXTURE_PARSERS.values()}
+    parsers_module['parse_search_results'] = mal_search
+
+    results = []
+    previous_backend = get_parser_backend()
+    try:
+        for fixture_file_name in sorted(listdir(FIXTURES_DIRECTORY)):
+            parser_name = get_fixture_parser_name(fixture_file_name)
+            if parser_name is None or not fixture_file_name.endswith('.html'):
+                continue
+
+            response_html = read_fixture(fixture_file_name)
+            parser = getattr(parsers_module[parser_name], parser_name)
+            for parser_backend in (ParserBackend.BeautifulSoup, ParserBackend.Lxml):
+                set_parser_backend(parser_backend)
+                results.append(measure(
+                    f'{parser_name}[{fixture_file_name}]', lambda: parser(response_html), repeats, backend=parser_backend))
+    finally:
+        set_parser_backend(previous_backend)
+
+    response_json = read_fixture('anime_list_page.json')
+    results.append(measure(
+        'decode_user_anime_list_page[anime_list_page.json]',
+        lambda: mal_base.decode_user_anime_list_page(BENCHMARK_USER_NAME, response_json), repeats))
+
+    return results
+
+
+def benchmark_cache(repeats: int, temporary_directory: str) -> list[dict]:
+    characters = mal_base.parse_anime_character_list(read_fixture('anime_characters.html'))
+    cache = MalCache(join(temporary_directory, 'benchmark_cache.sqlite3'))
+
+    def write():
+        for anime_id in range(CACHE_BENCHMARK_ENTRY_COUNT):
+            cache.put(CacheKind.AnimeCharacters, anime_id, characters)
+
+    def read():
+        for anime_id in range(CACHE_BENCHMARK_ENTRY_COUNT):
+            cache.get(CacheKind.AnimeCharacters, anime_id)
+
+    return [
+        measure('cache_write', write, repeats, entries=CACHE_BENCHMARK_ENTRY_COUNT),
+        measure('cache_read_database', read, repeats, setup=cache.clear_memory, entries=CACHE_BENCHMARK_ENTRY_COUNT),
+        measure('cache_read_memory', read, repeats, entries=CACHE_BENCHMARK_ENTRY_COUNT),
+    ]
+
+
+def benchmark_title_index(repeats: int, temporary_directory: str) -> list[dict]:
+    MAL_CACHE.set_database_path(join(temporary_directory, 'title_index_cache.sqlite3'))
+    entries = mal_base.decode_user_anime_list_page(BENCHMARK_USER_NAME, read_fixture('anime_list_page.json'))
+    title_index = TitleIndex()
+    title_index.add_list_entries(entries)
+
+    # Misspelled titles, every query has to be scored against similar titles
+    queries = [entry.anime_title.lower()[:-1] + 'x' for entry in entries[:TITLE_INDEX_QUERY_COUNT]]
+
+    def search():
+        for query in queries:
+            title_index.search(query)
+
+    return [measure('title_index_search', search, repeats, queries=len(queries), titles=len(title_index))]
+
+
+def benchmark_pipeline(repeats: int, temporary_directory: str) -> list[dict]:
+    # Expects the stand-in server
+    output_path = join(temporary_directory, 'report.html')
+    run_count = 0
+
+    def use_new_cache():
+        nonlocal run_count
+        run_count += 1
+        MAL_CACHE.set_database_path(join(temporary_directory, f'pipeline_cache_{run_count}.sqlite3'))
+
+    def generate(full_rebuild: bool):
+        with redirect_stdout(StringIO()):
+            character_va_relations.generate_va_relationships(
+                BENCHMARK_USER_NAME, output_path, full_rebuild=full_rebuild, images=character_va_relations.ReportImages.Remote)
+
+    def expire_user_anime_list():
+        MAL_CACHE.delete(CacheKind.UserAnimeList, mal_base.get_user_anime_list_url(
+            BENCHMARK_USER_NAME, AnimeListType.AllAnime, -AnimeListSortBy.AirStartDate))
+
+    previous_interval = MAL_RATE_LIMITER.interval
+    previous_build_state_directory = character_va_relations.BUILD_STATE_DIRECTORY
+    MAL_RATE_LIMITER.interval = 0
+    character_va_relations.BUILD_STATE_DIRECTORY = temporary_directory
+    try:
+        return [
+            measure('generate_va_relationships_cold', lambda: generate(True), repeats, setup=use_new_cache),
+            measure('generate_va_relationships_warm_cache', lambda: generate(True), repeats, setup=expire_user_anime_list),
+            measure('generate_va_relationships_incremental', lambda: generate(False), repeats, setup=expire_user_anime_list),
+        ]
+    finally:
+        MAL_RATE_LIMITER.interval = previous_interval
+        character_va_relations.BUILD_STATE_DIRECTORY = previous_build_state_directory
+
+
+def benchmark_fetch_parse(repeats: int, temporary_directory: str) -> list[dict]:
+    # Expects the stand-in server
+    anime_ids = list(range(1, FETCH_PARSE_ANIME_COUNT + 1))
+    run_count = 0
+
+    def use_new_cache():
+        nonlocal run_count
+        run_count += 1
+        MAL_CACHE.set_database_path(join(temporary_directory, f'fetch_parse_cache_{run_count}.sqlite3'))
+
+    previous_backend = get_parser_backend()
+    previous_interval = MAL_RATE_LIMITER.interval
+    set_parser_backend(ParserBackend.BeautifulSoup)
+    MAL_RATE_LIMITER.interval = FETCH_PARSE_REQUEST_INTERVAL
+    try:
+        return [
+            measure('get_anime_details_serial', lambda: [mal_base.get_anime_details(anime_id) for anime_id in anime_ids],
+                    repeats, setup=use_new_cache, anime=len(anime_ids), backend=ParserBackend.BeautifulSoup),
+            measure('get_many_anime_details_pipelined', lambda: mal_pipeline.get_many_anime_details(anime_ids),
+                    repeats, setup=use_new_cache, anime=len(anime_ids), backend=ParserBackend.BeautifulSoup),
+        ]
+    finally:
+        set_parser_backend(previous_backend)
+        MAL_RATE_LIMITER.interval = previous_interval
+
+
+def run_benchmarks(repeats: int = DEFAULT_REPEATS) -> dict:
+    previous_database_path = MAL_CACHE.database_path
+    previous_state_path = MAL_RATE_LIMITER.state_path
+    with TemporaryDirectory() as temporary_directory:
+        try:
+            # The benchmarks change the request interval, which mustn't affect other processes on the host
+            MAL_RATE_LIMITER.set_state_path(join(temporary_directory, 'rate_limiter.sqlite3'))
+            results = benchmark_parsers(repeats)
+            results += benchmark_cache(repeats, temporary_directory)
+            results += benchmark_title_index(repeats, temporary_directory)
+            with stand_in_server():
+                results += benchmark_pipeline(repeats, temporary_directory)
+                results += benchmark_fetch_parse(repeats, temporary_directory)
+        finally:
+            # Back to the real cache and rate limiter before the temporary directory is deleted
+            MAL_CACHE.set_database_path(previous_database_path)
+            MAL_RATE_LIMITER.set_state_path(previous_state_path)
+
+    return {
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'results'   : results
+    }
+
+
+def get_result_key(result: dict) -> tuple:
+    return result['name'], result.get('backend')
+
+
+def find_regressions(report: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    """
+    Return a description of every benchmark that is slower than in the baseline by more than 'tolerance'.
+    """
+    baseline_results = {get_result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        baseline_result = baseline_results.get(get_result_key(result))
+        if baseline_result is not None and result['min'] > baseline_result['min'] * (1 + tolerance):
+            regressions.append(
+                f'{result["name"]} ({result.get("backend", "-")}): {baseline_result["min"]:.6f}s -> {result["min"]:.6f}s')
+    return regressions
+
+
+def main():
+    argument_parser = ArgumentParser(description='Run the offline benchmarks')
+    argument_parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    argument_parser.add_argument('--output', help='Write the results to this JSON file instead of stdout')
+    argument_parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    argument_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    arguments = argument_parser.parse_args()
+
+    report = run_benchmarks(arguments.repeats)
+
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf8') as output_file:
+            json.dump(report, output_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if arguments.baseline:
+        with open(arguments.baseline, 'r', encoding='utf8') as baseline_file:
+            regressions = find_regressions(report, json.load(baseline_file), arguments.tolerance)
+        for regression in regressions:
+            print('Regression:', regression, file=sys.stderr)
+        if regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+import json
+import os
+import random
+import sqlite3
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from os.path import dirname, join
+from threading import Lock, local
+from time import time
+from mal_common import EntryContainer, Record, CacheKind, CACHE_TTL_IN_DAYS, CACHE_STALE_IN_DAYS, DATABASE_BUSY_TIMEOUT
+from mal_stats import MAL_STATS
+
+CACHE_DATABASE_PATH = join(dirname(__file__), 'cache', 'mal_cache.sqlite3')
+MEMORY_CACHE_SIZE = 4096 # entries
+# Every entry lives between 90% and 110% of the TTL of its kind, so entries that were
+# written together (e.g. by a single report run) don't all expire on the same day
+TTL_JITTER = 0.1
+SECONDS_PER_DAY = 24 * 60 * 60
+
+DATABASE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    kind        TEXT NOT NULL,
+    key         TEXT NOT NULL,
+    value       TEXT NOT NULL,
+    written_at  REAL NOT NULL,
+    expires_at  REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+
+-- Which character is voiced by which person in which anime, filled from AnimeCharacters entries
+CREATE TABLE IF NOT EXISTS character_roles (
+    anime_id        TEXT NOT NULL,
+    character_id    TEXT NOT NULL,
+    person_id       TEXT NOT NULL,
+    PRIMARY KEY (anime_id, character_id, person_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS character_roles_by_character ON character_roles (character_id);
+CREATE INDEX IF NOT EXISTS character_roles_by_person ON character_roles (person_id);
+
+-- Every title and synonym of an anime that was seen while scraping, see mal_title_index
+CREATE TABLE IF NOT EXISTS anime_titles (
+    title       TEXT NOT NULL,
+    anime_id    TEXT NOT NULL,
+    PRIMARY KEY (title, anime_id)
+) WITHOUT ROWID;
+'''
+
+
+def encode_json_value(value, tagged: bool = True) -> object:
+    """
+    'default' of json.dumps() for the types that the scrapers return. Tagged values
+    are decoded back to the same types by loads(), untagged ones are plain JSON
+    (datetimes as ISO strings, timedeltas as seconds) for other programs to read.
+    """
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()} if tagged else value.isoformat()
+    if isinstance(value, timedelta):
+        return {'__timedelta__': value.total_seconds()} if tagged else value.total_seconds()
+    if isinstance(value, Record):
+        return dict(value.to_dict(), __record__=type(value).__name__) if tagged else value.to_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def __decode_value(obj: dict) -> object:
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__timedelta__' in obj:
+        return timedelta(seconds=obj['__timedelta__'])
+    if '__record__' in obj:
+        return Record.TYPES[obj.pop('__record__')](obj)
+    # Entries that were cached before the record types existed
+    return EntryContainer(obj)
+
+
+def dumps(value) -> str:
+    return json.dumps(value, default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+
+def loads(data: str) -> object:
+    return json.loads(data, object_hook=__decode_value)
+
+
+class MalCache:
+    """
+    Two tier cache for everything that is scraped from MAL: a bounded in-process
+    LRU in front of a SQLite database in WAL mode. Writes are single transactions,
+    so several processes can share the same database file.
+
+    Values are stored as JSON (datetimes, timedeltas and records included) and
+    records are decoded as the same record types. Values returned from the memory tier are shared
+    between callers, so copy them before modifying.
+
+    While 'serve_stale' is set (see mal_refresh.CacheRefresher), entries that expired less
+    than CACHE_STALE_IN_DAYS ago are still returned by get() and queued to be refreshed.
+    """
+    def __init__(self, database_path: str = CACHE_DATABASE_PATH, memory_size: int = MEMORY_CACHE_SIZE, ttl_in_days: dict = None,
+                 stale_in_days: dict = None):
+        self.database_path = database_path
+        self.memory_size = memory_size
+        self.ttl_in_days = dict(CACHE_TTL_IN_DAYS)
+        if ttl_in_days:
+            self.ttl_in_days.update(ttl_in_days)
+        self.stale_in_days = dict(CACHE_STALE_IN_DAYS)
+        if stale_in_days:
+            self.stale_in_days.update(stale_in_days)
+        self.serve_stale = False
+
+        # {(kind, key): number of lookups that found the entry}, in this process. Only entries
+        # in the memory tier are counted, so it's bounded by 'memory_size' like the memory tier.
+        self._read_counts = Counter()
+        # {(kind, key): None} of the stale entries that were served, oldest first
+        self._stale_keys = OrderedDict()
+
+        # {(kind, key): (value, written_at, expires_at)}
+        self._memory = OrderedDict()
+        self._memory_lock = Lock()
+        self._thread_local = local()
+        # Incremented whenever the database changes, so threads know to reopen their connection
+        self._database_generation = 0
+
+    def set_database_path(self, database_path: str) -> None:
+        self.database_path = database_path
+        self._database_generation += 1
+        self.clear_memory()
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, nor with a process forked
+        # after the parent used them (crawler workers, the pipeline's parse processes)
+        connection = getattr(self._thread_local, 'connection', None)
+        if connection is None or self._thread_local.generation != self._database_generation or self._thread_local.pid != os.getpid():
+            # A connection inherited from the parent is dropped without closing it, that would touch the parent's locks
+            if connection is not None and self._thread_local.pid == os.getpid():
+                connection.close()
+            connection = sqlite3.connect(self.database_path, timeout=DATABASE_BUSY_TIMEOUT)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(DATABASE_SCHEMA)
+            self._thread_local.connection = connection
+            self._thread_local.generation = self._database_generation
+            self._thread_local.pid = os.getpid()
+        return connection
+
+    def get(self, kind: str, key) -> object:
+        """
+        Return the cached value, or None if it's missing or expired.
+        """
+        entry = self.get_entry(kind, key)
+        if entry is None:
+            return None
+
+        now = time()
+        if entry[2] < now:
+            if self.serve_stale and now < entry[2] + self.stale_in_days.get(kind, 0) * SECONDS_PER_DAY:
+                MAL_STATS.increment('mal_cache_stale_served_total', kind=kind)
+                with self._memory_lock:
+                    self._stale_keys[(kind, str(key))] = None
+                return entry[0]
+            MAL_STATS.increment('mal_cache_stale_total', kind=kind)
+            return None
+        return entry[0]
+
+    def get_entry(self, kind: str, key) -> tuple:
+        """
+        Return (value, written_at, expires_at) even if the entry is expired, or None if it's missing.
+        """
+        return self.__get_entry(kind, key, True)
+
+    def __get_entry(self, kind: str, key, is_read: bool) -> tuple:
+        # Lookups that aren't reads (e.g. deduplication probes) aren't counted in the read counts nor the stats
+        memory_key = (kind, str(key))
+        with self._memory_lock:
+            entry = self._memory.get(memory_key)
+            if entry is not None:
+                self._memory.move_to_end(memory_key)
+                if is_read:
+                    self._read_counts[memory_key] += 1
+                    MAL_STATS.increment('mal_cache_lookups_total', kind=kind, tier='memory')
+                return entry
+
+        row = self._connection.execute(
+            'SELECT value, written_at, expires_at FROM entries WHERE kind = ? AND key = ?', memory_key
+        ).fetchone()
+        if row is None:
+            if is_read:
+                MAL_STATS.increment('mal_cache_lookups_total', kind=kind, tier='miss')
+            return None
+
+        if is_read:
+            MAL_STATS.increment('mal_cache_lookups_total', kind=kind, tier='database')
+        entry = (loads(row[0]), row[1], row[2])
+        self.__remember(memory_key, entry, is_read)
+        return entry
+
+    def __peek(self, kind: str, key) -> object:
+        """
+        Return the value that get() would return, without counting the lookup as a read.
+        Stale entries are returned but not queued to be refreshed.
+        """
+        entry = self.__get_entry(kind, key, False)
+        if entry is None:
+            return None
+        stale_seconds = self.stale_in_days.get(kind, 0) * SECONDS_PER_DAY if self.serve_stale else 0
+        return entry[0] if time() <= entry[2] + stale_seconds else None
+
+    def put(self, kind: str, key, value, written_at: float = None) -> None:
+        written_at = time() if written_at is None else written_at
+        expires_at = written_at + self.ttl_in_days[kind] * SECONDS_PER_DAY * random.uniform(1 - TTL_JITTER, 1 + TTL_JITTER)
+        key = str(key)
+
+        connection = self._connection
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO entries (kind, key, value, written_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (kind, key, dumps(value), written_at, expires_at)
+            )
+            if kind == CacheKind.AnimeCharacters:
+                connection.execute('DELETE FROM character_roles WHERE anime_id = ?', (key,))
+                connection.executemany(
+                    'INSERT OR IGNORE INTO character_roles (anime_id, character_id, person_id) VALUES (?, ?, ?)',
+                    ((key, str(character.id), str(voice_actor.id)) for character in value for voice_actor in character.voice_actors)
+                )
+
+        MAL_STATS.increment('mal_cache_writes_total', kind=kind)
+        self.__remember((kind, key), (value, written_at, expires_at))
+        with self._memory_lock:
+            self._stale_keys.pop((kind, key), None)
+
+    def delete(self, kind: str, key) -> None:
+        key = str(key)
+        connection = self._connection
+        with connection:
+            connection.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, key))
+            if kind == CacheKind.AnimeCharacters:
+                connection.execute('DELETE FROM character_roles WHERE anime_id = ?', (key,))
+
+        with self._memory_lock:
+            self._memory.pop((kind, key), None)
+            self._read_counts.pop((kind, key), None)
+
+    def pop_stale_keys(self) -> list[tuple[str, str]]:
+        """
+        Return the (kind, key) of the stale entries that were served since the last call, oldest first.
+        """
+        with self._memory_lock:
+            stale_keys = list(self._stale_keys)
+            self._stale_keys.clear()
+        return stale_keys
+
+    def get_expiring_keys(self, kind: str, until: float, limit: int) -> list[tuple[str, float]]:
+        """
+        Return up to 'limit' (key, expires_at) of entries of the kind that expire before 'until'
+        and can still be served stale, the ones closest to expiring first.
+        """
+        return self._connection.execute(
+            'SELECT key, expires_at FROM entries WHERE kind = ? AND expires_at BETWEEN ? AND ? ORDER BY expires_at LIMIT ?',
+            (kind, time() - self.stale_in_days.get(kind, 0) * SECONDS_PER_DAY, until, limit)
+        ).fetchall()
+
+    def get_read_count(self, kind: str, key) -> int:
+        with self._memory_lock:
+            return self._read_counts[(kind, str(key))]
+
+    def get_character_anime_ids(self, character_id) -> list[str]:
+        return [row[0] for row in self._connection.execute(
+            'SELECT DISTINCT anime_id FROM character_roles WHERE character_id = ?', (str(character_id),))]
+
+    def get_known_character_voice_actors(self, character_ids) -> dict:
+        """
+        Return {character_id: voice actors} of the given characters that have voice actors
+        in a cached characters list of any anime or in a cached character page. These probes
+        don't count as reads of the entries (see get_read_count) nor as cache lookups.
+        """
+        result = {}
+        for character_id in character_ids:
+            voice_actors = self.__peek(CacheKind.CharacterVoiceActors, character_id)
+            if voice_actors is None:
+                voice_actors = self.__get_voice_actors_from_character_lists(str(character_id))
+            if voice_actors is not None:
+                result[character_id] = voice_actors
+        return result
+
+    def __get_voice_actors_from_character_lists(self, character_id: str) -> list:
+        for anime_id in self.get_character_anime_ids(character_id):
+            characters = self.__peek(CacheKind.AnimeCharacters, anime_id)
+            for character in characters or ():
+                if str(character.id) == character_id and character.voice_actors:
+                    return list(character.voice_actors)
+        return None
+
+    def get_person_character_ids(self, person_id) -> list[str]:
+        return [row[0] for row in self._connection.execute(
+            'SELECT DISTINCT character_id FROM character_roles WHERE person_id = ?', (str(person_id),))]
+
+    def put_anime_titles(self, anime_titles) -> None:
+        """
+        Remember (anime_id, title) pairs, titles never expire.
+        """
+        connection = self._connection
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO anime_titles (title, anime_id) VALUES (?, ?)',
+                ((title, str(anime_id)) for anime_id, title in anime_titles)
+            )
+
+    def get_anime_titles(self) -> list[tuple[str, str]]:
+        return self._connection.execute('SELECT anime_id, title FROM anime_titles').fetchall()
+
+    def purge_expired(self) -> int:
+        """
+        Delete expired entries from the database, return the number of deleted entries.
+        """
+        connection = self._connection
+        with connection:
+            return connection.execute('DELETE FROM entries WHERE expires_at < ?', (time(),)).rowcount
+
+    def clear_memory(self) -> None:
+        with self._memory_lock:
+            self._memory.clear()
+            self._read_counts.clear()
+
+    def __remember(self, memory_key: tuple, entry: tuple, is_read: bool = False) -> None:
+        with self._memory_lock:
+            self._memory[memory_key] = entry
+            self._memory.move_to_end(memory_key)
+            if is_read:
+                self._read_counts[memory_key] += 1
+            while len(self._memory) > self.memory_size:
+                evicted_key, _ = self._memory.popitem(last=False)
+                self._read_counts.pop(evicted_key, None)
+
+
+MAL_CACHE = MalCache()
@@ -1,6 +1,14 @@
+import os
+import re
+import sqlite3
+from concurrent.futures import Future, CancelledError
 from contextlib import contextmanager
 from datetime import datetime
-from time import sleep
+from os.path import dirname, join
+from threading import Lock, get_ident
+from time import sleep, monotonic, ctime, time
+from mal_stats import MAL_STATS
+import asyncio
 
 MAL_BASE_URL = 'https://myanimelist.net'
 MAL_ANIME_URL_PREFIX = MAL_BASE_URL + '/anime/'
@@ -9,8 +17,12 @@ CACHE_LIFETIME_IN_DAYS = 100
 CACHE_TIME_FORMAT = '%d/%m/%Y'
 AIR_DATE_FORMAT = '%d-%m-%y'
 MAL_REQUEST_INTERVAL = 3 # seconds
-
-__LAST_MAL_REQUEST_TIME = datetime.min
+# Bounds of the adaptive request interval, see SharedRateLimiter
+MIN_MAL_REQUEST_INTERVAL = 1 # seconds
+MAX_MAL_REQUEST_INTERVAL = 60 # seconds
+# How long SQLite connections wait for another connection's write lock (cache, crawl queue)
+DATABASE_BUSY_TIMEOUT = 30 # seconds
+ANIME_DURATION_REGEX = re.compile(r'^(?:(\d+) hr\.)? ?(?:(\d+) min\.)? ?(?:(\d+) sec\.)?')
 
 
 class EntryContainer(dict):
@@ -22,24 +34,505 @@ class EntryContainer(dict):
         return EntryContainer(super().copy())
 
 
-@contextmanager
-def mal_request():
+class Record:
+    """
+    Base of the compact record types that are returned by the scrapers. Fields are
+    stored in __slots__ instead of a dict per object, which takes a fraction of the
+    memory of an EntryContainer and makes attribute access a plain slot read.
+
+    Like EntryContainer, records can be read as attributes or as items and fields
+    that a record doesn't have read as None. Fields that aren't declared by the
+    record type (e.g. new fields that MAL added to its pages) are kept in
+    'extra_fields' so nothing is lost.
+    """
+    __slots__ = ('extra_fields',)
+
+    # {'name of a record type': record type}, used to decode cached records
+    TYPES = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELDS = cls.__slots__
+        cls._field_names = frozenset(cls.__slots__)
+        Record.TYPES[cls.__name__] = cls
+
+    def __init__(self, fields: dict = None, **kwargs):
+        if fields is not None:
+            kwargs = dict(fields, **kwargs) if kwargs else fields
+        for name in self.FIELDS:
+            setattr(self, name, kwargs.get(name))
+        if kwargs.keys() <= self._field_names:
+            self.extra_fields = None
+        else:
+            self.extra_fields = {name: value for name, value in kwargs.items() if name not in self._field_names}
+
+    def __getattr__(self, name: str):
+        # Only called for names that aren't fields of the record (or before 'extra_fields' is set while unpickling)
+        if name.startswith('__') or name == 'extra_fields':
+            raise AttributeError(name)
+        return self.extra_fields.get(name) if self.extra_fields else None
+
+    def __getitem__(self, name: str):
+        if name in self._field_names:
+            return getattr(self, name)
+        if self.extra_fields and name in self.extra_fields:
+            return self.extra_fields[name]
+        raise KeyError(name)
+
+    def __setitem__(self, name: str, value) -> None:
+        if name in self._field_names:
+            setattr(self, name, value)
+        else:
+            if self.extra_fields is None:
+                self.extra_fields = {}
+            self.extra_fields[name] = value
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._field_names or bool(self.extra_fields and name in self.extra_fields)
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    def get(self, name: str, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self) -> list[str]:
+        return list(self.FIELDS) + list(self.extra_fields or ())
+
+    def to_dict(self) -> dict:
+        """
+        Return the fields as a new dict, records in fields are not converted.
+        """
+        result = {name: getattr(self, name) for name in self.FIELDS}
+        if self.extra_fields:
+            result.update(self.extra_fields)
+        return result
+
+    def copy(self) -> 'Record':
+        return type(self)(self.to_dict())
+
+
+class AnimeListEntry(Record):
+    __slots__ = (
+        'status', 'score', 'tags', 'is_rewatching', 'num_watched_episodes', 'created_at', 'updated_at',
+        'anime_title', 'anime_title_eng', 'anime_num_episodes', 'anime_airing_status', 'anime_id', 'anime_studios',
+        'anime_licensors', 'anime_season', 'anime_total_members', 'anime_total_scores', 'anime_score_val',
+        'anime_score_diff', 'anime_popularity', 'has_episode_video', 'has_promotion_video', 'has_video',
+        'video_url', 'genres', 'demographics', 'title_localized', 'anime_url', 'anime_image_path',
+        'is_added_to_list', 'anime_media_type_string', 'anime_mpaa_rating_string', 'start_date_string',
+        'finish_date_string', 'anime_start_date_string', 'anime_end_date_string', 'days_string',
+        'storage_string', 'priority_string', 'notes', 'editable_notes'
+    )
+
+
+class Character(Record):
+    __slots__ = ('name', 'is_main_character', 'id', 'image_link', 'voice_actors')
+
+
+class VoiceActor(Record):
+    __slots__ = ('name', 'language', 'id')
+
+
+# Fields of the information sidebar of an anime's page, named after their labels (see parse_anime_details)
+class AnimeDetails(Record):
+    __slots__ = (
+        'title', 'synonyms', 'japanese', 'english', 'german', 'spanish', 'french', 'type', 'episodes', 'status', 'aired',
+        'premiered', 'broadcast', 'producers', 'licensors', 'studios', 'source', 'genres', 'genre', 'themes',
+        'theme', 'demographic', 'duration', 'rating', 'score', 'ranked', 'popularity', 'members', 'favorites'
+    )
+
+
+class SearchResult(Record):
+    __slots__ = ('title', 'id', 'type', 'num_episodes', 'score', 'start_date', 'end_date', 'num_users', 'rating')
+
+
+def decode_anime_list_entries(json_data: list[dict]) -> list[AnimeListEntry]:
     """
-    This context manager makes sure that there are at least MAL_REQUEST_INTERVAL
-    seconds between each request to avoid getting the IP suspended for request
-    flooding. Each request to MyAnimeList website should be made in a different
-    instance of this context manager.
+    Convert the raw entries of an anime list ('data-items' of the list page)
+    to AnimeListEntry records and reinterpret some fields as pythonic types for easier use.
     """
-    global __LAST_MAL_REQUEST_TIME
+    result = []
+    for json_entry in json_data:
+        # Date fields
+        for field_name in ('anime_start_date_string', 'anime_end_date_string'):
+            if json_entry[field_name] is not None:
+                json_entry[field_name] = datetime.strptime(json_entry[field_name], AIR_DATE_FORMAT)
+
+        # Named entry lists
+        for field_name in ('genres', 'demographics'):
+            json_entry[field_name] = [entry['name'] for entry in json_entry[field_name]]
+
+        # ctime entries
+        for field_name in ('created_at', 'updated_at'):
+            json_entry[field_name] = datetime.strptime(ctime(json_entry[field_name]), '%c')
+
+        # Misc
+        json_entry['tags'] = json_entry['tags'].split(', ')
+        json_entry['is_rewatching'] = bool(json_entry['is_rewatching'])
+
+        result.append(AnimeListEntry(json_entry))
+
+    return result
+
 
-    time_delta = datetime.now() - __LAST_MAL_REQUEST_TIME
-    if time_delta.total_seconds() < MAL_REQUEST_INTERVAL:
-        sleep(MAL_REQUEST_INTERVAL - time_delta.total_seconds())
+def get_temporary_path(path: str) -> str:
+    # Unique per process and thread so that concurrent writers of the same file never share a temporary file
+    return f'{path}.{os.getpid()}.{get_ident()}.tmp'
 
+
+def atomic_write(path: str, data, mode: str = 'w') -> None:
+    """
+    Write data ('str' for mode 'w', 'bytes' for mode 'wb') to path
+    through a temporary file, so that a crash never leaves a half written file.
+    """
+    temporary_path = get_temporary_path(path)
     try:
-        yield
-    finally:
-        __LAST_MAL_REQUEST_TIME = datetime.now()
+        with open(temporary_path, mode, encoding=None if 'b' in mode else 'utf8') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+@contextmanager
+def immediate_transaction(connection: sqlite3.Connection):
+    """
+    Run the block in a write transaction of 'connection' (opened with isolation_level=None).
+    BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write of several
+    processes never interleaves.
+    """
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+class RateLimiter:
+    """
+    Token bucket that hands out request slots to every request sent to MyAnimeList,
+    both from blocking code and from asyncio tasks. Slots are reserved under a lock,
+    so concurrent callers are queued one interval apart instead of all waking up at
+    the same time. With burst=1 this guarantees at least 'interval' seconds between
+    the start of any two requests.
+    """
+    def __init__(self, interval: float, burst: int = 1):
+        self.interval = interval
+        self.burst = burst
+        self._lock = Lock()
+        # Theoretical arrival time of the next request (monotonic clock)
+        self._next_slot = 0.0
+
+    def reserve(self) -> float:
+        """
+        Reserve the next free slot and return how many seconds the caller has to
+        wait before sending its request.
+        """
+        with self._lock:
+            now = monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+            return max(0.0, slot - (self.burst - 1) * self.interval - now)
+
+    def is_idle(self) -> bool:
+        """
+        Whether a request sent now wouldn't delay any request that already has a slot.
+        """
+        with self._lock:
+            return self._next_slot <= monotonic()
+
+    def acquire(self) -> float:
+        """
+        Wait for the next free slot, return the number of seconds waited.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
+        return delay
+
+    async def acquire_async(self) -> float:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def record_response(self, seconds: float, status_code: int, throttled_status_codes: tuple = None) -> None:
+        """
+        Called by mal_http after every response, see SharedRateLimiter.
+        'throttled_status_codes' are the statuses that mean that requests are sent
+        too fast, THROTTLED_STATUS_CODES by default.
+        """
+        pass
+
+    def record_throttled(self) -> None:
+        """
+        Called when a page came back without its content, which usually means that the IP was suspended.
+        """
+        pass
+
+
+RATE_LIMITER_STATE_PATH = join(dirname(__file__), 'cache', 'rate_limiter.sqlite3')
+RATE_LIMITER_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rate_limiter (
+    id                  INTEGER PRIMARY KEY CHECK (id = 0),
+    next_slot           REAL NOT NULL,
+    interval            REAL NOT NULL,
+    last_slowdown_at    REAL NOT NULL
+);
+'''
+# Responses that mean that requests are sent too fast
+THROTTLED_STATUS_CODES = (403, 429)
+# The v2 API answers 403 to authentication and permission errors, only 429 means flooding there
+API_THROTTLED_STATUS_CODES = (429,)
+# Responses that take longer than this mean that MAL is struggling
+SLOW_RESPONSE_SECONDS = 10
+# Additive increase: every successful response increases the request rate by this much (requests per second)
+RATE_INCREASE = 0.002
+# Multiplicative decrease: the interval is multiplied by this when requests are throttled
+INTERVAL_BACKOFF_FACTOR = 2
+# Requests that were already in flight when the first one was throttled don't slow down the rate again
+SLOWDOWN_COOLDOWN = 30 # seconds
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    Rate limiter whose slots are shared by every process on the host that uses the
+    same state file (a small SQLite database), so several scripts running at the same
+    time stay within a single budget instead of each using all of it.
+
+    The interval adapts to how MAL responds (AIMD): each successful response raises the
+    request rate a little, down to 'min_interval', and a 429/403, a response slower than
+    SLOW_RESPONSE_SECONDS or a suspended page multiply the interval by INTERVAL_BACKOFF_FACTOR,
+    up to 'max_interval'. Setting 'interval' directly sets it for every process.
+    """
+    def __init__(self, interval: float, min_interval: float, max_interval: float, state_path: str = RATE_LIMITER_STATE_PATH, burst: int = 1):
+        super().__init__(interval, burst)
+        self.initial_interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.state_path = state_path
+        self._connection = None
+        # The connection of the parent process can't be used after a fork
+        self._connection_key = None
+
+    @property
+    def interval(self) -> float:
+        if getattr(self, 'state_path', None) is None:
+            return self.initial_interval
+        with self.__transaction() as connection:
+            return connection.execute('SELECT interval FROM rate_limiter').fetchone()[0]
+
+    @interval.setter
+    def interval(self, interval: float) -> None:
+        # Called by RateLimiter.__init__ before the state file is known
+        if getattr(self, 'state_path', None) is None:
+            return
+        with self.__transaction() as connection:
+            connection.execute('UPDATE rate_limiter SET interval = ?', (interval,))
+
+    def set_state_path(self, state_path: str) -> None:
+        with self._lock:
+            self.state_path = state_path
+            self._connection_key = None
+
+    def reserve(self) -> float:
+        with self.__transaction() as connection:
+            next_slot, interval = connection.execute('SELECT next_slot, interval FROM rate_limiter').fetchone()
+            now = time()
+            slot = max(next_slot, now)
+            connection.execute('UPDATE rate_limiter SET next_slot = ?', (slot + interval,))
+        return max(0.0, slot - (self.burst - 1) * interval - now)
+
+    async def acquire_async(self) -> float:
+        # Waiting for another process to release the state file mustn't block the event loop
+        delay = await asyncio.to_thread(self.reserve)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def is_idle(self) -> bool:
+        with self.__transaction() as connection:
+            return connection.execute('SELECT next_slot FROM rate_limiter').fetchone()[0] <= time()
+
+    def record_response(self, seconds: float, status_code: int, throttled_status_codes: tuple = None) -> None:
+        if status_code in (throttled_status_codes or THROTTLED_STATUS_CODES):
+            self.__slow_down('throttled')
+        elif seconds > SLOW_RESPONSE_SECONDS:
+            self.__slow_down('slow_response')
+        elif status_code < 400:
+            self.__speed_up()
+
+    def record_throttled(self) -> None:
+        self.__slow_down('suspended')
+
+    def __speed_up(self) -> None:
+        with self.__transaction() as connection:
+            interval = connection.execute('SELECT interval FROM rate_limiter').fetchone()[0]
+            # Intervals that were set below the minimum (e.g. for tests) are left alone
+            if interval > self.min_interval:
+                connection.execute(
+                    'UPDATE rate_limiter SET interval = ?', (max(self.min_interval, 1 / (1 / interval + RATE_INCREASE)),))
+
+    def __slow_down(self, reason: str) -> None:
+        with self.__transaction() as connection:
+            interval, last_slowdown_at = connection.execute('SELECT interval, last_slowdown_at FROM rate_limiter').fetchone()
+            now = time()
+            if now - last_slowdown_at < SLOWDOWN_COOLDOWN or interval <= 0:
+                return
+            connection.execute(
+                'UPDATE rate_limiter SET interval = ?, last_slowdown_at = ?',
+                (min(self.max_interval, max(interval, self.min_interval) * INTERVAL_BACKOFF_FACTOR), now))
+        MAL_STATS.increment('mal_rate_limiter_slowdowns_total', reason=reason)
+
+    @contextmanager
+    def __transaction(self):
+        with self._lock:
+            connection_key = (os.getpid(), self.state_path)
+            if self._connection_key != connection_key:
+                if self._connection is not None and self._connection_key is not None and self._connection_key[0] == os.getpid():
+                    self._connection.close()
+                self._connection = self.__connect()
+                self._connection_key = connection_key
+
+            # Processes reserve slots one at a time
+            with immediate_transaction(self._connection) as connection:
+                yield connection
+
+    def __connect(self) -> sqlite3.Connection:
+        os.makedirs(dirname(self.state_path), exist_ok=True)
+        connection = sqlite3.connect(self.state_path, timeout=60, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(RATE_LIMITER_SCHEMA)
+        connection.execute(
+            'INSERT OR IGNORE INTO rate_limiter (id, next_slot, interval, last_slowdown_at) VALUES (0, 0, ?, 0)', (self.initial_interval,))
+        return connection
+
+
+# Shared by every module and every process on the host, see mal_request() and mal_http
+MAL_RATE_LIMITER = SharedRateLimiter(MAL_REQUEST_INTERVAL, MIN_MAL_REQUEST_INTERVAL, MAX_MAL_REQUEST_INTERVAL)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent fetches of the same resource: the first caller of a key
+    runs the fetch and every caller that asks for the same key while it's still
+    running waits for it and gets the same result (or exception), both threads and
+    asyncio tasks. Keys are (CacheKind, key) pairs, the same keys as in MAL_CACHE.
+
+    Nothing is remembered once a fetch completes, that's what the cache is for, so
+    fetch functions should check the cache again before downloading anything.
+    Never wait for a key from blocking code on the event loop's thread while an
+    asyncio task of that loop is the one fetching it.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        # {key: Future of the fetch in flight}
+        self._in_flight = {}
+
+    def run(self, key: tuple, function, *args):
+        future, is_owner = self.__join(key)
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = function(*args)
+        except BaseException as e:
+            self.__complete(key, future, exception=e)
+            raise
+        self.__complete(key, future, result)
+        return result
+
+    async def run_async(self, key: tuple, coroutine_function, *args):
+        future, is_owner = self.__join(key)
+        if not is_owner:
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await coroutine_function(*args)
+        except BaseException as e:
+            self.__complete(key, future, exception=e)
+            raise
+        self.__complete(key, future, result)
+        return result
+
+    def submit(self, key: tuple, submit_function, *args) -> Future:
+        """
+        Non-blocking version of run() for fetches that run elsewhere (e.g. in a
+        FetchParsePipeline): 'submit_function' is only called by the first caller
+        of the key and returns a Future, the key stays in flight until it's done.
+        Return the Future of the fetch, whoever runs it.
+        """
+        future, is_owner = self.__join(key)
+        if not is_owner:
+            return future
+
+        try:
+            fetch_future = submit_function(*args)
+        except BaseException as e:
+            self.__complete(key, future, exception=e)
+            raise
+        fetch_future.add_done_callback(lambda fetch_future : self.__complete_from(key, future, fetch_future))
+        return future
+
+    def __join(self, key: tuple) -> tuple[Future, bool]:
+        """
+        Return the future of the fetch of 'key' and whether the caller is the one that has to run it.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                MAL_STATS.increment('mal_coalesced_requests_total', kind=key[0])
+                return future, False
+
+            future = self._in_flight[key] = Future()
+            return future, True
+
+    def __complete(self, key: tuple, future: Future, result=None, exception: BaseException = None) -> None:
+        with self._lock:
+            del self._in_flight[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def __complete_from(self, key: tuple, future: Future, fetch_future: Future) -> None:
+        if fetch_future.cancelled():
+            self.__complete(key, future, exception=CancelledError())
+        elif fetch_future.exception() is not None:
+            self.__complete(key, future, exception=fetch_future.exception())
+        else:
+            self.__complete(key, future, fetch_future.result())
+
+
+# Shared by the blocking and the asyncio scrapers, so they never download the same page at the same time
+MAL_SINGLE_FLIGHT = SingleFlight()
+
+
+@contextmanager
+def mal_request():
+    """
+    This context manager takes a slot from MAL_RATE_LIMITER to avoid getting the IP
+    suspended for request flooding. The interval between requests is shared by every
+    process on the host and adapts to MAL's responses: it starts at MAL_REQUEST_INTERVAL,
+    drops towards MIN_MAL_REQUEST_INTERVAL while requests succeed and grows up to
+    MAX_MAL_REQUEST_INTERVAL when MAL throttles them (see SharedRateLimiter). Responses
+    only count if they're reported with MAL_RATE_LIMITER.record_response(), which
+    send_request() in mal_http does. Each request to MyAnimeList website should be
+    made in a different instance of this context manager.
+    """
+    MAL_RATE_LIMITER.acquire()
+    yield
 
 
 class AnimeStatus:
@@ -83,6 +576,58 @@ class AnimeListSortBy:
     Status          = 16
 
 
+class CacheKind:
+    AnimeCharacters         = 'anime_characters'
+    CharacterVoiceActors    = 'character_voice_actors'
+    AnimeDetails            = 'anime_details'
+    SearchResults           = 'search_results'
+    UserAnimeList           = 'user_anime_list'
+    ImageThumbnails         = 'image_thumbnails'
+
+
+# How long each kind of cached entity stays valid
+CACHE_TTL_IN_DAYS = {
+    CacheKind.AnimeCharacters       : CACHE_LIFETIME_IN_DAYS,
+    CacheKind.CharacterVoiceActors  : CACHE_LIFETIME_IN_DAYS,
+    CacheKind.AnimeDetails          : 7,
+    CacheKind.SearchResults         : 30,
+    CacheKind.UserAnimeList         : 1 / 24,
+    CacheKind.ImageThumbnails       : CACHE_LIFETIME_IN_DAYS,
+}
+
+# How long after expiring an entity may still be served while a refresher downloads it again, see mal_refresh
+CACHE_STALE_IN_DAYS = {
+    CacheKind.AnimeCharacters       : 30,
+    CacheKind.CharacterVoiceActors  : 30,
+    CacheKind.AnimeDetails          : 7,
+    CacheKind.SearchResults         : 7,
+    CacheKind.UserAnimeList         : 0,
+    CacheKind.ImageThumbnails       : 0,
+}
+
+
+class ParserBackend:
+    BeautifulSoup   = 'bs4'
+    Lxml            = 'lxml'
+
+
+__parser_backend = ParserBackend.Lxml
+
+
+def set_parser_backend(parser_backend: str) -> None:
+    """
+    Select the HTML parser used by all parse_* functions, see ParserBackend.
+    """
+    global __parser_backend
+    if parser_backend not in (ParserBackend.BeautifulSoup, ParserBackend.Lxml):
+        raise ValueError(f'Unknown parser backend "{parser_backend}"')
+    __parser_backend = parser_backend
+
+
+def get_parser_backend() -> str:
+    return __parser_backend
+
+
 class CharacterRole:
     Main        = 0
     Supporting  = 1
\ No newline at end of file
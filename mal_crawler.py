@@ -0,0 +1,373 @@
+# Resumable bulk crawl of anime details. The IDs to crawl are kept in a durable queue
+# (SQLite) inside a crawl directory and every result is appended to a JSONL file as
+# soon as it's downloaded, so a crawl that was stopped (crash, Ctrl+C, suspended IP)
+# continues from where it stopped when it's run again. Several worker processes can
+# work on the same crawl directory at the same time.
+#
+#   python mal_crawler.py catalog add 1-60000
+#   python mal_crawler.py catalog run --workers 2
+#   python mal_crawler.py catalog status
+#   python mal_crawler.py catalog export
+import json
+import os
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Process
+from os.path import join
+from time import time
+import numpy as np
+import requests
+from mal_common import *
+from mal_http import is_suspension_error
+from mal_base import get_anime_details, is_empty_anime_details
+from mal_cache import encode_json_value
+
+QUEUE_DATABASE_FILE_NAME = 'queue.sqlite3'
+RESULTS_FILE_NAME = 'anime_details.jsonl'
+COLUMNAR_FILE_NAME = 'anime_details.npz'
+# Failed jobs are retried until they failed this many times
+MAX_ATTEMPTS = 3
+# Jobs that were claimed this long ago by a worker that never completed them (e.g. it was killed) are queued again
+CLAIM_TIMEOUT = 10 * 60 # seconds
+# The worker stops after this many failures in a row, it usually means that the IP was suspended.
+# Missing anime (404) aren't failures, MAL's IDs are sparse.
+MAX_CONSECUTIVE_FAILURES = 5
+
+QUEUE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    anime_id    INTEGER PRIMARY KEY,
+    state       TEXT NOT NULL DEFAULT 'pending',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    claimed_by  TEXT,
+    claimed_at  REAL,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, attempts);
+'''
+
+
+class JobState:
+    Pending = 'pending'
+    Running = 'running'
+    Done    = 'done'
+    Failed  = 'failed'
+    Missing = 'missing' # No anime has this ID, never retried
+
+
+class CrawlQueue:
+    """
+    Durable queue of anime IDs. Claiming jobs is a single write transaction,
+    so any number of processes can take jobs from the same queue without
+    getting the same job twice.
+    """
+    def __init__(self, crawl_directory: str):
+        os.makedirs(crawl_directory, exist_ok=True)
+        self._connection = sqlite3.connect(
+            join(crawl_directory, QUEUE_DATABASE_FILE_NAME), timeout=DATABASE_BUSY_TIMEOUT, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(QUEUE_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def add(self, anime_ids) -> int:
+        """
+        Queue the given IDs, IDs that were queued before are ignored. Return the number of new jobs.
+        """
+        with self.__transaction():
+            return self._connection.executemany(
+                'INSERT OR IGNORE INTO jobs (anime_id) VALUES (?)', ((int(anime_id),) for anime_id in anime_ids)).rowcount
+
+    def claim(self, worker_id: str, count: int = 1) -> list[int]:
+        """
+        Take up to 'count' jobs, pending jobs first and then failed jobs that can be retried.
+        """
+        with self.__transaction():
+            anime_ids = [row[0] for row in self._connection.execute(
+                'SELECT anime_id FROM jobs WHERE state = ? OR (state = ? AND attempts < ?) '
+                'ORDER BY state = ?, anime_id LIMIT ?',
+                (JobState.Pending, JobState.Failed, MAX_ATTEMPTS, JobState.Failed, count))]
+            self._connection.executemany(
+                'UPDATE jobs SET state = ?, claimed_by = ?, claimed_at = ? WHERE anime_id = ?',
+                ((JobState.Running, worker_id, time(), anime_id) for anime_id in anime_ids))
+        return anime_ids
+
+    def complete(self, anime_id: int) -> None:
+        with self.__transaction():
+            self._connection.execute(
+                'UPDATE jobs SET state = ?, attempts = attempts + 1, error = NULL WHERE anime_id = ?', (JobState.Done, anime_id))
+
+    def fail(self, anime_id: int, error: str) -> None:
+        with self.__transaction():
+            self._connection.execute(
+                'UPDATE jobs SET state = ?, attempts = attempts + 1, error = ? WHERE anime_id = ?', (JobState.Failed, error, anime_id))
+
+    def mark_missing(self, anime_id: int) -> None:
+        with self.__transaction():
+            self._connection.execute(
+                'UPDATE jobs SET state = ?, attempts = attempts + 1, error = NULL WHERE anime_id = ?', (JobState.Missing, anime_id))
+
+    def release(self, worker_id: str) -> int:
+        """
+        Queue the unfinished jobs of a worker again (e.g. when it stops early).
+        """
+        with self.__transaction():
+            return self._connection.execute(
+                'UPDATE jobs SET state = ? WHERE state = ? AND claimed_by = ?', (JobState.Pending, JobState.Running, worker_id)).rowcount
+
+    def release_stale(self, timeout: float = CLAIM_TIMEOUT) -> int:
+        """
+        Queue jobs of workers that were killed before they finished them again.
+        """
+        with self.__transaction():
+            return self._connection.execute(
+                'UPDATE jobs SET state = ? WHERE state = ? AND claimed_at < ?', (JobState.Pending, JobState.Running, time() - timeout)).rowcount
+
+    def retry_failed(self) -> int:
+        """
+        Give failed jobs that ran out of attempts another set of attempts.
+        """
+        with self.__transaction():
+            return self._connection.execute(
+                'UPDATE jobs SET state = ?, attempts = 0 WHERE state = ?', (JobState.Pending, JobState.Failed)).rowcount
+
+    def get_progress(self) -> dict:
+        """
+        Return {'state': number of jobs, ...}, failed jobs that can still be retried are counted as 'retryable'.
+        """
+        progress = {state: 0 for state in (JobState.Pending, JobState.Running, JobState.Done, JobState.Failed, JobState.Missing)}
+        progress.update(self._connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+        progress['retryable'] = self._connection.execute(
+            'SELECT COUNT(*) FROM jobs WHERE state = ? AND attempts < ?', (JobState.Failed, MAX_ATTEMPTS)).fetchone()[0]
+        return progress
+
+    def get_failures(self) -> list[tuple[int, int, str]]:
+        return self._connection.execute(
+            'SELECT anime_id, attempts, error FROM jobs WHERE state = ? ORDER BY anime_id', (JobState.Failed,)).fetchall()
+
+    def __transaction(self):
+        # Two workers never select the same jobs
+        return immediate_transaction(self._connection)
+
+
+def append_result(results_file_path: str, anime_id: int, details: AnimeDetails) -> None:
+    line = json.dumps(
+        {'anime_id': anime_id, 'crawled_at': time(), 'details': details.to_dict()},
+        default=partial(encode_json_value, tagged=False), ensure_ascii=False
+    ) + '\n'
+
+    # A single write to a file opened for appending, so lines of different workers never interleave
+    file_descriptor = os.open(results_file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(file_descriptor, line.encode())
+    finally:
+        os.close(file_descriptor)
+
+
+def read_results(crawl_directory: str) -> dict:
+    """
+    Return {anime_id: details dict} from the JSONL results. An anime that was crawled
+    more than once (e.g. a worker was killed before marking its job as done) has
+    the details of its last line.
+    """
+    results = {}
+    try:
+        with open(join(crawl_directory, RESULTS_FILE_NAME), 'r', encoding='utf8') as results_file:
+            for line in results_file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # A worker was killed in the middle of writing a line and the next result was
+                    # appended to it, the job of the incomplete line was crawled again anyway
+                    try:
+                        result = json.loads(line[line.rfind('{"anime_id"'):])
+                    except json.JSONDecodeError:
+                        continue
+                results[result['anime_id']] = result['details']
+    except FileNotFoundError:
+        pass
+    return results
+
+
+def run_worker(crawl_directory: str, worker_id: str = None) -> int:
+    """
+    Crawl jobs from the queue until it's empty, return the number of crawled anime.
+    """
+    worker_id = worker_id or f'{os.getpid()}'
+
+    queue = CrawlQueue(crawl_directory)
+    results_file_path = join(crawl_directory, RESULTS_FILE_NAME)
+    crawled_count = 0
+    consecutive_failures = 0
+    try:
+        queue.release_stale()
+        while True:
+            anime_ids = queue.claim(worker_id)
+            if not anime_ids:
+                break
+
+            anime_id = anime_ids[0]
+            suspended = False
+            try:
+                details = get_anime_details(anime_id)
+                # Suspension pages that are served as 200 parse to empty details
+                if is_empty_anime_details(details):
+                    suspended = True
+                    raise Exception('The page has no details, the IP may be suspended')
+            except Exception as e:
+                if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 404:
+                    queue.mark_missing(anime_id)
+                    consecutive_failures = 0
+                    continue
+
+                if suspended or is_suspension_error(e):
+                    # Slows down every process that shares the rate limiter, not only this worker
+                    MAL_RATE_LIMITER.record_throttled()
+                queue.fail(anime_id, str(e))
+                consecutive_failures += 1
+                if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                    print(f'Worker {worker_id}: {consecutive_failures} failures in a row, stopping', file=sys.stderr)
+                    break
+                continue
+
+            append_result(results_file_path, anime_id, details)
+            queue.complete(anime_id)
+            consecutive_failures = 0
+            crawled_count += 1
+    finally:
+        queue.release(worker_id)
+        queue.close()
+
+    return crawled_count
+
+
+def crawl(crawl_directory: str, worker_count: int = 1) -> dict:
+    """
+    Run 'worker_count' worker processes over the queue and return the progress once they stop.
+    The processes share MAL_RATE_LIMITER, so all of them together stay within the limit and
+    more workers only help to hide the latency of the requests.
+    """
+    if worker_count == 1:
+        run_worker(crawl_directory)
+    else:
+        workers = [
+            Process(target=run_worker, args=(crawl_directory, f'{os.getpid()}-{index}'))
+            for index in range(worker_count)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    queue = CrawlQueue(crawl_directory)
+    try:
+        return queue.get_progress()
+    finally:
+        queue.close()
+
+
+def export_columnar(crawl_directory: str) -> str:
+    """
+    Write the results as columns to a NumPy .npz file and return its path. Numbers are
+    float64 (NaN when missing), durations are in seconds, strings and lists of strings
+    (joined with '\\x1f') are stored as int32 codes into a '<column>__categories' array
+    (code -1 when missing). See load_columnar().
+    """
+    results = read_results(crawl_directory)
+    anime_ids = sorted(results)
+    columns = {'anime_id': np.array(anime_ids, dtype=np.int64)}
+
+    field_names = list(AnimeDetails.FIELDS)
+    for details in results.values():
+        field_names += [field_name for field_name in details if field_name not in field_names]
+
+    for field_name in field_names:
+        values = [results[anime_id].get(field_name) for anime_id in anime_ids]
+        present_values = [value for value in values if value is not None]
+        if not present_values:
+            continue
+
+        if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present_values):
+            columns[field_name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            continue
+
+        strings = [None if value is None else '\x1f'.join(value) if isinstance(value, list) else str(value) for value in values]
+        categories = sorted(set(string for string in strings if string is not None))
+        codes = {string: code for code, string in enumerate(categories)}
+        columns[field_name] = np.array([-1 if string is None else codes[string] for string in strings], dtype=np.int32)
+        columns[field_name + '__categories'] = np.array(categories, dtype=np.str_)
+
+    columnar_file_path = join(crawl_directory, COLUMNAR_FILE_NAME)
+    np.savez_compressed(columnar_file_path, **columns)
+    return columnar_file_path
+
+
+def load_columnar(columnar_file_path: str) -> dict:
+    """
+    Return {'column': array} from a file written by export_columnar(), string columns
+    are decoded to object arrays (None when missing).
+    """
+    with np.load(columnar_file_path) as columnar_file:
+        arrays = {name: columnar_file[name] for name in columnar_file.files}
+
+    columns = {}
+    for name, array in arrays.items():
+        if name.endswith('__categories'):
+            continue
+        categories = arrays.get(name + '__categories')
+        if categories is None:
+            columns[name] = array
+        else:
+            decoded = np.empty(len(array), dtype=object)
+            decoded[:] = [None if code < 0 else str(categories[code]) for code in array]
+            columns[name] = decoded
+    return columns
+
+
+def __parse_anime_ids(arguments: list[str]):
+    for argument in arguments:
+        if '-' in argument:
+            first, last = argument.split('-')
+            yield from range(int(first), int(last) + 1)
+        else:
+            yield int(argument)
+
+
+def main():
+    argument_parser = ArgumentParser(description='Crawl the details of many anime')
+    argument_parser.add_argument('crawl_directory')
+    subparsers = argument_parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='Queue anime IDs, e.g. "1 5 100-200"')
+    add_parser.add_argument('anime_ids', nargs='+')
+    run_parser = subparsers.add_parser('run', help='Crawl the queued anime')
+    run_parser.add_argument('--workers', type=int, default=1)
+    subparsers.add_parser('status', help='Show the progress and the failures')
+    subparsers.add_parser('retry', help='Queue the failed anime again')
+    subparsers.add_parser('export', help='Write the results to a columnar .npz file')
+    arguments = argument_parser.parse_args()
+
+    if arguments.command == 'run':
+        print(crawl(arguments.crawl_directory, arguments.workers))
+        return
+    if arguments.command == 'export':
+        print(export_columnar(arguments.crawl_directory))
+        return
+
+    queue = CrawlQueue(arguments.crawl_directory)
+    try:
+        if arguments.command == 'add':
+            print(queue.add(__parse_anime_ids(arguments.anime_ids)), 'new jobs')
+        elif arguments.command == 'retry':
+            print(queue.retry_failed(), 'jobs queued again')
+        else:
+            print(queue.get_progress())
+            for anime_id, attempts, error in queue.get_failures():
+                print(f'{anime_id} ({attempts} attempts): {error}')
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
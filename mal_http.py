@@ -0,0 +1,288 @@
+import asyncio
+import random
+import requests
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from functools import partial
+from threading import Lock
+from typing import Iterator
+from time import sleep, perf_counter
+from requests.adapters import HTTPAdapter
+from mal_common import RateLimiter, MAL_RATE_LIMITER, THROTTLED_STATUS_CODES, API_THROTTLED_STATUS_CODES
+from mal_stats import MAL_STATS, Endpoint, get_url_endpoint
+
+CONNECTION_POOL_SIZE = 16
+REQUEST_TIMEOUT = 30 # seconds
+MAX_RETRIES = 5
+RETRY_BACKOFF_BASE = 2 # seconds
+RETRY_BACKOFF_MAX = 120 # seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Number of pages whose ETag/Last-Modified validators (and bodies) are kept for revalidation
+VALIDATOR_CACHE_SIZE = 128
+# Size of the chunks iter_html() reads, small enough that a stream stops soon after what was looked for
+STREAM_CHUNK_SIZE = 16 * 1024 # bytes
+
+__session = None
+__session_lock = Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Return the session shared by all modules. It keeps connections alive, so
+    consecutive requests to MAL don't pay for a new TCP+TLS handshake.
+    """
+    global __session
+    with __session_lock:
+        if __session is None:
+            __session = requests.Session()
+            # Retries are handled by send_request() because they have to go through the rate limiter
+            adapter = HTTPAdapter(pool_connections=CONNECTION_POOL_SIZE, pool_maxsize=CONNECTION_POOL_SIZE, max_retries=0)
+            __session.mount('https://', adapter)
+            __session.mount('http://', adapter)
+        return __session
+
+
+class ValidatorCache:
+    """
+    Bounded LRU of {url: (etag, last_modified, body)} used to send conditional
+    requests for pages that were already downloaded.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, url: str) -> tuple:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url: str, etag: str, last_modified: str, body: bytes) -> None:
+        with self._lock:
+            self._entries[url] = (etag, last_modified, body)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+VALIDATOR_CACHE = ValidatorCache(VALIDATOR_CACHE_SIZE)
+
+
+def get_retry_delay(attempt: int, response: requests.Response = None) -> float:
+    """
+    Return how long to wait before the given retry attempt. 'Retry-After' is
+    honored when the server sends it, otherwise exponential backoff with full jitter is used.
+    Either way the delay is at most RETRY_BACKOFF_MAX, a server (or a proxy) asking for
+    a day doesn't hang the worker for a day.
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(RETRY_BACKOFF_MAX, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+            try:
+                return min(RETRY_BACKOFF_MAX, max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()))
+            except (TypeError, ValueError):
+                pass
+
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+def __should_retry(attempt: int, response: requests.Response, max_retries: int) -> bool:
+    return attempt < max_retries and response.status_code in RETRY_STATUS_CODES
+
+
+def __get_throttled_status_codes(url: str) -> tuple:
+    # A bad token or a forbidden list update mustn't slow down every process that shares the limiter
+    return API_THROTTLED_STATUS_CODES if get_url_endpoint(url) == Endpoint.ApiV2 else THROTTLED_STATUS_CODES
+
+
+def __send_once(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    return get_session().request(method, url, **kwargs)
+
+
+def send_request(method: str, url: str, rate_limiter: RateLimiter = MAL_RATE_LIMITER, max_retries: int = None, **kwargs) -> requests.Response:
+    """
+    Send a request through the shared session. Each attempt takes a slot from the
+    rate limiter, connection errors, 429 and 5xx responses are retried up to
+    'max_retries' times (MAX_RETRIES by default).
+    Accepts the same keyword arguments as requests.request().
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    endpoint = get_url_endpoint(url) if MAL_STATS.enabled else None
+    for attempt in range(max_retries + 1):
+        __record_wait(endpoint, rate_limiter.acquire())
+        start = perf_counter()
+        try:
+            response = __send_once(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            __record_error(endpoint)
+            if attempt == max_retries:
+                raise
+            sleep(get_retry_delay(attempt))
+            continue
+
+        seconds = perf_counter() - start
+        __record_response(endpoint, response, seconds, kwargs.get('stream', False))
+        rate_limiter.record_response(seconds, response.status_code, __get_throttled_status_codes(url))
+        if not __should_retry(attempt, response, max_retries):
+            return response
+        # Streamed responses keep their connection until they're closed
+        response.close()
+        __record_retry(endpoint)
+        sleep(get_retry_delay(attempt, response))
+
+
+async def send_request_async(method: str, url: str, rate_limiter: RateLimiter = MAL_RATE_LIMITER, max_retries: int = None, **kwargs) -> requests.Response:
+    """
+    Same as send_request() but waits for the rate limiter and the backoff
+    without blocking the event loop.
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    loop = asyncio.get_running_loop()
+    endpoint = get_url_endpoint(url) if MAL_STATS.enabled else None
+    for attempt in range(max_retries + 1):
+        __record_wait(endpoint, await rate_limiter.acquire_async())
+        start = perf_counter()
+        try:
+            response = await loop.run_in_executor(None, partial(__send_once, method, url, **kwargs))
+        except (requests.ConnectionError, requests.Timeout):
+            __record_error(endpoint)
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(get_retry_delay(attempt))
+            continue
+
+        seconds = perf_counter() - start
+        __record_response(endpoint, response, seconds, kwargs.get('stream', False))
+        await asyncio.to_thread(rate_limiter.record_response, seconds, response.status_code, __get_throttled_status_codes(url))
+        if not __should_retry(attempt, response, max_retries):
+            return response
+        # Streamed responses keep their connection until they're closed
+        response.close()
+        __record_retry(endpoint)
+        await asyncio.sleep(get_retry_delay(attempt, response))
+
+
+# The endpoint is None when stats weren't enabled at the time the request started
+def __record_wait(endpoint: str, seconds: float) -> None:
+    if endpoint is not None:
+        MAL_STATS.observe('mal_rate_limiter_wait_seconds', seconds, endpoint=endpoint)
+
+
+def __record_response(endpoint: str, response: requests.Response, seconds: float, stream: bool) -> None:
+    if endpoint is not None:
+        MAL_STATS.increment('mal_requests_total', endpoint=endpoint, status=response.status_code)
+        # The body of a streamed response isn't read yet, iter_html() counts the bytes it reads
+        if not stream:
+            MAL_STATS.increment('mal_response_bytes_total', len(response.content), endpoint=endpoint)
+        MAL_STATS.observe('mal_request_duration_seconds', seconds, endpoint=endpoint)
+
+
+def __record_error(endpoint: str) -> None:
+    if endpoint is not None:
+        MAL_STATS.increment('mal_request_errors_total', endpoint=endpoint)
+
+
+def __record_retry(endpoint: str) -> None:
+    if endpoint is not None:
+        MAL_STATS.increment('mal_request_retries_total', endpoint=endpoint)
+
+
+def __conditional_headers(validators: tuple) -> dict:
+    headers = {}
+    if validators is not None:
+        etag, last_modified, _ = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def __handle_html_response(url: str, response: requests.Response, validators: tuple) -> str:
+    # Page didn't change since the last time it was downloaded
+    if response.status_code == 304 and validators is not None:
+        if MAL_STATS.enabled:
+            MAL_STATS.increment('mal_not_modified_total', endpoint=get_url_endpoint(url))
+        return validators[2].decode()
+
+    # Error pages (a missing page, a suspended IP, a 429/5xx that outlasted the retries) aren't content
+    response.raise_for_status()
+
+    if response.status_code == 200:
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            VALIDATOR_CACHE.put(url, etag, last_modified, response.content)
+
+    return response.content.decode()
+
+
+def __full_url(url: str, params: dict) -> str:
+    if not params:
+        return url
+    return requests.Request('GET', url, params=params).prepare().url
+
+
+def is_suspension_error(exception: BaseException) -> bool:
+    """
+    Return True if the exception is an HTTPError for one of the pages MAL serves instead of
+    the requested page while the IP is suspended or throttled.
+    """
+    return isinstance(exception, requests.HTTPError) and exception.response is not None\
+        and exception.response.status_code in THROTTLED_STATUS_CODES
+
+
+def get_html(url: str, params: dict = None) -> str:
+    """
+    Download a MAL page and return it decoded. Pages that were downloaded before
+    are revalidated with If-None-Match/If-Modified-Since. Error responses raise
+    requests.HTTPError, its 'response' has the status code.
+    """
+    url = __full_url(url, params)
+    validators = VALIDATOR_CACHE.get(url)
+    response = send_request('GET', url, headers=__conditional_headers(validators))
+    return __handle_html_response(url, response, validators)
+
+
+def iter_html(url: str, params: dict = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Download a MAL page as it arrives, in chunks of raw bytes, for parsers that can
+    stop before the end of the page. The rest of the page is never downloaded once
+    the generator is closed (the connection is dropped rather than drained). Pages
+    are revalidated and errors raised like in get_html(), but streamed pages are
+    usually incomplete so they aren't kept for later revalidation.
+    """
+    url = __full_url(url, params)
+    validators = VALIDATOR_CACHE.get(url)
+    endpoint = get_url_endpoint(url) if MAL_STATS.enabled else None
+    with send_request('GET', url, headers=__conditional_headers(validators), stream=True) as response:
+        if response.status_code == 304 and validators is not None:
+            if endpoint is not None:
+                MAL_STATS.increment('mal_not_modified_total', endpoint=endpoint)
+            yield validators[2]
+            return
+        response.raise_for_status()
+
+        read_bytes = 0
+        try:
+            for chunk in response.iter_content(chunk_size):
+                read_bytes += len(chunk)
+                yield chunk
+        finally:
+            if endpoint is not None:
+                MAL_STATS.increment('mal_response_bytes_total', read_bytes, endpoint=endpoint)
+
+
+async def get_html_async(url: str, params: dict = None) -> str:
+    url = __full_url(url, params)
+    validators = VALIDATOR_CACHE.get(url)
+    response = await send_request_async('GET', url, headers=__conditional_headers(validators))
+    return __handle_html_response(url, response, validators)
@@ -0,0 +1,263 @@
+# lxml implementations of the parse_* functions in mal_base and mal_search.
+# They return the same results as the BeautifulSoup implementations but evaluate
+# precompiled XPath expressions directly on the lxml tree, which is several times
+# faster than building a soup and running CSS selectors on it.
+# See set_parser_backend() in mal_common.
+import re
+import json
+from datetime import timedelta
+from lxml import etree, html
+from mal_common import *
+
+
+def __has_class(class_name: str) -> str:
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+
+# Equivalent of CSS ':nth-child(n)' for elements
+def __nth_child(n: int) -> str:
+    return f'count(preceding-sibling::*) = {n - 1}'
+
+
+# parse_user_anime_list
+__LIST_ITEMS_XPATH = etree.XPath(f'//*[@id="list-container"]/div[{__has_class("list-block")}]/div/table/@data-items')
+
+# parse_anime_character_list
+__CHARACTER_CONTAINER_XPATH = etree.XPath(
+    '/html/body/div[@id="myanimelist"]'
+    f'/div[{__has_class("wrapper")}]'
+    '/div[@id="contentWrapper"]/div[@id="content"]/table/tr/td[2]'
+)
+__CHARACTER_ROWS_XPATH = etree.XPath(
+    f'.//div[{__has_class("js-scrollfix-bottom-rel")}]'
+    f'/div[{__has_class("anime-character-container")}]'
+    f'/table[{__has_class("js-anime-character-table")}]/tr'
+)
+__ROW_VOICE_ACTORS_XPATH = etree.XPath('.//td[3]/table/tr/td[1]')
+__DIVS_XPATH = etree.XPath('.//div')
+__FIRST_LINK_XPATH = etree.XPath('(.//a)[1]')
+__ROW_CHARACTER_DATA_XPATH = etree.XPath('(.//td[2])[1]')
+__CHARACTER_ROLE_AND_NAME_XPATH = etree.XPath(f'(.//div[{__has_class("js-chara-roll-and-name")}])[1]')
+__CHARACTER_LINK_XPATH = etree.XPath('((.//div[3])[1]//a)[1]/@href')
+__CHARACTER_IMAGE_SRCSET_XPATH = etree.XPath('(.//td[1]/div/a/img)[1]/@data-srcset')
+
+# parse_character_voice_actors
+__CHARACTER_PAGE_VOICE_ACTORS_XPATH = etree.XPath('//*[@id="content"]/table[1]/tr[1]/td[2]/table/tr/td[2]')
+__VOICE_ACTOR_LANGUAGE_XPATH = etree.XPath('((.//div)[1]//small)[1]')
+
+# parse_anime_details
+__TITLE_XPATH = etree.XPath(f'(//h1[{__has_class("title-name")}])[1]')
+__ATTRIBUTES_XPATH = etree.XPath(f'//div[{__has_class("spaceit_pad")}]')
+__ATTRIBUTE_SPANS_XPATH = etree.XPath('.//span[parent::div]')
+__ATTRIBUTE_LINKS_XPATH = etree.XPath('.//a[parent::div]')
+
+# parse_search_results
+__SEARCH_ROWS_XPATH = etree.XPath(f'//*[{__has_class("js-categories-seasonal")}]/table[{__nth_child(1)}]/tr')
+__SEARCH_TITLE_XPATH = etree.XPath(f'(.//td[{__nth_child(2)}]/div[{__nth_child(1)}]/a[{__nth_child(2)}])[1]')
+__FIRST_STRONG_XPATH = etree.XPath('(.//strong)[1]')
+
+
+def __parse_html(response_html: str) -> html.HtmlElement:
+    return html.document_fromstring(response_html)
+
+
+def __get_id_from_url(url: str, kind: str) -> str:
+    parts = url.split('/')
+    return parts[parts.index(kind) + 1]
+
+
+def __element_children(element: html.HtmlElement) -> list[html.HtmlElement]:
+    # Skip comments and processing instructions, like iterating over a soup ignores them
+    return [child for child in element if isinstance(child.tag, str)]
+
+
+def parse_user_anime_list(response_html: str) -> list[AnimeListEntry]:
+    json_data = json.loads(__LIST_ITEMS_XPATH(__parse_html(response_html))[0])
+    return decode_anime_list_entries(json_data)
+
+
+def parse_anime_character_list(response_html: str) -> list[Character]:
+    # If the page doesn't contain the expected content, assume that the IP was suspended
+    character_container = __CHARACTER_CONTAINER_XPATH(__parse_html(response_html))
+    if len(character_container) == 0:
+        return None
+
+    result = []
+    for character_row in __CHARACTER_ROWS_XPATH(character_container[0]):
+        character_voice_actors = []
+        for voice_actor in __ROW_VOICE_ACTORS_XPATH(character_row):
+            name, language = __DIVS_XPATH(voice_actor)
+            name_link = __FIRST_LINK_XPATH(name)[0]
+            character_voice_actors.append(VoiceActor({
+                'name'     : name_link.text.strip(),
+                'language' : language.text.strip(),
+                'id'       : __get_id_from_url(name_link.get('href').strip(), 'people')
+            }))
+
+        character_data = __ROW_CHARACTER_DATA_XPATH(character_row)[0]
+
+        character_role, character_name = __CHARACTER_ROLE_AND_NAME_XPATH(character_data)[0].text.strip().split('_', 1)
+        if character_role not in ('m', 's'):
+            raise Exception(f'Unrecognized character role "{character_role}"')
+
+        character_id = __get_id_from_url(__CHARACTER_LINK_XPATH(character_data)[0].strip(), 'character')
+
+        # Get the link to the image with the highest quality
+        character_image_links = __CHARACTER_IMAGE_SRCSET_XPATH(character_row)[0].split(', ')
+        largest_character_image_link = max(character_image_links, key=(lambda item : item.split(' ')[1])).split(' ')[0]
+
+        result.append(Character({
+            'name'              : character_name,
+            'is_main_character' : character_role == 'm',
+            'id'                : character_id,
+            'image_link'        : largest_character_image_link,
+            'voice_actors'      : character_voice_actors
+        }))
+
+    return result
+
+
+def parse_character_voice_actors(response_html: str) -> list[VoiceActor]:
+    voice_actors = []
+    for voice_actor_data in __CHARACTER_PAGE_VOICE_ACTORS_XPATH(__parse_html(response_html)):
+        name_link = __FIRST_LINK_XPATH(voice_actor_data)[0]
+        voice_actors.append(VoiceActor({
+            'name'     : name_link.text,
+            'language' : __VOICE_ACTOR_LANGUAGE_XPATH(voice_actor_data)[0].text,
+            'id'       : __get_id_from_url(name_link.get('href'), 'people')
+        }))
+
+    return voice_actors
+
+
+def __parse_anime_attribute(attr: html.HtmlElement) -> tuple:
+    """
+    Return (name, value) of a 'spaceit_pad' entry of the information sidebar.
+    """
+    attr_span = __ATTRIBUTE_SPANS_XPATH(attr)
+    attr_a = __ATTRIBUTE_LINKS_XPATH(attr)
+
+    attr_name = attr_span[0].text.strip(':').lower().replace(' ', '_')
+
+    # Categorize types of attributes
+    if attr_a:
+        # Link group category
+        attr_value = [a.text for a in attr_a]
+        if attr_name == 'type':
+            attr_value = attr_value[0]
+
+    elif len(attr_span) > 1:
+        # Span value category
+        attr_value = attr_span[1].text
+
+    else:
+        # Direct sibling value category
+        attr_value = attr_span[0].tail.strip()
+
+        # Interpret duration as timedelta
+        if attr_name == 'duration':
+            match = ANIME_DURATION_REGEX.search(attr_value)
+            attr_value = timedelta(
+                hours   = int(match[1] or 0),
+                minutes = int(match[2] or 0),
+                seconds = int(match[3] or 0)
+            )
+        elif attr_name == 'synonyms':
+            attr_value = attr_value.split(', ')
+
+    # Convert numerical attributes to floats
+    if attr_name in ('episodes', 'score', 'members', 'favorites'):
+        attr_value = float(attr_value.replace(',', ''))
+
+    return attr_name, attr_value
+
+
+def parse_anime_details(response_html: str) -> AnimeDetails:
+    root = __parse_html(response_html)
+    attr_dict = {}
+    for title_element in __TITLE_XPATH(root):
+        attr_dict['title'] = ''.join(title_element.itertext()).strip()
+    for attr in __ATTRIBUTES_XPATH(root):
+        attr_name, attr_value = __parse_anime_attribute(attr)
+        attr_dict[attr_name] = attr_value
+
+        # This is the last relevant entry
+        if attr_name == 'favorites':
+            break
+
+    return AnimeDetails(attr_dict)
+
+
+def parse_anime_details_stream(html_chunks, fields: frozenset = None) -> AnimeDetails:
+    """
+    Same as parse_anime_details, but for a page that is still being downloaded:
+    'html_chunks' is an iterable of bytes (see iter_html in mal_http) that is fed
+    to an incremental parser, and no more chunks are read once every field in
+    'fields' (all of them by default) was found. Other fields are left out.
+    """
+    parser = etree.HTMLPullParser(events=('end',), tag=('h1', 'div'), encoding='utf-8')
+    remaining_fields = set(fields or ())
+    attr_dict = {}
+
+    def read_attributes() -> bool:
+        # Return True once there's nothing left to look for
+        for _, element in parser.read_events():
+            element_classes = element.get('class', '').split()
+            if element.tag == 'h1':
+                # The title comes before the information sidebar
+                if 'title-name' in element_classes and 'title' not in attr_dict and (fields is None or 'title' in fields):
+                    attr_dict['title'] = ''.join(element.itertext()).strip()
+                    remaining_fields.discard('title')
+                    if fields is not None and not remaining_fields:
+                        return True
+                continue
+            if 'spaceit_pad' not in element_classes:
+                continue
+            attr_name, attr_value = __parse_anime_attribute(element)
+            if fields is None or attr_name in fields:
+                attr_dict[attr_name] = attr_value
+                remaining_fields.discard(attr_name)
+
+            # This is the last relevant entry
+            if attr_name == 'favorites' or (fields is not None and not remaining_fields):
+                return True
+        return False
+
+    for html_chunk in html_chunks:
+        parser.feed(html_chunk)
+        if read_attributes():
+            return AnimeDetails(attr_dict)
+
+    parser.close()
+    read_attributes()
+    return AnimeDetails(attr_dict)
+
+
+def parse_search_results(response_html: str) -> list[SearchResult]:
+    results = []
+    for search_result in __SEARCH_ROWS_XPATH(__parse_html(response_html))[1:]: # Skip first row (header row)
+        # Parse title and id
+        title_data = __SEARCH_TITLE_XPATH(search_result)[0]
+        title = __FIRST_STRONG_XPATH(title_data)[0].text
+        anime_id = int(re.search(r'/anime/(\d+)/', title_data.get('href'))[1])
+
+        # Parse additional info
+        additional_info = __element_children(search_result)[2:]
+        anime_type, num_episodes, score, start_date, end_date, num_users, rating = [e.text.strip() for e in additional_info]
+
+        num_episodes = 0 if num_episodes=='-' else int(num_episodes.replace(',', ''))
+        score = 0 if score=='N/A' else float(score)
+        num_users = int(num_users.replace(',', ''))
+
+        results.append(SearchResult({
+            'title': title,
+            'id': anime_id,
+            'type': anime_type,
+            'num_episodes': num_episodes,
+            'score': score,
+            'start_date': start_date,
+            'end_date': end_date,
+            'num_users': num_users,
+            'rating': rating}))
+
+    return results
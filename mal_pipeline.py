@@ -0,0 +1,345 @@
+# Batch versions of the scrapers in mal_base and mal_search that overlap downloading
+# with parsing. A single fetcher thread sends the requests one after the other as
+# fast as the rate limiter allows, and every downloaded page is parsed in a process
+# pool while the fetcher already waits for the next slot. On long jobs the time is
+# bound by the rate limit alone, parsing is hidden behind the waits.
+import os
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from queue import Empty, SimpleQueue
+from threading import BoundedSemaphore, Thread
+from time import perf_counter
+from mal_common import *
+from mal_http import get_html, is_suspension_error
+from mal_cache import MAL_CACHE
+from mal_stats import MAL_STATS, get_url_endpoint
+from mal_base import get_anime_id_from_url, get_cached_anime_character_list, cache_anime_character_list, parse_anime_character_list,\
+    parse_character_voice_actors, parse_anime_details, cache_character_voice_actors, cache_anime_details
+from mal_search import ANIME_SEARCH_URL, get_search_cache_key, parse_search_results, cache_search_results
+
+# Number of downloaded pages that may wait for a parse process for each process, more
+# pages than that and the fetcher waits, so a slow parse pool doesn't fill the memory
+PENDING_PAGES_PER_PROCESS = 2
+
+
+def run_parser(parser, response_html: str) -> tuple:
+    # Runs in the parse processes, their MAL_STATS aren't the caller's so the duration is returned
+    start = perf_counter()
+    return parser(response_html), perf_counter() - start
+
+
+class FetchParsePipeline:
+    """
+    One fetcher thread that downloads pages in the order they were submitted and
+    a process pool that parses them. Use as a context manager, or call close():
+
+        with FetchParsePipeline() as pipeline:
+            future = pipeline.submit(MAL_ANIME_URL_PREFIX + '1', parse_anime_details)
+            details = future.result()
+
+    Parsers have to be module level functions, they're sent to the parse processes.
+    When the with block raises (including Ctrl+C), the pages that weren't downloaded
+    yet are cancelled instead of being downloaded for nothing.
+    """
+    def __init__(self, max_processes: int = None):
+        max_processes = max_processes or os.cpu_count() or 1
+        self._process_pool = ProcessPoolExecutor(max_processes, initializer=set_parser_backend, initargs=(get_parser_backend(),))
+        self._parse_slots = BoundedSemaphore(max_processes * PENDING_PAGES_PER_PROCESS)
+        self._jobs = SimpleQueue()
+        self._fetcher = Thread(target=self.__fetch_jobs, daemon=True)
+        self._fetcher.start()
+
+    def __enter__(self) -> 'FetchParsePipeline':
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        self.close(cancel=exc_type is not None)
+
+    def submit(self, url: str, parser, params: dict = None) -> Future:
+        """
+        Queue a page to download, return a Future of what 'parser' returns for it.
+        """
+        future = Future()
+        self._jobs.put((url, params, parser, future))
+        return future
+
+    def close(self, cancel: bool = False) -> None:
+        """
+        Wait until every submitted page was downloaded and parsed, then stop. With 'cancel'
+        the pages that weren't downloaded or parsed yet are cancelled, only the page that
+        is being downloaded and the pages that are being parsed are waited for.
+        """
+        if cancel:
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except Empty:
+                    break
+                if job is not None:
+                    job[3].cancel()
+        self._jobs.put(None)
+        self._fetcher.join()
+        self._process_pool.shutdown(cancel_futures=cancel)
+
+    def __fetch_jobs(self) -> None:
+        while (job := self._jobs.get()) is not None:
+            url, params, parser, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            self._parse_slots.acquire()
+            try:
+                response_html = get_html(url, params)
+                parse_future = self._process_pool.submit(run_parser, parser, response_html)
+            except BaseException as e:
+                self._parse_slots.release()
+                future.set_exception(e)
+                continue
+
+            endpoint = get_url_endpoint(url) if MAL_STATS.enabled else None
+            parse_future.add_done_callback(partial(self.__complete, future, endpoint))
+
+    def __complete(self, future: Future, endpoint: str, parse_future: Future) -> None:
+        self._parse_slots.release()
+        try:
+            result, seconds = parse_future.result()
+        except BaseException as e:
+            future.set_exception(e)
+            return
+
+        if endpoint is not None:
+            MAL_STATS.observe('mal_parse_duration_seconds', seconds, endpoint=endpoint)
+        future.set_result(result)
+
+
+@contextmanager
+def __use_pipeline(pipeline: FetchParsePipeline):
+    # Batches that weren't given a pipeline get one of their own
+    if pipeline is not None:
+        yield pipeline
+        return
+    with FetchParsePipeline() as pipeline:
+        yield pipeline
+
+
+def __submit_missing(keys, get_cached, submit) -> tuple[dict, dict]:
+    """
+    Return ({key: cached value}, {key: Future}), every key is submitted once.
+    """
+    results = {}
+    futures = {}
+    for key in keys:
+        if key in results or key in futures:
+            continue
+        result = get_cached(key)
+        if result is not None:
+            results[key] = result
+        else:
+            futures[key] = submit(key)
+    return results, futures
+
+
+def __collect(futures: dict, store) -> dict:
+    """
+    Return {key: what 'store' returns for the parsed value}, 'store' caches each value as
+    soon as it's available. A page that failed doesn't stop the others, the first error
+    is raised once every other value was stored.
+    """
+    results = {}
+    errors = []
+    for key, future in futures.items():
+        try:
+            results[key] = store(key, future.result())
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def get_many_anime_details(anime_ids: list, pipeline: FetchParsePipeline = None) -> list[AnimeDetails]:
+    """
+    Batch version of mal_base.get_anime_details, results are in the same order as 'anime_ids'.
+    """
+    def store(anime_id, details: AnimeDetails) -> AnimeDetails:
+        cache_anime_details(anime_id, details)
+        return details
+
+    with __use_pipeline(pipeline) as pipeline:
+        results, futures = __submit_missing(
+            anime_ids,
+            partial(MAL_CACHE.get, CacheKind.AnimeDetails),
+            lambda anime_id : MAL_SINGLE_FLIGHT.submit(
+                (CacheKind.AnimeDetails, str(anime_id)), pipeline.submit, MAL_ANIME_URL_PREFIX + str(anime_id), parse_anime_details)
+        )
+        results.update(__collect(futures, store))
+    return [results[anime_id] for anime_id in anime_ids]
+
+
+def __store_character_voice_actors(character_id, voice_actors: list[VoiceActor]) -> list[VoiceActor]:
+    cache_character_voice_actors(character_id, voice_actors)
+    return voice_actors
+
+
+def __get_known_character_voice_actors(character_id) -> list[VoiceActor]:
+    # Characters that appear with their voice actors in a cached characters list don't need their page
+    return MAL_CACHE.get_known_character_voice_actors((character_id,)).get(character_id)
+
+
+def __submit_character_voice_actors(pipeline: FetchParsePipeline, character_ids: list) -> tuple[dict, dict]:
+    return __submit_missing(
+        character_ids,
+        __get_known_character_voice_actors,
+        lambda character_id : MAL_SINGLE_FLIGHT.submit(
+            (CacheKind.CharacterVoiceActors, str(character_id)),
+            pipeline.submit, MAL_CHARACTER_URL_PREFIX + str(character_id), parse_character_voice_actors)
+    )
+
+
+def get_many_character_voice_actors(character_ids: list, pipeline: FetchParsePipeline = None) -> list[list[VoiceActor]]:
+    """
+    Batch version of mal_base.get_character_voice_actors, results are in the same order as 'character_ids'.
+    """
+    with __use_pipeline(pipeline) as pipeline:
+        results, futures = __submit_character_voice_actors(pipeline, character_ids)
+        results.update(__collect(futures, __store_character_voice_actors))
+    return [results[character_id] for character_id in character_ids]
+
+
+def get_many_anime_character_lists(anime_urls: list[str], pipeline: FetchParsePipeline = None) -> list[list[Character]]:
+    """
+    Batch version of mal_base.get_anime_character_list, results are in the same order as 'anime_urls'.
+    The character pages of characters whose voice actors aren't on the characters page are
+    queued as soon as the characters page is parsed, so the fetcher never waits for them, and
+    each anime is cached as soon as the voice actors of all its characters are known. A page
+    that failed doesn't stop the others, the first error is raised once the rest was cached.
+    Anime that another caller is already downloading (see MAL_SINGLE_FLIGHT) are waited for.
+    """
+    errors = []
+    voice_actors = {}
+    voice_actor_futures = {}
+    # {anime URL: IDs of its characters whose voice actors weren't on its characters page}
+    waiting_anime = {}
+    # {anime URL: Future of its characters page}, for the anime that this batch downloads
+    page_futures = {}
+    # {anime URL: Future of its complete characters list}, what other callers of the same anime wait for
+    completed_futures = {}
+
+    def submit_anime(anime_url: str) -> Future:
+        def submit_page() -> Future:
+            page_futures[anime_url] = pipeline.submit(MAL_BASE_URL + anime_url + '/characters', parse_anime_character_list)
+            completed_futures[anime_url] = Future()
+            return completed_futures[anime_url]
+
+        return MAL_SINGLE_FLIGHT.submit((CacheKind.AnimeCharacters, get_anime_id_from_url(anime_url)), submit_page)
+
+    def get_voice_actors(character_id) -> list[VoiceActor]:
+        if character_id not in voice_actors:
+            voice_actors[character_id] = __store_character_voice_actors(character_id, voice_actor_futures[character_id].result())
+        return voice_actors[character_id]
+
+    def complete_anime(anime_url: str, wait: bool) -> None:
+        missing_character_ids = waiting_anime[anime_url]
+        if not wait and not all(voice_actor_futures[character_id].done() for character_id in missing_character_ids if character_id not in voice_actors):
+            return
+
+        del waiting_anime[anime_url]
+        try:
+            missing_voice_actors = {character_id: get_voice_actors(character_id) for character_id in missing_character_ids}
+        except Exception as e:
+            errors.append(e)
+            results[anime_url] = None
+            completed_futures[anime_url].set_exception(e)
+            return
+
+        for character in results[anime_url]:
+            if character.id in missing_voice_actors:
+                character.voice_actors = missing_voice_actors[character.id]
+        cache_anime_character_list(anime_url, results[anime_url])
+        completed_futures[anime_url].set_result(results[anime_url])
+
+    with __use_pipeline(pipeline) as pipeline:
+        results, futures = __submit_missing(anime_urls, get_cached_anime_character_list, submit_anime)
+        try:
+            for anime_url, page_future in page_futures.items():
+                # None means that the page couldn't be parsed (or MAL refused to serve it), it isn't cached
+                try:
+                    results[anime_url] = page_future.result()
+                    if results[anime_url] is None:
+                        MAL_RATE_LIMITER.record_throttled()
+                except Exception as e:
+                    if not is_suspension_error(e):
+                        errors.append(e)
+                    results[anime_url] = None
+                if results[anime_url] is None:
+                    completed_futures[anime_url].set_result(None)
+                    continue
+
+                missing_character_ids = list(dict.fromkeys(
+                    character.id for character in results[anime_url] if len(character.voice_actors) == 0))
+                cached, submitted = __submit_character_voice_actors(pipeline, [
+                    character_id for character_id in missing_character_ids
+                    if character_id not in voice_actors and character_id not in voice_actor_futures
+                ])
+                voice_actors.update(cached)
+                voice_actor_futures.update(submitted)
+                waiting_anime[anime_url] = missing_character_ids
+
+                # This anime right away if none of its voice actors were missing, and the
+                # anime whose voice actors were downloaded in the meantime
+                for waiting_anime_url in list(waiting_anime):
+                    complete_anime(waiting_anime_url, wait=False)
+
+            for waiting_anime_url in list(waiting_anime):
+                complete_anime(waiting_anime_url, wait=True)
+        finally:
+            # Other callers of an anime that won't be completed (e.g. after Ctrl+C) mustn't wait forever
+            for completed_future in completed_futures.values():
+                if not completed_future.done():
+                    completed_future.set_exception(CancelledError())
+
+        # Anime that other callers were already downloading, they reported errors and suspensions themselves
+        for anime_url, future in futures.items():
+            if anime_url not in page_futures:
+                try:
+                    results[anime_url] = future.result()
+                except Exception as e:
+                    if not is_suspension_error(e):
+                        errors.append(e)
+                    results[anime_url] = None
+
+    if errors:
+        raise errors[0]
+    return [results[anime_url] for anime_url in anime_urls]
+
+
+def search_many_anime(queries: list[str], pipeline: FetchParsePipeline = None) -> list[list[SearchResult]]:
+    """
+    Batch version of mal_search.search_anime, results are in the same order as 'queries'.
+    Queries with the same cache key are searched once, MAL gets the first of them as it was written.
+    """
+    def store(cache_key: str, search_results: list[SearchResult]) -> list[SearchResult]:
+        cache_search_results(original_queries[cache_key], search_results)
+        return search_results
+
+    cache_keys = [get_search_cache_key(query) for query in queries]
+    # {cache key: first query with that key}
+    original_queries = {}
+    for cache_key, query in zip(cache_keys, queries):
+        original_queries.setdefault(cache_key, query)
+
+    with __use_pipeline(pipeline) as pipeline:
+        results, futures = __submit_missing(
+            cache_keys,
+            partial(MAL_CACHE.get, CacheKind.SearchResults),
+            lambda cache_key : MAL_SINGLE_FLIGHT.submit(
+                (CacheKind.SearchResults, cache_key), pipeline.submit, ANIME_SEARCH_URL, parse_search_results, {'q': original_queries[cache_key]})
+        )
+        results.update(__collect(futures, store))
+    return [results[cache_key] for cache_key in cache_keys]
+
+
+if __name__ == '__main__':
+    for details in get_many_anime_details([1, 5, 6]):
+        print(details)
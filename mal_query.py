@@ -0,0 +1,282 @@
+# Columnar, in-memory version of a user's anime list. The list is downloaded once
+# (AnimeListType.AllAnime) and every other view of it (a single status, a different
+# sort order, statistics per genre, ...) is computed locally with NumPy instead of
+# sending another request with different 'status'/'order' parameters.
+import sys
+from datetime import datetime
+import numpy as np
+from mal_common import *
+from mal_base import get_user_anime_list
+
+# {'column': dtype}, missing values are stored as 0
+NUMERIC_COLUMNS = {
+    'status'                : np.int8,
+    'score'                 : np.int8,
+    'num_watched_episodes'  : np.int32,
+    'anime_num_episodes'    : np.int32,
+    'anime_airing_status'   : np.int8,
+    'anime_id'              : np.int64,
+    'is_rewatching'         : np.bool_,
+    'anime_total_members'   : np.int64,
+    'anime_popularity'      : np.int32,
+    'anime_score_val'       : np.float64,
+}
+
+# {'column': dtype}, missing values are stored as NaT
+DATETIME_COLUMNS = {
+    'created_at'                : 'datetime64[s]',
+    'updated_at'                : 'datetime64[s]',
+    'anime_start_date_string'   : 'datetime64[D]',
+    'anime_end_date_string'     : 'datetime64[D]',
+    'start_date_string'         : 'datetime64[D]',
+    'finish_date_string'        : 'datetime64[D]',
+}
+
+# Stored as codes into a sorted list of unique strings, so comparing and sorting codes
+# is the same as comparing and sorting the strings
+STRING_COLUMNS = (
+    'anime_title', 'anime_title_eng', 'anime_media_type_string', 'anime_mpaa_rating_string',
+    'anime_url', 'priority_string', 'storage_string'
+)
+
+# Stored as tuples, see where_contains()
+LIST_COLUMNS = ('genres', 'demographics', 'tags')
+
+# Column that each AnimeListSortBy orders by
+SORT_BY_COLUMNS = {
+    AnimeListSortBy.AnimeTitle      : 'anime_title',
+    AnimeListSortBy.FinishDate      : 'finish_date_string',
+    AnimeListSortBy.StartDate       : 'start_date_string',
+    AnimeListSortBy.Score           : 'score',
+    AnimeListSortBy.LastUpdated     : 'updated_at',
+    AnimeListSortBy.Type            : 'anime_media_type_string',
+    AnimeListSortBy.Rating          : 'anime_mpaa_rating_string',
+    AnimeListSortBy.Priority        : 'priority_string',
+    AnimeListSortBy.WatchedEpisodes : 'num_watched_episodes',
+    AnimeListSortBy.Storage         : 'storage_string',
+    AnimeListSortBy.AirStartDate    : 'anime_start_date_string',
+    AnimeListSortBy.AirEndDate      : 'anime_end_date_string',
+    AnimeListSortBy.Status          : 'status',
+}
+
+
+def parse_list_date(value) -> datetime:
+    # The user's start/finish dates aren't decoded by decode_anime_list_entries
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, AIR_DATE_FORMAT)
+        except ValueError:
+            return None
+    return value
+
+
+class AnimeListTable:
+    """
+    An anime list stored as columns: NumPy arrays for numbers, statuses and dates,
+    codes into interned strings for text. Every query returns a new table, so they
+    can be chained:
+
+        table = get_user_anime_list_table('user')
+        completed = table.of_list_type(AnimeListType.Completed).sort(-AnimeListSortBy.Score, AnimeListSortBy.AnimeTitle)
+        for entry in completed: ...
+        table.aggregate_by('anime_media_type_string', 'score')
+    """
+    def __init__(self, columns: dict, categories: dict, entries: np.ndarray):
+        # {'column': array}, all of the same length
+        self.columns = columns
+
+        # {'string column': [unique strings, sorted]}, shared between all the tables of the same list
+        self.categories = categories
+
+        # The AnimeListEntry of each row
+        self.entries = entries
+
+    @classmethod
+    def from_entries(cls, entries: list[AnimeListEntry]) -> 'AnimeListTable':
+        columns = {}
+        for name, dtype in NUMERIC_COLUMNS.items():
+            columns[name] = np.fromiter((entry[name] or 0 for entry in entries), dtype=dtype, count=len(entries))
+
+        for name, dtype in DATETIME_COLUMNS.items():
+            columns[name] = np.array([parse_list_date(entry[name]) for entry in entries], dtype=dtype)
+
+        categories = {}
+        for name in STRING_COLUMNS:
+            values = [entry[name] or '' for entry in entries]
+            # Case insensitive order, like the list pages
+            categories[name] = [sys.intern(value) for value in sorted(set(values), key=(lambda value : (value.lower(), value)))]
+            codes = {value: code for code, value in enumerate(categories[name])}
+            columns[name] = np.fromiter((codes[value] for value in values), dtype=np.int32, count=len(values))
+
+        for name in LIST_COLUMNS:
+            columns[name] = np.empty(len(entries), dtype=object)
+            columns[name][:] = [tuple(entry[name] or ()) for entry in entries]
+
+        entries_array = np.empty(len(entries), dtype=object)
+        entries_array[:] = entries
+        return cls(columns, categories, entries_array)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        """
+        Return the values of a column, strings are decoded.
+        """
+        if column in self.categories:
+            return np.array(self.categories[column], dtype=object)[self.columns[column]]
+        return self.columns[column]
+
+    def to_entries(self) -> list[AnimeListEntry]:
+        return list(self.entries)
+
+    def take(self, rows) -> 'AnimeListTable':
+        """
+        Return a table of the given rows (a boolean mask or indices) of this one.
+        """
+        return AnimeListTable({name: values[rows] for name, values in self.columns.items()}, self.categories, self.entries[rows])
+
+    def filter(self, mask: np.ndarray) -> 'AnimeListTable':
+        return self.take(mask)
+
+    def where(self, **conditions) -> 'AnimeListTable':
+        """
+        Keep rows whose columns match all the conditions. A condition is either a value,
+        a list/tuple/set of values or a function that takes the column's array and returns a mask.
+        String columns are compared as strings.
+        """
+        mask = np.ones(len(self), dtype=np.bool_)
+        for column, condition in conditions.items():
+            values = self.columns[column]
+            if callable(condition):
+                mask &= condition(self[column])
+            elif isinstance(condition, (list, tuple, set, frozenset)):
+                mask &= np.isin(values, [self.__encode(column, value) for value in condition])
+            else:
+                mask &= values == self.__encode(column, condition)
+        return self.take(mask)
+
+    def where_contains(self, column: str, value) -> 'AnimeListTable':
+        """
+        Keep rows whose list column (see LIST_COLUMNS) contains the given value, e.g. where_contains('genres', 'Drama').
+        """
+        return self.take(np.fromiter((value in values for values in self.columns[column]), dtype=np.bool_, count=len(self)))
+
+    def of_list_type(self, list_type: int) -> 'AnimeListTable':
+        """
+        The same rows as the list page of the given AnimeListType.
+        """
+        if list_type == AnimeListType.AllAnime:
+            return self
+        return self.take(self.columns['status'] == list_type)
+
+    def sort(self, *sort_keys) -> 'AnimeListTable':
+        """
+        Sort by one or more keys, most significant first. A key is either an AnimeListSortBy
+        (negated for a reversed order, like the 'order' parameters of the list pages) or
+        a column name (prefixed with '-' for a reversed order). The sort is stable.
+        """
+        keys = []
+        for sort_key in sort_keys:
+            if isinstance(sort_key, str):
+                reverse = sort_key.startswith('-')
+                column = sort_key.lstrip('-')
+            else:
+                reverse = sort_key < 0
+                column = SORT_BY_COLUMNS.get(abs(sort_key))
+                if column is None:
+                    raise Exception(f'Sorting by {abs(sort_key)} isn\'t supported, the list entries have no such field')
+
+            values = self.columns[column]
+            if values.dtype.kind == 'M':
+                values = values.view(np.int64)
+            elif values.dtype.kind == 'O':
+                raise Exception(f'Can\'t sort by the list column "{column}"')
+            values = values.astype(np.float64)
+            keys.append(-values if reverse else values)
+
+        if not keys:
+            return self
+        # lexsort sorts by the last key first
+        return self.take(np.lexsort(keys[::-1]))
+
+    def group_by(self, column: str) -> dict:
+        """
+        Return {value of the column: table of the rows with that value}.
+        """
+        unique_values, inverse = np.unique(self.columns[column], return_inverse=True)
+        return {self.__decode(column, value): self.take(inverse == index) for index, value in enumerate(unique_values)}
+
+    def aggregate_by(self, column: str, value_column: str = None, ignore_zeros: bool = True) -> dict:
+        """
+        Return {value of the column: {'count', 'sum', 'mean', 'min', 'max'}} of 'value_column' per
+        group (only 'count' if it's not given). Zeros are left out of the statistics if
+        'ignore_zeros' is set, so unscored anime don't drag the mean score down.
+        """
+        unique_values, inverse = np.unique(self.columns[column], return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(unique_values))
+        if value_column is None:
+            return {self.__decode(column, value): {'count': int(count)} for value, count in zip(unique_values, counts)}
+
+        values = self.columns[value_column].astype(np.float64)
+        used = values != 0 if ignore_zeros else np.ones(len(values), dtype=np.bool_)
+        used_counts = np.bincount(inverse, weights=used, minlength=len(unique_values))
+        sums = np.bincount(inverse, weights=np.where(used, values, 0), minlength=len(unique_values))
+        minimums = np.full(len(unique_values), np.inf)
+        maximums = np.full(len(unique_values), -np.inf)
+        np.minimum.at(minimums, inverse[used], values[used])
+        np.maximum.at(maximums, inverse[used], values[used])
+
+        result = {}
+        for index, value in enumerate(unique_values):
+            has_values = used_counts[index] > 0
+            result[self.__decode(column, value)] = {
+                'count' : int(counts[index]),
+                'sum'   : float(sums[index]),
+                'mean'  : float(sums[index] / used_counts[index]) if has_values else None,
+                'min'   : float(minimums[index]) if has_values else None,
+                'max'   : float(maximums[index]) if has_values else None,
+            }
+        return result
+
+    def mean(self, column: str, ignore_zeros: bool = True) -> float:
+        values = self.columns[column].astype(np.float64)
+        if ignore_zeros:
+            values = values[values != 0]
+        return float(values.mean()) if len(values) else None
+
+    def sum(self, column: str) -> float:
+        return self.columns[column].sum().item()
+
+    def __encode(self, column: str, value):
+        if column not in self.categories:
+            return value
+        # Strings that don't appear in the list match nothing
+        try:
+            return self.categories[column].index(value)
+        except ValueError:
+            return -1
+
+    def __decode(self, column: str, value):
+        if column in self.categories:
+            return self.categories[column][value]
+        return value.item() if isinstance(value, np.generic) else value
+
+
+def get_user_anime_list_table(mal_user_name: str) -> AnimeListTable:
+    """
+    Download (or load from the cache) the whole list of the user once, as a table.
+    """
+    return AnimeListTable.from_entries(get_user_anime_list(mal_user_name, AnimeListType.AllAnime))
+
+
+if __name__ == '__main__':
+    table = get_user_anime_list_table(input('Enter MAL username: '))
+    print('Mean score:', table.mean('score'))
+    for media_type, statistics in table.of_list_type(AnimeListType.Completed).aggregate_by('anime_media_type_string', 'score').items():
+        print(media_type, statistics)
+    for entry in table.sort(-AnimeListSortBy.Score, AnimeListSortBy.AnimeTitle).to_entries()[:10]:
+        print(entry.score, entry.anime_title)
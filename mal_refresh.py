@@ -0,0 +1,123 @@
+# Background refresh of cached entries. While a CacheRefresher is running, MAL_CACHE
+# serves entries that recently expired instead of downloading them again on the spot
+# (stale-while-revalidate), and the refresher downloads them again whenever the rate
+# limiter has nothing else to do, starting with the stale entries that were served,
+# then entries that are about to expire, the most read ones first.
+#
+#   with CacheRefresher():
+#       generate_va_relationships(...)
+import sys
+from threading import Event, Thread
+from time import time
+from mal_common import CacheKind, MAL_RATE_LIMITER
+from mal_cache import MAL_CACHE
+from mal_stats import MAL_STATS
+from mal_base import refresh_anime_character_list, refresh_character_voice_actors, refresh_anime_details
+from mal_search import refresh_search_results
+
+# Entries that expire within this many days are refreshed ahead of time
+REFRESH_AHEAD_IN_DAYS = 7
+# Number of expiring entries of each kind that are considered at a time
+REFRESH_CANDIDATE_COUNT = 100
+# How long to wait before looking for expiring entries again when there are none
+IDLE_POLL_INTERVAL = 30 # seconds
+# How long to stop refreshing after a refresh failed (e.g. the IP was suspended)
+REFRESH_ERROR_BACKOFF = 5 * 60 # seconds
+
+# {CacheKind: function that downloads the entry of a key again and caches it}
+REFRESH_FUNCTIONS = {
+    # Any name works in the URL of an anime, MAL redirects to the right one
+    CacheKind.AnimeCharacters       : lambda anime_id : refresh_anime_character_list(f'/anime/{anime_id}/_'),
+    CacheKind.CharacterVoiceActors  : refresh_character_voice_actors,
+    CacheKind.AnimeDetails          : refresh_anime_details,
+    CacheKind.SearchResults         : refresh_search_results,
+}
+
+
+class CacheRefresher:
+    """
+    Thread that refreshes MAL_CACHE entries using only idle request slots: it sends
+    a request only when nothing else reserved the rate limiter, so at most one
+    refresh request is ever in front of the requests of the program itself.
+    """
+    def __init__(self, refresh_ahead_in_days: float = REFRESH_AHEAD_IN_DAYS):
+        self.refresh_ahead_in_days = refresh_ahead_in_days
+        self._stopped = Event()
+        self._thread = None
+        # [(kind, key), ...] of the expiring entries that weren't refreshed yet, next one last
+        self._candidates = []
+        # Keys that were already refreshed (or failed) in this run
+        self._attempted = set()
+
+    def __enter__(self) -> 'CacheRefresher':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        MAL_CACHE.serve_stale = True
+        self._stopped.clear()
+        self._thread = Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        MAL_CACHE.serve_stale = False
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def refresh_next(self) -> bool:
+        """
+        Refresh the entry that needs it the most, return False if no entry needs to be refreshed.
+        """
+        # Stale entries that were served are refreshed even if they were refreshed before in this run
+        stale_keys = [stale_key for stale_key in MAL_CACHE.pop_stale_keys() if stale_key[0] in REFRESH_FUNCTIONS]
+        self._candidates += reversed(stale_keys)
+        if not self._candidates:
+            self.__find_candidates()
+        if not self._candidates:
+            return False
+
+        kind, key = self._candidates.pop()
+        self._attempted.add((kind, key))
+        try:
+            result = REFRESH_FUNCTIONS[kind](key)
+        except Exception as e:
+            result = None
+            print(f'Failed to refresh {kind} {key}: {e}', file=sys.stderr)
+
+        # Parsers return None when the page has no content, which usually means that the IP was suspended
+        MAL_STATS.increment('mal_cache_refreshes_total', kind=kind, result='failed' if result is None else 'refreshed')
+        if result is None:
+            self._stopped.wait(REFRESH_ERROR_BACKOFF)
+        return True
+
+    def __find_candidates(self) -> None:
+        until = time() + self.refresh_ahead_in_days * 24 * 60 * 60
+        candidates = []
+        for kind in REFRESH_FUNCTIONS:
+            candidates += [
+                (kind, key, expires_at) for key, expires_at in MAL_CACHE.get_expiring_keys(kind, until, REFRESH_CANDIDATE_COUNT)
+                if (kind, key) not in self._attempted
+            ]
+
+        # The most read entries first, then the ones that expire first (popped from the end)
+        candidates.sort(key=(lambda candidate : (-MAL_CACHE.get_read_count(candidate[0], candidate[1]), candidate[2])), reverse=True)
+        self._candidates = [(kind, key) for kind, key, _ in candidates]
+
+    def __run(self) -> None:
+        while not self._stopped.is_set():
+            if not MAL_RATE_LIMITER.is_idle():
+                self._stopped.wait(MAL_RATE_LIMITER.interval)
+            elif not self.refresh_next():
+                self._stopped.wait(IDLE_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    # Refresh everything that expires soon right away
+    refresher = CacheRefresher()
+    while refresher.refresh_next():
+        pass
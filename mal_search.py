@@ -1,8 +1,11 @@
 import re
-import requests
 from bs4 import BeautifulSoup
-from mal_common import EntryContainer
-from mal_base import mal_request
+from mal_common import SearchResult, CacheKind, ParserBackend, MAL_SINGLE_FLIGHT, get_parser_backend
+from mal_http import get_html
+from mal_cache import MAL_CACHE
+from mal_stats import Endpoint, timed_parser
+from mal_title_index import MAL_TITLE_INDEX, CONFIDENT_MATCH_SCORE, TitleMatch
+import mal_lxml
 
 ANIME_SEARCH_URL = r'https://myanimelist.net/anime.php?cat=anime&c[]=a&c[]=b&c[]=c&c[]=d&c[]=e&c[]=f&c[]=g'
 
@@ -10,9 +13,68 @@ link_to_id = lambda link: int(re.search(r'/anime/(\d+)/', link)[1])
 str_to_int = lambda s: int(s.replace(',', ''))
 
 
-def search_anime(query: str) -> list[EntryContainer]:
-    with mal_request():
-        response_html = requests.get(ANIME_SEARCH_URL, params={'q':query}).content.decode()
+def search_anime(query: str) -> list[SearchResult]:
+    result = MAL_CACHE.get(CacheKind.SearchResults, get_search_cache_key(query))
+    if result is not None:
+        return result
+
+    return MAL_SINGLE_FLIGHT.run((CacheKind.SearchResults, get_search_cache_key(query)), __download_search_results, query)
+
+
+def refresh_search_results(query: str) -> list[SearchResult]:
+    return MAL_SINGLE_FLIGHT.run((CacheKind.SearchResults, get_search_cache_key(query)), __download_search_results, query, False)
+
+
+def __download_search_results(query: str, use_cache: bool = True) -> list[SearchResult]:
+    result = MAL_CACHE.get(CacheKind.SearchResults, get_search_cache_key(query)) if use_cache else None
+    if result is not None:
+        return result
+
+    result = parse_search_results(get_html(ANIME_SEARCH_URL, params={'q':query}))
+    cache_search_results(query, result)
+
+    return result
+
+
+def cache_search_results(query: str, search_results: list[SearchResult]) -> None:
+    MAL_CACHE.put(CacheKind.SearchResults, get_search_cache_key(query), search_results)
+    MAL_TITLE_INDEX.add_search_results(search_results)
+
+
+def find_anime(query: str, limit: int = 10, min_score: float = CONFIDENT_MATCH_SCORE) -> list[TitleMatch]:
+    """
+    Return the anime whose titles match the query best, from the local title index.
+    MAL is searched only if the best local match scores less than 'min_score',
+    its results are added to the index and the index is searched again.
+    """
+    matches = MAL_TITLE_INDEX.search(query, limit)
+    if matches and matches[0].score >= min_score:
+        return matches
+
+    # Results that were cached before they were indexed are added here
+    MAL_TITLE_INDEX.add_search_results(search_anime(query))
+    return MAL_TITLE_INDEX.search(query, limit)
+
+
+def resolve_anime_id(title: str, min_score: float = CONFIDENT_MATCH_SCORE) -> int:
+    """
+    Return the ID of the anime with the given title, or None if nothing matches it well enough.
+    """
+    matches = find_anime(title, 1, min_score)
+    if matches and matches[0].score >= min_score:
+        return matches[0].anime_id
+    return None
+
+
+def get_search_cache_key(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+
+@timed_parser(Endpoint.Search)
+def parse_search_results(response_html: str) -> list[SearchResult]:
+    if get_parser_backend() == ParserBackend.Lxml:
+        return mal_lxml.parse_search_results(response_html)
+
     soup = BeautifulSoup(response_html, features='lxml')
     data = soup.select('.js-categories-seasonal > table:nth-child(1) > tr')[1:] # Skip first row (header row)
 
@@ -20,7 +82,7 @@ def search_anime(query: str) -> list[EntryContainer]:
     for search_result in data:
         # Parse title and id
         title_data = search_result.select('td:nth-child(2) > div:nth-child(1) > a:nth-child(2)')[0]
-        title = title_data.strong.contents[0]
+        title = str(title_data.strong.contents[0])
         anime_id = link_to_id(title_data['href'])
 
         # Parse additional info
@@ -31,7 +93,7 @@ def search_anime(query: str) -> list[EntryContainer]:
         score = 0 if score=='N/A' else float(score)
         num_users = str_to_int(num_users)
 
-        results.append(EntryContainer({
+        results.append(SearchResult({
             'title': title,
             'id': anime_id,
             'type': anime_type,
@@ -0,0 +1,211 @@
+import re
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds (in seconds) of the latency histogram buckets
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# {'metric name': ('metric type', 'description'), ...}
+METRICS = {
+    'mal_requests_total'                : ('counter',   'Requests sent, by endpoint and HTTP status'),
+    'mal_request_retries_total'         : ('counter',   'Requests that were retried, by endpoint'),
+    'mal_request_errors_total'          : ('counter',   'Requests that failed with a connection error or timeout, by endpoint'),
+    'mal_not_modified_total'            : ('counter',   'Conditional requests answered with 304 Not Modified, by endpoint'),
+    'mal_response_bytes_total'          : ('counter',   'Bytes of response bodies received, by endpoint'),
+    'mal_request_duration_seconds'      : ('histogram', 'Time from sending a request until its body was downloaded, by endpoint'),
+    'mal_rate_limiter_wait_seconds'     : ('histogram', 'Time spent waiting for the rate limiter, by endpoint'),
+    'mal_rate_limiter_slowdowns_total'  : ('counter',   'Times the shared request interval was increased, by reason (throttled, slow_response or suspended)'),
+    'mal_parse_duration_seconds'        : ('histogram', 'Time spent parsing responses, by endpoint'),
+    'mal_cache_lookups_total'           : ('counter',   'Cache lookups by entity kind and the tier that answered (memory, database or miss)'),
+    'mal_cache_stale_total'             : ('counter',   'Cache lookups that found an expired entry, by entity kind'),
+    'mal_cache_stale_served_total'      : ('counter',   'Expired entries that were served while waiting to be refreshed, by entity kind'),
+    'mal_cache_writes_total'            : ('counter',   'Cache writes, by entity kind'),
+    'mal_cache_refreshes_total'         : ('counter',   'Entries refreshed in the background, by entity kind and result (refreshed or failed)'),
+    'mal_coalesced_requests_total'      : ('counter',   'Fetches that joined an identical fetch already in flight, by entity kind'),
+}
+
+
+class Endpoint:
+    List        = 'list'
+    Characters  = 'characters'
+    Character   = 'character'
+    Details     = 'details'
+    Search      = 'search'
+    ApiV2       = 'api_v2'
+    Image       = 'image'
+    Other       = 'other'
+
+
+ENDPOINT_URL_PATTERNS = (
+    (re.compile(r'^https?://api\.myanimelist\.net/v2/'),    Endpoint.ApiV2),
+    (re.compile(r'^https?://cdn\.myanimelist\.net/'),       Endpoint.Image),
+    (re.compile(r'/animelist/'),                            Endpoint.List),
+    (re.compile(r'/anime/\d+/[^/?]*/characters'),           Endpoint.Characters),
+    (re.compile(r'/character/\d+'),                         Endpoint.Character),
+    (re.compile(r'/anime\.php'),                            Endpoint.Search),
+    (re.compile(r'/anime/\d+'),                             Endpoint.Details),
+)
+
+
+def get_url_endpoint(url: str) -> str:
+    for pattern, endpoint in ENDPOINT_URL_PATTERNS:
+        if pattern.search(url):
+            return endpoint
+    return Endpoint.Other
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(HISTOGRAM_BUCKETS) + 1) # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: 'Histogram') -> None:
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, other.bucket_counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum, 'mean': (self.sum / self.count) if self.count else 0.0}
+
+
+class MalStats:
+    """
+    Counters and latency histograms of requests, the rate limiter, parsing and the cache.
+    Disabled by default, in which case every method returns immediately. Instrumented
+    code should check 'enabled' before measuring anything so that it costs nothing
+    when the stats aren't collected.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = Lock()
+        # {('metric name', (('label', 'value'), ...)): number or Histogram}
+        self._values = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def increment(self, metric_name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (metric_name, tuple(sorted((name, str(label)) for name, label in labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, metric_name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (metric_name, tuple(sorted((name, str(label)) for name, label in labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = Histogram()
+            histogram.observe(value)
+
+    def get_counter(self, metric_name: str, **labels) -> float:
+        """
+        Return the sum of the counter over all label sets that match the given labels.
+        """
+        return sum(self.__matching_values(metric_name, labels)) or 0
+
+    def get_histogram(self, metric_name: str, **labels) -> dict:
+        """
+        Return {'count', 'sum', 'mean'} of the histogram over all label sets that match the given labels.
+        """
+        merged_histogram = Histogram()
+        for histogram in self.__matching_values(metric_name, labels):
+            merged_histogram.merge(histogram)
+        return merged_histogram.to_dict()
+
+    def snapshot(self) -> dict:
+        """
+        Return {'metric name': [{'labels': {...}, 'value': number or histogram dict}, ...], ...}
+        """
+        result = {}
+        with self._lock:
+            for (metric_name, labels), value in sorted(self._values.items()):
+                result.setdefault(metric_name, []).append({
+                    'labels': dict(labels),
+                    'value': value.to_dict() if isinstance(value, Histogram) else value
+                })
+        return result
+
+    def to_prometheus(self) -> str:
+        """
+        Return all the metrics in Prometheus' text exposition format.
+        """
+        lines = []
+        with self._lock:
+            values = sorted(self._values.items())
+
+        previous_metric_name = None
+        for (metric_name, labels), value in values:
+            if metric_name != previous_metric_name:
+                metric_type, description = METRICS.get(metric_name, ('untyped', ''))
+                lines.append(f'# HELP {metric_name} {description}')
+                lines.append(f'# TYPE {metric_name} {metric_type}')
+                previous_metric_name = metric_name
+
+            if isinstance(value, Histogram):
+                cumulative_count = 0
+                for bucket, bucket_count in zip(HISTOGRAM_BUCKETS + ('+Inf',), value.bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f'{metric_name}_bucket{format_prometheus_labels(labels + (("le", str(bucket)),))} {cumulative_count}')
+                lines.append(f'{metric_name}_sum{format_prometheus_labels(labels)} {value.sum}')
+                lines.append(f'{metric_name}_count{format_prometheus_labels(labels)} {value.count}')
+            else:
+                lines.append(f'{metric_name}{format_prometheus_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def __matching_values(self, metric_name: str, labels: dict) -> list:
+        wanted_labels = {(name, str(label)) for name, label in labels.items()}
+        with self._lock:
+            return [
+                value for (name, value_labels), value in self._values.items()
+                if name == metric_name and wanted_labels.issubset(value_labels)
+            ]
+
+
+def format_prometheus_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped_labels = (
+        (name, value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')) for name, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped_labels) + '}'
+
+
+MAL_STATS = MalStats()
+
+
+def timed_parser(endpoint: str):
+    """
+    Decorator that records the duration of a parse_* function under the given endpoint.
+    """
+    def decorator(parser):
+        @wraps(parser)
+        def wrapper(*args, **kwargs):
+            if not MAL_STATS.enabled:
+                return parser(*args, **kwargs)
+
+            start = perf_counter()
+            try:
+                return parser(*args, **kwargs)
+            finally:
+                MAL_STATS.observe('mal_parse_duration_seconds', perf_counter() - start, endpoint=endpoint)
+        return wrapper
+    return decorator
@@ -0,0 +1,127 @@
+# Local cache of character images, downscaled to the box they're displayed in by the
+# voice actor reports. Thumbnails are named by the SHA-256 of the downloaded image, so
+# the same picture behind different links is stored once, and the link -> thumbnail
+# mapping is kept in MAL_CACHE so re-rendering a report doesn't download anything.
+import base64
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os.path import dirname, join, isfile, splitext
+from threading import Event
+from urllib.parse import urlparse
+import requests
+from mal_common import RateLimiter, CacheKind, atomic_write
+from mal_http import send_request
+from mal_cache import MAL_CACHE
+
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow images are stored the way they were downloaded
+    Image = None
+
+THUMBNAIL_DIRECTORY = join(dirname(__file__), 'cache', 'thumbnails')
+# Same as max-width/max-height of images in character_va_relationship_template.html
+THUMBNAIL_SIZE = (84, 124)
+THUMBNAIL_JPEG_QUALITY = 85
+MAX_CONCURRENT_IMAGE_DOWNLOADS = 4
+# Images are served by MAL's CDN rather than the site itself, so they have a budget of their own
+IMAGE_REQUEST_INTERVAL = 0.1 # seconds
+IMAGE_RATE_LIMITER = RateLimiter(IMAGE_REQUEST_INTERVAL)
+# Images are optional, an unreachable CDN should be noticed after one short attempt rather than after all of send_request()'s retries
+IMAGE_REQUEST_TIMEOUT = 5 # seconds
+IMAGE_MAX_RETRIES = 0
+
+IMAGE_MIME_TYPES = {
+    '.jpg'  : 'image/jpeg',
+    '.jpeg' : 'image/jpeg',
+    '.png'  : 'image/png',
+    '.webp' : 'image/webp',
+    '.gif'  : 'image/gif',
+}
+
+
+def make_thumbnail(image_data: bytes) -> bytes:
+    """
+    Return the image downscaled to fit THUMBNAIL_SIZE as a JPEG, or None if it isn't an image.
+    """
+    try:
+        image = Image.open(BytesIO(image_data))
+        image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        thumbnail_data = BytesIO()
+        image.save(thumbnail_data, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    return thumbnail_data.getvalue()
+
+
+def get_thumbnail_path(thumbnail_file_name: str) -> str:
+    return join(THUMBNAIL_DIRECTORY, thumbnail_file_name)
+
+
+def get_thumbnails(image_links) -> dict:
+    """
+    Return {image link: path of its thumbnail}, downloading the images that weren't
+    downloaded before (several at a time, within IMAGE_RATE_LIMITER). Images that
+    couldn't be downloaded map to None.
+    """
+    result = {}
+    missing_image_links = []
+    for image_link in dict.fromkeys(image_links):
+        if not image_link:
+            continue
+        thumbnail_file_name = MAL_CACHE.get(CacheKind.ImageThumbnails, image_link)
+        if thumbnail_file_name is not None and isfile(get_thumbnail_path(thumbnail_file_name)):
+            result[image_link] = get_thumbnail_path(thumbnail_file_name)
+        else:
+            missing_image_links.append(image_link)
+
+    if missing_image_links:
+        os.makedirs(THUMBNAIL_DIRECTORY, exist_ok=True)
+        # Once the CDN can't be reached (e.g. offline) the rest of the images aren't even tried
+        unreachable = Event()
+        with ThreadPoolExecutor(max_workers=min(len(missing_image_links), MAX_CONCURRENT_IMAGE_DOWNLOADS)) as executor:
+            result.update(zip(missing_image_links, executor.map(
+                lambda image_link : __download_thumbnail(image_link, unreachable), missing_image_links)))
+
+    return result
+
+
+def get_thumbnail_data_uri(thumbnail_path: str) -> str:
+    with open(thumbnail_path, 'rb') as thumbnail_file:
+        thumbnail_data = thumbnail_file.read()
+    mime_type = IMAGE_MIME_TYPES.get(splitext(thumbnail_path)[1].lower(), 'application/octet-stream')
+    return f'data:{mime_type};base64,{base64.b64encode(thumbnail_data).decode()}'
+
+
+def __download_thumbnail(image_link: str, unreachable: Event) -> str:
+    if unreachable.is_set():
+        return None
+    try:
+        response = send_request('GET', image_link, rate_limiter=IMAGE_RATE_LIMITER, max_retries=IMAGE_MAX_RETRIES, timeout=IMAGE_REQUEST_TIMEOUT)
+    except requests.RequestException:
+        unreachable.set()
+        return None
+    if response.status_code != 200:
+        return None
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if Image is not None:
+        thumbnail_file_name = content_hash + '.jpg'
+    else:
+        thumbnail_file_name = content_hash + (splitext(urlparse(image_link).path)[1].lower() or '.jpg')
+
+    # Another link to the same image was downloaded before
+    thumbnail_path = get_thumbnail_path(thumbnail_file_name)
+    if not isfile(thumbnail_path):
+        thumbnail_data = make_thumbnail(response.content) if Image is not None else response.content
+        if thumbnail_data is None:
+            return None
+        atomic_write(thumbnail_path, thumbnail_data, 'wb')
+
+    MAL_CACHE.put(CacheKind.ImageThumbnails, image_link, thumbnail_file_name)
+    return thumbnail_path
@@ -0,0 +1,172 @@
+# Local fuzzy search over every anime title that was seen while scraping (search
+# results, lists and the synonyms of anime details), so resolving a title to an
+# anime ID usually doesn't need a request to anime.php. See find_anime() in mal_search.
+import re
+import unicodedata
+from collections import Counter
+from threading import Lock
+from mal_common import Record, AnimeListEntry, AnimeDetails, SearchResult
+from mal_cache import MAL_CACHE
+
+# Matches with at least this score are trusted without asking MAL
+CONFIDENT_MATCH_SCORE = 0.8
+# Titles that score less than this aren't returned at all
+MIN_MATCH_SCORE = 0.3
+NON_WORD_REGEX = re.compile(r'[\W_]+')
+
+
+class TitleMatch(Record):
+    __slots__ = ('anime_id', 'title', 'score')
+
+
+def normalize_title(title: str) -> str:
+    # Case, accents and punctuation are ignored
+    title = unicodedata.normalize('NFKD', title.lower())
+    title = ''.join(character for character in title if not unicodedata.combining(character))
+    return NON_WORD_REGEX.sub(' ', title).strip()
+
+
+def get_trigrams(normalized_title: str) -> set[str]:
+    # Words are padded so that their first and last letters are part of a trigram of their own.
+    # Unlike PostgreSQL's pg_trgm there's no '  x' trigram, it matches a large part of all titles.
+    trigrams = set()
+    for word in normalized_title.split():
+        padded_word = f' {word} '
+        trigrams.update(padded_word[i:i + 3] for i in range(len(padded_word) - 2))
+    return trigrams
+
+
+class TitleIndex:
+    """
+    Trigram inverted index over anime titles. Titles are persisted in MAL_CACHE's
+    database and loaded the first time the index is searched, so the index keeps
+    growing across runs and is shared by every process that uses the same cache.
+
+    Matches are scored with the Dice coefficient of the trigrams of the query and
+    the title (1 means the same title, ignoring case, accents and punctuation).
+    """
+    def __init__(self):
+        self._lock = Lock()
+        # Path of the database the index was loaded from, None if it wasn't loaded yet
+        self._database_path = None
+
+        self._titles = []           # [(anime_id, title, number of trigrams), ...]
+        self._known_titles = set()  # {(anime_id, title), ...}
+        self._exact_titles = {}     # {normalized title: [index in _titles, ...]}
+        self._postings = {}         # {trigram: [index in _titles, ...]}
+
+    def __len__(self) -> int:
+        self.__ensure_loaded()
+        return len(self._titles)
+
+    def add_titles(self, anime_titles) -> None:
+        """
+        Add (anime_id, title) pairs to the database, and to the index if it was
+        already loaded (otherwise they're loaded with the rest on the first search).
+        """
+        new_titles = list(dict.fromkeys((int(anime_id), title) for anime_id, title in anime_titles if title))
+        with self._lock:
+            if self.__is_loaded():
+                new_titles = [anime_title for anime_title in new_titles if anime_title not in self._known_titles]
+        if not new_titles:
+            return
+
+        MAL_CACHE.put_anime_titles(new_titles)
+        # A search may have loaded the index since, with or without these titles
+        with self._lock:
+            if self.__is_loaded():
+                for anime_id, title in new_titles:
+                    if (anime_id, title) not in self._known_titles:
+                        self.__add_title(anime_id, title)
+
+    def add_search_results(self, search_results: list[SearchResult]) -> None:
+        self.add_titles((result.id, result.title) for result in search_results)
+
+    def add_list_entries(self, entries: list[AnimeListEntry]) -> None:
+        self.add_titles(
+            (entry.anime_id, title) for entry in entries for title in (entry.anime_title, entry.anime_title_eng))
+
+    def add_anime_details(self, anime_id, details: AnimeDetails) -> None:
+        self.add_titles(
+            (anime_id, title) for title in [details.title, details.english, details.japanese] + list(details.synonyms or ()))
+
+    def search(self, query: str, limit: int = 10, min_score: float = MIN_MATCH_SCORE) -> list[TitleMatch]:
+        """
+        Return up to 'limit' anime whose titles are the most similar to the query,
+        best first, with the best matching title of each anime.
+        """
+        self.__ensure_loaded()
+        normalized_query = normalize_title(query)
+        query_trigrams = get_trigrams(normalized_query)
+        if not query_trigrams:
+            return []
+
+        with self._lock:
+            common_trigram_counts = Counter()
+            for trigram in query_trigrams:
+                common_trigram_counts.update(self._postings.get(trigram, ()))
+
+            # A title with 'n' trigrams in common can't score more than 2n / (len(query_trigrams) + n),
+            # so titles with too few common trigrams are skipped without calculating their score
+            min_common_trigram_count = min_score * len(query_trigrams) / (2 - min_score)
+            scores = []
+            for title_index, common_trigram_count in common_trigram_counts.items():
+                if common_trigram_count >= min_common_trigram_count:
+                    score = 2 * common_trigram_count / (len(query_trigrams) + self._titles[title_index][2])
+                    if score >= min_score:
+                        scores.append((score, title_index))
+            scores += [(1.0, title_index) for title_index in self._exact_titles.get(normalized_query, ())]
+            scores.sort(reverse=True)
+
+            # Keep the best title of each anime
+            best_matches = {}
+            for score, title_index in scores:
+                anime_id, title, _ = self._titles[title_index]
+                if anime_id not in best_matches:
+                    best_matches[anime_id] = TitleMatch(anime_id=anime_id, title=title, score=score)
+                    if len(best_matches) == limit:
+                        break
+
+        return list(best_matches.values())
+
+    def __is_loaded(self) -> bool:
+        return self._database_path == MAL_CACHE.database_path
+
+    def __ensure_loaded(self) -> None:
+        if self.__is_loaded():
+            return
+
+        # Loaded while holding the lock, so that titles added meanwhile are either read here or added by add_titles()
+        with self._lock:
+            database_path = MAL_CACHE.database_path
+            if self._database_path == database_path:
+                return
+            anime_titles = MAL_CACHE.get_anime_titles()
+            self._titles.clear()
+            self._known_titles.clear()
+            self._exact_titles.clear()
+            self._postings.clear()
+            for anime_id, title in anime_titles:
+                if (int(anime_id), title) not in self._known_titles:
+                    self.__add_title(int(anime_id), title)
+            self._database_path = database_path
+
+    def __add_title(self, anime_id: int, title: str) -> None:
+        normalized_title = normalize_title(title)
+        trigrams = get_trigrams(normalized_title)
+        title_index = len(self._titles)
+        self._titles.append((anime_id, title, len(trigrams)))
+        self._known_titles.add((anime_id, title))
+        self._exact_titles.setdefault(normalized_title, []).append(title_index)
+        for trigram in trigrams:
+            self._postings.setdefault(trigram, []).append(title_index)
+
+
+MAL_TITLE_INDEX = TitleIndex()
+
+
+if __name__ == '__main__':
+    print(len(MAL_TITLE_INDEX), 'titles')
+    while True:
+        for match in MAL_TITLE_INDEX.search(input('Search: ')):
+            print(f'{match.score:.2f} {match.anime_id} {match.title}')
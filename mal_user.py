@@ -1,32 +1,164 @@
 from mal_base import *
+from mal_http import send_request
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+from threading import Lock, Thread
+from time import time
 import re
+import sys
 import json
-import requests
 import secrets
 
+MAL_API_URL = 'https://api.myanimelist.net/v2/'
+MAL_OAUTH_TOKEN_URL = MAL_BASE_URL + '/v1/oauth2/token'
+# The access token is refreshed in the background once it has less than this many seconds left,
+# and synchronously (blocking every request) once it has less than TOKEN_EXPIRY_MARGIN left
+TOKEN_REFRESH_MARGIN = 600 # seconds
+TOKEN_EXPIRY_MARGIN = 30 # seconds
+# Token requests aren't retried, codes and refresh tokens are single use, so a retry after a
+# response that was lost would be rejected anyway (and holds _tokens_lock through the backoff)
+TOKEN_REQUEST_MAX_RETRIES = 0
+# Maximum page size of the list endpoints of the API
+API_LIST_PAGE_SIZE = 1000
+# Number of list updates that are sent at the same time, all of them still share MAL_RATE_LIMITER
+MAX_CONCURRENT_LIST_UPDATES = 4
+
+# Names of the list statuses in the API
+API_ANIME_STATUS_NAMES = {
+    AnimeStatus.Watching    : 'watching',
+    AnimeStatus.Completed   : 'completed',
+    AnimeStatus.OnHold      : 'on_hold',
+    AnimeStatus.Dropped     : 'dropped',
+    AnimeStatus.PlanToWatch : 'plan_to_watch',
+}
+
+# Fields that can be changed through anime/{anime_id}/my_list_status
+API_LIST_STATUS_FIELDS = (
+    'status', 'is_rewatching', 'score', 'num_watched_episodes', 'priority',
+    'num_times_rewatched', 'rewatch_value', 'tags', 'comments'
+)
+
 
 class MyAnimeListUser:
     def __init__(self, client_id: str, mal_tokens_file_path: str):
         self._client_id = client_id
         self._tokens_file_path = mal_tokens_file_path
+        # Held while the tokens are refreshed, so that only one thread refreshes them at a time
+        self._tokens_lock = Lock()
+        # Guards starting the background refresh, never held during a request
+        self._background_refresh_lock = Lock()
+        self._background_refresh = None
+        # time() at which the access token expires, None if unknown
+        self._access_token_expires_at = None
+
         if not path.isfile(mal_tokens_file_path):
             self._generate_tokens()
         else:
             with open(self._tokens_file_path) as f:
-                self._update_tokens(json.load(f), save_to_file=False)
+                tokens = json.load(f)
+            # Files written by older versions don't have 'expires_at', the file was written when the tokens were received
+            if 'expires_at' not in tokens and 'expires_in' in tokens:
+                tokens['expires_at'] = path.getmtime(self._tokens_file_path) + tokens['expires_in']
+            self._update_tokens(tokens, save_to_file=False)
 
     def get_user_info(self) -> dict:
         return self._send_authenticated_request('GET', 'users/@me')
 
     def update_anime_episode_count(self, anime_id, new_episode_count: int) -> None:
-        self._send_authenticated_request(
+        self.update_anime_list_status(anime_id, num_watched_episodes=new_episode_count)
+
+    def update_anime_list_status(self, anime_id, **fields) -> dict:
+        """
+        Update the list entry of an anime, see API_LIST_STATUS_FIELDS for the accepted fields.
+        'status' may be either an AnimeStatus or its name in the API.
+        Return the updated list status.
+        """
+        return self._send_authenticated_request(
             'PATCH',
             f'anime/{anime_id}/my_list_status',
-            data=f'num_watched_episodes={new_episode_count}',
+            data=self.__encode_list_status_fields(fields),
             headers={'Content-Type': 'application/x-www-form-urlencoded'}
         )
 
+    def update_anime_list_statuses(self, updates, max_concurrency: int = MAX_CONCURRENT_LIST_UPDATES) -> dict:
+        """
+        Apply many list updates, given as (anime_id, {field: value}) pairs in the order they happened.
+        Updates of the same anime are merged into a single request where later values of a field
+        replace earlier ones, so only the final state of each entry is sent.
+
+        Return {anime_id: EntryContainer(fields, response, error)} where 'response' is the updated
+        list status, or None if the request failed with 'error'. A failed update doesn't stop the others.
+        """
+        coalesced_updates = {}
+        for anime_id, fields in updates:
+            for field_name in fields:
+                if field_name not in API_LIST_STATUS_FIELDS:
+                    raise Exception(f'Unknown list status field "{field_name}"')
+            coalesced_updates.setdefault(anime_id, {}).update(fields)
+
+        def update(anime_id, fields) -> EntryContainer:
+            try:
+                return EntryContainer(fields=fields, response=self.update_anime_list_status(anime_id, **fields), error=None)
+            except Exception as e:
+                return EntryContainer(fields=fields, response=None, error=e)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {anime_id: executor.submit(update, anime_id, fields) for anime_id, fields in coalesced_updates.items()}
+            return {anime_id: future.result() for anime_id, future in futures.items()}
+
+    def get_anime_list(self, fields=None, status: int = None, sort: str = None, mal_user_name: str = '@me') -> list[EntryContainer]:
+        return list(self.iter_anime_list(fields, status, sort, mal_user_name))
+
+    def iter_anime_list(self, fields=None, status: int = None, sort: str = None, mal_user_name: str = '@me') -> Iterator[EntryContainer]:
+        """
+        Yield the entries of a user's list through the API, page by page. The next page is
+        downloaded in the background while the caller processes the current one.
+
+        'fields' are the API's field names to return for each anime (e.g. ['list_status', 'num_episodes']),
+        'status' is an AnimeStatus to filter by and 'sort' is one of the API's sort orders
+        (e.g. 'list_updated_at'). Each entry is the anime's node, with its 'list_status' if requested.
+        """
+        params = {'limit': API_LIST_PAGE_SIZE}
+        if fields:
+            params['fields'] = ','.join(fields)
+        if status is not None:
+            params['status'] = API_ANIME_STATUS_NAMES[status]
+        if sort is not None:
+            params['sort'] = sort
+
+        def get_page(offset: int) -> dict:
+            return self._send_authenticated_request('GET', f'users/{mal_user_name}/animelist', params=dict(params, offset=offset))
+
+        offset = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(get_page, offset)
+            while next_page is not None:
+                page = next_page.result()
+                next_page = None
+
+                offset += len(page['data'])
+                if page.get('paging', {}).get('next') and page['data']:
+                    next_page = executor.submit(get_page, offset)
+
+                for item in page['data']:
+                    entry = EntryContainer(item['node'])
+                    if 'list_status' in item:
+                        entry.list_status = EntryContainer(item['list_status'])
+                    yield entry
+
+    @staticmethod
+    def __encode_list_status_fields(fields: dict) -> dict:
+        encoded_fields = {}
+        for field_name, value in fields.items():
+            if field_name == 'status' and value in API_ANIME_STATUS_NAMES:
+                value = API_ANIME_STATUS_NAMES[value]
+            elif field_name == 'tags' and not isinstance(value, str):
+                value = ','.join(value)
+            elif isinstance(value, bool):
+                value = str(value).lower()
+            encoded_fields[field_name] = value
+        return encoded_fields
+
     def _generate_tokens(self) -> None:
         challenge = secrets.token_urlsafe(100)[:128]
         print('Go to', f'https://myanimelist.net/v1/oauth2/authorize?response_type=code&client_id={self._client_id}&code_challenge={challenge}')
@@ -35,52 +167,101 @@ class MyAnimeListUser:
         if match:
             auth_code = match[1]
 
-        with mal_request():
-            response = requests.post(
-                'https://myanimelist.net/v1/oauth2/token',
-                {
-                    'client_id': self._client_id,
-                    'code': auth_code,
-                    'code_verifier': challenge,
-                    'grant_type': 'authorization_code'
-                }
-            )
+        response = send_request(
+            'POST',
+            MAL_OAUTH_TOKEN_URL,
+            data={
+                'client_id': self._client_id,
+                'code': auth_code,
+                'code_verifier': challenge,
+                'grant_type': 'authorization_code'
+            },
+            max_retries=TOKEN_REQUEST_MAX_RETRIES
+        )
         response.raise_for_status()
         self._update_tokens(response.json())
 
     def _refresh_tokens(self) -> None:
-        with mal_request():
-            response = requests.post(
-                'https://myanimelist.net/v1/oauth2/token',
-                {
-                    'client_id': self._client_id,
-                    'grant_type': 'refresh_token',
-                    'refresh_token': self._refresh_token
-                }
-            )
+        response = send_request(
+            'POST',
+            MAL_OAUTH_TOKEN_URL,
+            data={
+                'client_id': self._client_id,
+                'grant_type': 'refresh_token',
+                'refresh_token': self._refresh_token
+            },
+            max_retries=TOKEN_REQUEST_MAX_RETRIES
+        )
         response.raise_for_status()
         self._update_tokens(response.json())
 
+    def _refresh_tokens_once(self, stale_access_token: str) -> None:
+        """
+        Refresh the tokens unless another thread already replaced 'stale_access_token'
+        while this one was waiting for the lock.
+        """
+        with self._tokens_lock:
+            if self._access_token == stale_access_token:
+                self._refresh_tokens()
+
+    def _get_access_token(self) -> str:
+        """
+        Return a valid access token, refreshing it ahead of its expiry.
+        """
+        access_token = self._access_token
+        expires_at = self._access_token_expires_at
+        if expires_at is None or time() < expires_at - TOKEN_REFRESH_MARGIN:
+            return access_token
+
+        if time() < expires_at - TOKEN_EXPIRY_MARGIN:
+            # Still valid for a while, keep using it until the refresh is done
+            self.__start_background_refresh(access_token)
+            return access_token
+
+        self._refresh_tokens_once(access_token)
+        return self._access_token
+
+    def __start_background_refresh(self, stale_access_token: str) -> None:
+        # Not _tokens_lock, the refresh holds it for a whole (rate limited) request
+        with self._background_refresh_lock:
+            if self._background_refresh is not None and self._background_refresh.is_alive():
+                return
+            self._background_refresh = Thread(target=self.__background_refresh, args=(stale_access_token,), daemon=True)
+            self._background_refresh.start()
+
+    def __background_refresh(self, stale_access_token: str) -> None:
+        try:
+            self._refresh_tokens_once(stale_access_token)
+        except Exception as e:
+            # The token will be refreshed synchronously once it's about to expire
+            print('Failed to refresh tokens in the background:', e, file=sys.stderr)
+
     def _update_tokens(self, tokens_response: dict, *, save_to_file=True) -> None:
-        self._access_token = tokens_response['access_token']
+        if 'expires_at' not in tokens_response and 'expires_in' in tokens_response:
+            tokens_response = dict(tokens_response, expires_at=time() + tokens_response['expires_in'])
+
+        # Update the refresh token first, the new access token is what tells other threads that the refresh is done
         self._refresh_token = tokens_response['refresh_token']
+        self._access_token_expires_at = tokens_response.get('expires_at')
+        self._access_token = tokens_response['access_token']
 
         # Save tokens to file
         if save_to_file:
-            with open(self._tokens_file_path, 'w') as f:
-                json.dump(tokens_response, f, indent=4)
+            atomic_write(self._tokens_file_path, json.dumps(tokens_response, indent=4))
 
-    def _send_authenticated_request(self, request_method, url, headers=None, json_data=None, data=None) -> dict[str, str]:
-        request_headers = {'Authorization': f'Bearer {self._access_token}'}
+    def _send_authenticated_request(self, request_method, url, headers=None, json_data=None, data=None, params=None, *, retry_on_invalid_token=True) -> dict[str, str]:
+        access_token = self._get_access_token()
+        request_headers = {'Authorization': f'Bearer {access_token}'}
         if headers:
             request_headers.update(headers)
-        with mal_request():
-            r = requests.request(request_method, 'https://api.myanimelist.net/v2/'+url, headers=request_headers, json=json_data, data=data)
+        r = send_request(request_method, MAL_API_URL+url, headers=request_headers, json=json_data, data=data, params=params)
 
-        if r.status_code == 401 and r.json()['error'] == 'invalid_token':
+        # Tokens can still be revoked or expire early, refresh them and retry once
+        if r.status_code == 401 and retry_on_invalid_token and r.json().get('error') == 'invalid_token':
             print('Token expired, refreshing')
-            self._refresh_tokens()
-            return self._send_authenticated_request(request_method, url, json_data, data)
+            self._refresh_tokens_once(access_token)
+            return self._send_authenticated_request(
+                request_method, url, headers=headers, json_data=json_data, data=data, params=params, retry_on_invalid_token=False)
 
         if not r.ok:
             print(r.content.decode())
@@ -0,0 +1,96 @@
+# Both parser backends (and the streaming details parser) must return the same
+# results for every page in fixtures/. Run with 'python -m pytest' or 'python -m unittest'.
+import unittest
+from os import listdir
+from mal_common import *
+from mal_benchmark import FIXTURES_DIRECTORY, FIXTURE_PARSERS, get_fixture_parser_name, read_fixture
+import mal_base
+import mal_search
+
+PARSER_BACKENDS = (ParserBackend.BeautifulSoup, ParserBackend.Lxml)
+# Small enough that attributes of the information sidebar are split across chunks
+STREAM_CHUNK_SIZE = 100
+# The title from before the sidebar, a field from the start of the sidebar, one from the middle and one that converts its value
+STREAM_FIELDS = ('title', 'japanese', 'episodes', 'duration')
+
+
+def get_fixture_file_names(parser_name: str) -> list[str]:
+    return [
+        fixture_file_name for fixture_file_name in sorted(listdir(FIXTURES_DIRECTORY))
+        if fixture_file_name.endswith('.html') and get_fixture_parser_name(fixture_file_name) == parser_name
+    ]
+
+
+def split_into_chunks(response_html: str, chunk_size: int = STREAM_CHUNK_SIZE) -> list[bytes]:
+    response_bytes = response_html.encode()
+    return [response_bytes[i:i + chunk_size] for i in range(0, len(response_bytes), chunk_size)]
+
+
+class ParserEquivalenceTest(unittest.TestCase):
+    def setUp(self):
+        previous_backend = get_parser_backend()
+        self.addCleanup(set_parser_backend, previous_backend)
+
+    def parse(self, parser_backend: str, parser, *args):
+        set_parser_backend(parser_backend)
+        return parser(*args)
+
+    def test_fixtures_exist(self):
+        for parser_name in FIXTURE_PARSERS.values():
+            with self.subTest(parser=parser_name):
+                self.assertTrue(get_fixture_file_names(parser_name))
+
+    def test_backends_are_equivalent(self):
+        for parser_name in FIXTURE_PARSERS.values():
+            parser = getattr(mal_search if parser_name == 'parse_search_results' else mal_base, parser_name)
+            for fixture_file_name in get_fixture_file_names(parser_name):
+                with self.subTest(fixture=fixture_file_name):
+                    response_html = read_fixture(fixture_file_name)
+                    bs4_result = self.parse(ParserBackend.BeautifulSoup, parser, response_html)
+                    lxml_result = self.parse(ParserBackend.Lxml, parser, response_html)
+                    self.assertIsNotNone(bs4_result)
+                    self.assertEqual(bs4_result, lxml_result)
+
+    def test_streamed_anime_details(self):
+        for fixture_file_name in get_fixture_file_names('parse_anime_details'):
+            response_html = read_fixture(fixture_file_name)
+            expected = self.parse(ParserBackend.BeautifulSoup, mal_base.parse_anime_details, response_html)
+            for parser_backend in PARSER_BACKENDS:
+                with self.subTest(fixture=fixture_file_name, backend=parser_backend):
+                    self.assertEqual(
+                        self.parse(parser_backend, mal_base.parse_anime_details_stream, split_into_chunks(response_html)), expected)
+
+    def test_streamed_anime_details_fields(self):
+        for fixture_file_name in get_fixture_file_names('parse_anime_details'):
+            response_html = read_fixture(fixture_file_name)
+            details = self.parse(ParserBackend.BeautifulSoup, mal_base.parse_anime_details, response_html)
+            expected = AnimeDetails({field: details[field] for field in STREAM_FIELDS if details[field] is not None})
+            for parser_backend in PARSER_BACKENDS:
+                with self.subTest(fixture=fixture_file_name, backend=parser_backend):
+                    self.assertEqual(
+                        self.parse(parser_backend, mal_base.parse_anime_details_stream, split_into_chunks(response_html), STREAM_FIELDS),
+                        expected)
+
+    def test_streamed_anime_details_stop_early(self):
+        # Chunks after the requested fields are never read
+        for fixture_file_name in get_fixture_file_names('parse_anime_details'):
+            chunks = split_into_chunks(read_fixture(fixture_file_name))
+            read_chunk_count = 0
+
+            def iter_chunks():
+                nonlocal read_chunk_count
+                for chunk in chunks:
+                    read_chunk_count += 1
+                    yield chunk
+
+            with self.subTest(fixture=fixture_file_name):
+                self.parse(ParserBackend.Lxml, mal_base.parse_anime_details_stream, iter_chunks(), ('japanese',))
+                self.assertLess(read_chunk_count, len(chunks))
+
+    def test_unknown_stream_fields(self):
+        with self.assertRaises(ValueError):
+            mal_base.parse_anime_details_stream([], ('bogus',))
+
+
+if __name__ == '__main__':
+    unittest.main()